@@ -0,0 +1,478 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Times every zzzfs and zzzpool command against a pool of synthetic
+# filesystems (see synthetic.py), run from the top of the source tree:
+#
+#   $ python -m benchmarks.suite --filesystems 4 --snapshots 4 --files 1000
+#   $ python -m benchmarks.suite --baseline bench_output.json.orig
+#
+# The pool is built once, with --filesystems filesystems of --files files
+# each and --snapshots snapshots of each, with some of their files changed
+# between snapshots. Each benchmark then runs its command --iterations
+# times, with anything it needs set up beforehand (and any changes it makes
+# undone afterwards) outside of the timing. Results are written as JSON to
+# --output; given the results of an earlier run as --baseline, any command
+# whose median time is more than --threshold slower fails the run.
+#
+# The disks of the pool are temporary directories under --dir (by default,
+# the system's temporary directory), given more than once to spread them
+# over several devices. Comparing a run with --layout mirror against a
+# baseline with --layout single shows the overhead of mirroring.
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import inspect
+import argparse
+import platform
+import tempfile
+
+from libzzzfs import zfs, zpool
+from libzzzfs.cmd.zzzfs import zzzfs_main
+from libzzzfs.cmd.zzzpool import zzzpool_main
+from libzzzfs.dataset import get_dataset_by, DatasetCache
+from libzzzfs.util import ZzzFSException
+
+from benchmarks.synthetic import DataSpec, generate, mutate
+
+POOL = 'bench'
+# runs until interrupted
+UNTIMED_COMMANDS = ('watch',)
+# functions of zfs and zpool which aren't commands
+HELPERS = ('get_pools',)
+LAYOUTS = ('single', 'stripe', 'mirror')
+
+
+def zzzcmd(cmdline):
+    # as in tests.py, through argparse like the command-line tools
+    args = cmdline.split(' ')
+    return {'zzzfs': zzzfs_main, 'zzzpool': zzzpool_main}[args[0]](args)
+
+
+class Fixture(object):
+    '''The pool the benchmarks run against, and what they need to know
+    about it.
+    '''
+    def __init__(self, spec, filesystems, snapshots, layout, dirs):
+        self.spec = spec
+        self.filesystems = ['%s/fs%d' % (POOL, i) for i in range(filesystems)]
+        self.snapshots = ['s%d' % i for i in range(snapshots)]
+        self.layout = layout
+        self.dirs = dirs
+        self.tmp = []
+        self.bytes = 0
+        # each benchmark's changes to the first filesystem are distinct
+        self.generation = len(self.snapshots)
+
+    def mkdtemp(self):
+        path = tempfile.mkdtemp(dir=self.dirs[len(self.tmp) % len(self.dirs)])
+        self.tmp.append(path)
+        return path
+
+    def disks(self):
+        if self.layout == 'single':
+            return [self.mkdtemp()]
+        elif self.layout == 'stripe':
+            return [self.mkdtemp(), self.mkdtemp()]
+        return ['mirror', self.mkdtemp(), self.mkdtemp()]
+
+    def populate(self, name, spec):
+        # a filesystem changing a little between each of its snapshots
+        data = get_dataset_by(name).data
+        self.bytes += generate(data, spec)
+        for i, snapshot in enumerate(self.snapshots):
+            if i:
+                mutate(data, spec, i)
+            zzzcmd('zzzfs snapshot %s@%s' % (name, snapshot))
+
+    def build(self):
+        os.environ['ZZZFS_ROOT'] = self.mkdtemp()
+        # for streams and the like, outside of ZZZFS_ROOT
+        self.scratch = self.mkdtemp()
+        zzzpool_main(['zzzpool', 'create', POOL] + self.disks())
+        for i, name in enumerate(self.filesystems):
+            zzzcmd('zzzfs create %s' % name)
+            spec = DataSpec(**self.spec.to_json())
+            spec.seed += i
+            self.populate(name, spec)
+
+    def clean_up(self):
+        for path in self.tmp:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @property
+    def fs(self):
+        return self.filesystems[0]
+
+    @property
+    def first(self):
+        return '%s@%s' % (self.fs, self.snapshots[0])
+
+    @property
+    def last(self):
+        return '%s@%s' % (self.fs, self.snapshots[-1])
+
+    def change(self):
+        # something new for the first filesystem's next snapshot
+        self.generation += 1
+        mutate(get_dataset_by(self.fs).data, self.spec, self.generation)
+
+    def send(self, path, snapshot, **kwargs):
+        with open(path, 'wb') as f, DatasetCache():
+            zfs.send(snapshot, stream=f, **kwargs)
+
+    def receive(self, path, filesystem):
+        with open(path, 'rb') as f, DatasetCache():
+            zfs.receive(filesystem, stream=f)
+
+
+class Benchmark(object):
+    '''A command to time, with what to do before and after each run.'''
+    def __init__(self, name, command, run, setup=None, teardown=None):
+        self.name = name
+        # the zfs or zpool function it exercises, as zfs.<name>
+        self.command = command
+        self.run = run
+        self.setup = setup or (lambda fixture: None)
+        self.teardown = teardown or (lambda fixture: None)
+
+    def time(self, fixture, iterations):
+        times = []
+        for _ in range(iterations):
+            self.setup(fixture)
+            start = time.time()
+            self.run(fixture)
+            times.append(time.time() - start)
+            self.teardown(fixture)
+        return times
+
+
+def stream_path(fixture):
+    return os.path.join(fixture.scratch, 'bench.zstream')
+
+
+def remove_stream(fixture):
+    os.remove(stream_path(fixture))
+
+
+def send_incremental(fixture):
+    with open(stream_path(fixture), 'wb') as f, DatasetCache():
+        zfs.send(fixture.last, incremental_from=fixture.first, stream=f)
+
+
+def receive_full_setup(fixture):
+    fixture.send(stream_path(fixture), fixture.last)
+
+
+def receive_incremental_setup(fixture):
+    fixture.send(stream_path(fixture), fixture.first)
+    fixture.receive(stream_path(fixture), POOL + '/recv')
+    send_incremental(fixture)
+
+
+def receive_teardown(fixture):
+    remove_stream(fixture)
+    zzzcmd('zzzfs destroy -r %s/recv' % POOL)
+
+
+def destroy_autosnaps(fixture):
+    for name in zzzcmd(
+            'zzzfs list -H -o name -t snapshot -r %s' % POOL).splitlines():
+        if '@autosnap_' in name:
+            zzzcmd('zzzfs destroy %s' % name)
+    zzzcmd('zzzfs inherit com.sun:auto-snapshot %s' % POOL)
+
+
+def program_path(fixture):
+    return os.path.join(fixture.scratch, 'bench.program')
+
+
+def write_program(fixture):
+    with open(program_path(fixture), 'w') as f:
+        for name in fixture.filesystems:
+            f.write('list -r -t all %s\n' % name)
+            f.write('get -r all %s\n' % name)
+            f.write('diff %s@%s %s\n' % (name, fixture.snapshots[0], name))
+
+
+def tier_setup(fixture):
+    # a pool of its own, since archiving can't be undone
+    coldtier = fixture.mkdtemp()
+    zzzpool_main(['zzzpool', 'create', 'cold'] + fixture.disks())
+    zzzcmd('zzzfs create cold/fs')
+    fixture.populate('cold/fs', fixture.spec)
+    zzzcmd('zzzfs set coldtier=%s cold' % coldtier)
+    zzzcmd('zzzfs set coldage=0 cold')
+
+
+def tier_teardown(fixture):
+    zzzcmd('zzzpool destroy cold')
+
+
+# in order: those changing the pool for good (dedup, gc) come last
+BENCHMARKS = [
+    Benchmark('list', 'zfs.list', lambda f: zzzcmd(
+        'zzzfs list -r -t all %s' % POOL)),
+    Benchmark('get', 'zfs.get', lambda f: zzzcmd(
+        'zzzfs get -r -t all all %s' % POOL)),
+    Benchmark('set', 'zfs.set', lambda f: zzzcmd(
+        'zzzfs set com.sun:auto-snapshot=false %s' % POOL),
+        teardown=lambda f: zzzcmd(
+            'zzzfs inherit com.sun:auto-snapshot %s' % POOL)),
+    Benchmark('inherit', 'zfs.inherit', lambda f: zzzcmd(
+        'zzzfs inherit com.sun:auto-snapshot %s' % POOL),
+        setup=lambda f: zzzcmd(
+            'zzzfs set com.sun:auto-snapshot=false %s' % POOL)),
+    Benchmark('diff', 'zfs.diff', lambda f: zzzcmd(
+        'zzzfs diff %s %s' % (f.first, f.last))),
+    Benchmark('diff-filesystem', 'zfs.diff', lambda f: zzzcmd(
+        'zzzfs diff %s %s' % (f.first, f.fs))),
+    Benchmark('create', 'zfs.create', lambda f: zzzcmd(
+        'zzzfs create %s/new' % POOL),
+        teardown=lambda f: zzzcmd('zzzfs destroy %s/new' % POOL)),
+    Benchmark('snapshot', 'zfs.snapshot', lambda f: zzzcmd(
+        'zzzfs snapshot %s@bench' % f.fs),
+        setup=lambda f: f.change(),
+        teardown=lambda f: (
+            zzzcmd('zzzfs destroy %s@bench' % f.fs),
+            zzzcmd('zzzfs rollback %s' % f.last))),
+    Benchmark('rollback', 'zfs.rollback', lambda f: zzzcmd(
+        'zzzfs rollback %s' % f.last),
+        setup=lambda f: f.change()),
+    Benchmark('destroy-snapshot', 'zfs.destroy', lambda f: zzzcmd(
+        'zzzfs destroy %s@bench' % f.fs),
+        setup=lambda f: zzzcmd('zzzfs snapshot %s@bench' % f.fs)),
+    Benchmark('bookmark', 'zfs.bookmark', lambda f: zzzcmd(
+        'zzzfs bookmark %s %s#bench' % (f.first, f.fs)),
+        teardown=lambda f: zzzcmd('zzzfs destroy %s#bench' % f.fs)),
+    Benchmark('clone', 'zfs.clone', lambda f: zzzcmd(
+        'zzzfs clone %s %s/clone' % (f.last, POOL)),
+        teardown=lambda f: zzzcmd('zzzfs destroy %s/clone' % POOL)),
+    Benchmark('promote', 'zfs.promote', lambda f: zzzcmd(
+        'zzzfs promote %s/clone' % POOL),
+        setup=lambda f: zzzcmd('zzzfs clone %s %s/clone' % (f.last, POOL)),
+        teardown=lambda f: (
+            zzzcmd('zzzfs promote %s' % f.fs),
+            zzzcmd('zzzfs destroy %s/clone' % POOL))),
+    Benchmark('copy', 'zfs.copy', lambda f: zzzcmd(
+        'zzzfs copy %s %s/copy' % (f.last, POOL)),
+        teardown=lambda f: zzzcmd('zzzfs destroy -r %s/copy' % POOL)),
+    Benchmark('rename', 'zfs.rename', lambda f: zzzcmd(
+        'zzzfs rename %s %s/renamed' % (f.fs, POOL)),
+        teardown=lambda f: zzzcmd(
+            'zzzfs rename %s/renamed %s' % (POOL, f.fs))),
+    Benchmark('send', 'zfs.send', lambda f: f.send(
+        stream_path(f), f.last),
+        teardown=remove_stream),
+    Benchmark('send-incremental', 'zfs.send', send_incremental,
+              teardown=remove_stream),
+    Benchmark('send-replicate', 'zfs.send', lambda f: f.send(
+        stream_path(f), f.last, replicate=True),
+        teardown=remove_stream),
+    Benchmark('receive', 'zfs.receive', lambda f: f.receive(
+        stream_path(f), POOL + '/recv'),
+        setup=receive_full_setup, teardown=receive_teardown),
+    Benchmark('receive-incremental', 'zfs.receive', lambda f: f.receive(
+        stream_path(f), POOL + '/recv'),
+        setup=receive_incremental_setup, teardown=receive_teardown),
+    Benchmark('autosnap', 'zfs.autosnap', lambda f: zzzcmd(
+        'zzzfs autosnap run'),
+        setup=lambda f: zzzcmd(
+            'zzzfs set com.sun:auto-snapshot=true %s' % POOL),
+        teardown=destroy_autosnaps),
+    Benchmark('program', 'zzzfs program', lambda f: zzzcmd(
+        'zzzfs program %s' % program_path(f)),
+        setup=write_program),
+    Benchmark('pool-list', 'zpool.list', lambda f: zzzcmd(
+        'zzzpool list -v')),
+    Benchmark('pool-status', 'zpool.status', lambda f: zzzcmd(
+        'zzzpool status -v %s' % POOL)),
+    Benchmark('pool-history', 'zpool.history', lambda f: zzzcmd(
+        'zzzpool history -l %s' % POOL)),
+    Benchmark('pool-create', 'zpool.create', lambda f: zzzpool_main(
+        ['zzzpool', 'create', 'new'] + f.disks()),
+        teardown=lambda f: zzzcmd('zzzpool destroy new')),
+    Benchmark('pool-destroy', 'zpool.destroy', lambda f: zzzcmd(
+        'zzzpool destroy new'),
+        setup=lambda f: zzzpool_main(
+            ['zzzpool', 'create', 'new'] + f.disks())),
+    Benchmark('pool-scrub', 'zpool.scrub', lambda f: zzzcmd(
+        'zzzpool scrub %s' % POOL)),
+    Benchmark('pool-tier', 'zpool.tier', lambda f: zzzcmd(
+        'zzzpool tier cold'),
+        setup=tier_setup, teardown=tier_teardown),
+    Benchmark('pool-dedup', 'zpool.dedup', lambda f: zzzcmd(
+        'zzzpool dedup %s' % POOL)),
+    Benchmark('pool-gc', 'zpool.gc', lambda f: zzzcmd(
+        'zzzpool gc %s' % POOL)),
+]
+
+
+def uncovered_commands():
+    '''Return the commands no benchmark exercises, so that new ones aren't
+    left out unnoticed.
+    '''
+    commands = set()
+    for module in (zfs, zpool):
+        prefix = module.__name__.split('.')[-1]
+        for name, value in vars(module).items():
+            if (inspect.isfunction(value) and
+                    value.__module__ == module.__name__ and
+                    name not in HELPERS + UNTIMED_COMMANDS):
+                commands.add('%s.%s' % (prefix, name))
+    return sorted(commands - set(b.command for b in BENCHMARKS))
+
+
+def summarize(times):
+    ordered = sorted(times)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2
+    return {'times': times, 'min': ordered[0], 'median': median,
+            'mean': sum(times) / len(times)}
+
+
+def compare(results, baseline, threshold):
+    '''Print each benchmark's median time against the baseline's, returning
+    the names of those slower by more than threshold (a fraction).
+    '''
+    if results['config'] != baseline['config']:
+        print('warning: baseline ran with a different configuration',
+              file=sys.stderr)
+    regressions = []
+    print('%-20s %10s %10s %8s' % (
+        'BENCHMARK', 'BASELINE', 'MEDIAN', 'CHANGE'))
+    for name, result in sorted(results['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['median']
+        after = result['median']
+        change = (after - before) / before if before else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('%-20s %9.4fs %9.4fs %+7.1f%%%s' % (
+            name, before, after, change * 100, flag))
+    return regressions
+
+
+def run(args):
+    spec = DataSpec(
+        files=args.files, sizes=args.sizes, depth=args.depth,
+        fanout=args.fanout, sparse=args.sparse,
+        compressible=args.compressible, seed=args.seed)
+    fixture = Fixture(spec, args.filesystems, args.snapshots, args.layout,
+                      args.dirs or [None])
+
+    benchmarks = [b for b in BENCHMARKS
+                  if not args.only or b.name in args.only]
+    results = {
+        'config': {
+            'data': spec.to_json(), 'filesystems': args.filesystems,
+            'snapshots': args.snapshots, 'layout': args.layout,
+            'iterations': args.iterations},
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': {}}
+    try:
+        start = time.time()
+        fixture.build()
+        results['fixture'] = {
+            'seconds': time.time() - start, 'bytes': fixture.bytes}
+        for benchmark in benchmarks:
+            times = benchmark.time(fixture, args.iterations)
+            results['benchmarks'][benchmark.name] = summarize(times)
+            print('%-20s %9.4fs' % (
+                benchmark.name, results['benchmarks'][benchmark.name][
+                    'median']), file=sys.stderr)
+    finally:
+        fixture.clean_up()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='time zzzfs and zzzpool commands on synthetic data')
+    parser.add_argument('--filesystems', type=int, default=4)
+    parser.add_argument('--snapshots', type=int, default=4)
+    parser.add_argument('--files', type=int, default=1000,
+                        help='files per filesystem')
+    parser.add_argument('--sizes', default='lognormal:16K',
+                        help='fixed:SIZE, uniform:MIN-MAX or '
+                             'lognormal:MEDIAN[,SIGMA]')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--sparse', type=float, default=0.05,
+                        help='fraction of large files left sparse')
+    parser.add_argument('--compressible', type=float, default=0.5,
+                        help='fraction of file contents that compresses')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--layout', choices=LAYOUTS, default='single')
+    parser.add_argument('--dir', action='append', dest='dirs', default=[],
+                        help='directory for the disks (may be repeated)')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--only', action='append', default=[],
+                        metavar='BENCHMARK', help='run just this benchmark '
+                        '(may be repeated)')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown to treat as a regression '
+                             '(default 0.2, i.e. 20%%)')
+    args = parser.parse_args()
+
+    unknown = set(args.only) - set(b.name for b in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: %s' % ', '.join(sorted(unknown)))
+    for command in uncovered_commands():
+        print('warning: no benchmark for %s' % command, file=sys.stderr)
+
+    try:
+        DataSpec(sizes=args.sizes)
+        results = run(args)
+    except ZzzFSException as e:
+        sys.exit('%s: %s' % (sys.argv[0], e))
+    with io.open(args.output, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(results, indent=2, sort_keys=True) + u'\n')
+
+    if args.baseline:
+        with io.open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.exit('%d benchmark(s) slower than the baseline: %s' % (
+                len(regressions), ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
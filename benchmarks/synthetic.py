@@ -0,0 +1,180 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Reproducible synthetic filesystem contents for the benchmarks: the same
+# DataSpec and seed always give the same tree, down to file contents and
+# times. Sizes are drawn from a distribution given as
+#
+#   fixed:<size>             every file the same size
+#   uniform:<min>-<max>      evenly between two sizes
+#   lognormal:<median>[,<sigma>]  mostly small files, with a long tail
+#
+# with sizes abbreviated as zzzfs prints them (e.g. 16K). Files are spread
+# over a tree of directories <depth> levels deep with <fanout> directories
+# per level; a fraction of them are sparse, and a fraction of each file's
+# contents compresses (the rest is pseudo-random).
+
+import os
+import math
+import random
+import hashlib
+
+from libzzzfs.util import parse_size, ZzzFSException
+
+BLOCK_SIZE = 1 << 16
+# seconds since the epoch given to every file and directory created
+MTIME = 1433131200
+
+
+def parse_sizes(value):
+    '''Return a function drawing a file size from a Random, per a size
+    distribution (see above).
+    '''
+    kind, _, args = value.partition(':')
+    try:
+        if kind == 'fixed':
+            size = parse_size(args)
+            return lambda rng: size
+        if kind == 'uniform':
+            low, high = [parse_size(arg) for arg in args.split('-')]
+            return lambda rng: rng.randint(low, high)
+        if kind == 'lognormal':
+            median, _, sigma = args.partition(',')
+            mu, sigma = math.log(parse_size(median)), float(sigma or 1.5)
+            return lambda rng: int(rng.lognormvariate(mu, sigma))
+    except (ValueError, ZzzFSException):
+        pass
+    raise ZzzFSException('%s: invalid size distribution' % value)
+
+
+class DataSpec(object):
+    '''What to generate: files files, with sizes drawn from sizes, in
+    directories depth levels deep, fanout per level, with sparse of them
+    sparse and compressible of their contents compressible.
+    '''
+    def __init__(self, files=1000, sizes='lognormal:16K', depth=3, fanout=4,
+                 sparse=0.05, compressible=0.5, seed=0):
+        self.files = files
+        self.sizes = sizes
+        self.draw_size = parse_sizes(sizes)
+        self.depth = depth
+        self.fanout = fanout
+        self.sparse = sparse
+        self.compressible = compressible
+        self.seed = seed
+
+    def to_json(self):
+        return dict((key, getattr(self, key)) for key in (
+            'files', 'sizes', 'depth', 'fanout', 'sparse', 'compressible',
+            'seed'))
+
+    def directories(self):
+        # relative paths of the tree's directories, parents first
+        paths = ['']
+        level = ['']
+        for _ in range(self.depth):
+            level = [os.path.join(parent, 'd%d' % i)
+                     for parent in level for i in range(self.fanout)]
+            paths += level
+        return paths
+
+
+class Contents(object):
+    '''Pseudo-random bytes, the same for the same seed.'''
+    def __init__(self, seed):
+        digests = []
+        for i in range(BLOCK_SIZE // 32):
+            digests.append(hashlib.sha256(
+                ('%s:%d' % (seed, i)).encode('ascii')).digest())
+        self.block = b''.join(digests)
+        self.text = b'zzzfs synthetic data ' * (BLOCK_SIZE // 21 + 1)
+
+    def write(self, f, size, rng, compressible, unique):
+        # unique (bytes) first, so that no two files are alike
+        f.write(unique[:size])
+        remaining = size - len(unique[:size])
+        while remaining > 0:
+            n = min(remaining, BLOCK_SIZE)
+            if rng.random() < compressible:
+                f.write(self.text[:n])
+            else:
+                offset = rng.randint(0, BLOCK_SIZE - 1)
+                f.write((self.block[offset:] + self.block[:offset])[:n])
+            remaining -= n
+
+
+def write_file(path, size, rng, contents, spec, unique):
+    with open(path, 'wb') as f:
+        if size > 2 * BLOCK_SIZE and rng.random() < spec.sparse:
+            # data at either end, with a hole in between
+            contents.write(f, BLOCK_SIZE, rng, spec.compressible, unique)
+            f.seek(size - BLOCK_SIZE)
+            contents.write(f, BLOCK_SIZE, rng, spec.compressible, unique)
+        else:
+            contents.write(f, size, rng, spec.compressible, unique)
+    os.utime(path, (MTIME, MTIME))
+
+
+def generate(path, spec):
+    '''Fill the directory at path per spec, returning the number of bytes of
+    file data written.
+    '''
+    rng = random.Random(spec.seed)
+    contents = Contents(spec.seed)
+    directories = spec.directories()
+    for directory in directories[1:]:
+        os.makedirs(os.path.join(path, directory))
+
+    total = 0
+    for i in range(spec.files):
+        size = spec.draw_size(rng)
+        write_file(
+            os.path.join(path, rng.choice(directories), 'f%d' % i), size,
+            rng, contents, spec, ('%d:%d\n' % (spec.seed, i)).encode('ascii'))
+        total += size
+    for directory in reversed(directories):
+        os.utime(os.path.join(path, directory), (MTIME, MTIME))
+    return total
+
+
+def mutate(path, spec, generation, fraction=0.05):
+    '''Change about fraction of the files generated in path per spec, as
+    the given generation of changes (1 for the first): modifying most of
+    them, removing some and adding as many new ones.
+    '''
+    rng = random.Random('%s:%d' % (spec.seed, generation))
+    contents = Contents(spec.seed)
+    files = sorted(
+        os.path.relpath(os.path.join(dirpath, name), path)
+        for dirpath, _, filenames in os.walk(path) for name in filenames)
+    for i, relpath in enumerate(rng.sample(
+            files, int(len(files) * fraction))):
+        full_path = os.path.join(path, relpath)
+        if i % 4 == 3:
+            os.remove(full_path)
+            full_path = os.path.join(
+                os.path.dirname(full_path), 'g%d-%d' % (generation, i))
+        write_file(
+            full_path, spec.draw_size(rng), rng, contents, spec,
+            ('%d:%d:%d\n' % (spec.seed, generation, i)).encode('ascii'))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# zzzfs autosnap run takes the automatic snapshots due for filesystems with
+# com.sun:auto-snapshot=true (set on a filesystem, it applies to all of its
+# descendants too), and prunes the oldest beyond what each frequency keeps.
+# Each frequency can be turned off, or its number kept changed, by
+#
+#   com.sun:auto-snapshot:<frequency>=true|false|<number to keep>
+#
+# A snapshot is due once per period of its frequency, named for the start of
+# the period in local time, e.g. autosnap_hourly-2015-06-01-1300; one run
+# takes whichever are missing. Since names are fixed by the period, runs
+# started at once take the same snapshots, and each pool's lock
+# (<pool_root>/autosnap.lock) keeps them from pruning the same ones.
+#
+# Only snapshots named this way are ever pruned.
+
+import re
+import fcntl
+import datetime
+import contextlib
+
+from libzzzfs.util import ZzzFSException
+
+TAG = 'com.sun:auto-snapshot'
+# each frequency, with the number of its snapshots kept by default
+FREQUENCIES = [
+    ('frequent', 4), ('hourly', 24), ('daily', 31), ('weekly', 8),
+    ('monthly', 12)]
+NAME_FORMAT = 'autosnap_%s-%s'
+DATE_FORMAT = '%Y-%m-%d-%H%M'
+NAME_PATTERN = re.compile(r'^autosnap_(%s)-\d{4}-\d\d-\d\d-\d{4}$' % (
+    '|'.join(frequency for frequency, _ in FREQUENCIES)))
+# snapshots destroyed by each thread at a time
+BATCH_SIZE = 16
+
+
+def parse_keep(frequency, value):
+    '''Return the number of snapshots to keep at a frequency, per the value
+    of its com.sun:auto-snapshot:<frequency> property (0 if turned off).
+    '''
+    if value in (None, 'true'):
+        return dict(FREQUENCIES)[frequency]
+    if value == 'false':
+        return 0
+    if value.isdigit():
+        return int(value)
+    raise ZzzFSException('%s: invalid %s:%s' % (value, TAG, frequency))
+
+
+def period_start(frequency, now):
+    '''Return the start of the period of a frequency containing now.'''
+    start = now.replace(second=0, microsecond=0)
+    if frequency == 'frequent':
+        return start.replace(minute=start.minute - start.minute % 15)
+    start = start.replace(minute=0)
+    if frequency == 'hourly':
+        return start
+    start = start.replace(hour=0)
+    if frequency == 'weekly':
+        return start - datetime.timedelta(days=start.weekday())
+    if frequency == 'monthly':
+        return start.replace(day=1)
+    return start
+
+
+def snapshot_name(frequency, now):
+    return NAME_FORMAT % (
+        frequency, period_start(frequency, now).strftime(DATE_FORMAT))
+
+
+def parse_name(name):
+    '''Return the frequency an automatic snapshot was taken at, or None if
+    the name isn't one of theirs.
+    '''
+    match = NAME_PATTERN.match(name)
+    return match.group(1) if match else None
+
+
+def plan(existing, keeps, now):
+    '''Given the names of a filesystem's snapshots, and the number to keep
+    at each frequency, return the names of the automatic snapshots due as of
+    now (a datetime), and of those to prune, oldest first.
+    '''
+    taken = dict((frequency, []) for frequency, _ in FREQUENCIES)
+    for name in existing:
+        frequency = parse_name(name)
+        if frequency is not None:
+            taken[frequency].append(name)
+
+    due, doomed = [], []
+    for frequency, _ in FREQUENCIES:
+        if not keeps[frequency]:
+            continue
+        names = set(taken[frequency])
+        name = snapshot_name(frequency, now)
+        if name not in names:
+            due.append(name)
+            names.add(name)
+        # named by date, so they sort oldest first
+        doomed += sorted(names)[:-keeps[frequency]]
+    return due, doomed
+
+
+@contextlib.contextmanager
+def locked(path):
+    '''Hold an exclusive lock on path (created if need be) while the context
+    lasts, waiting for it as long as it takes.
+    '''
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# A bookmark (zzzfs bookmark fs@snap fs#mark) keeps what an incremental send
+# from a snapshot needs to know of its data, but none of the data itself:
+#
+#   <filesystem_root>/bookmarks/<mark>
+#
+# one JSON object per line after a header line:
+#
+#   {"version": 1, "snapshot": <snapshot name>, "creation": <time>,
+#    "mark": <the snapshot's change journal mark, or null>}
+#   {"path": <relative path>, "type": "dir"|"file", "size": <bytes>,
+#    "mtime": <time>, "sha256": <hex digest, of files>}
+#
+# Entries describe the snapshot's data as it reads (uncompressed), parents
+# first, so that compare_manifest finds what has changed in a later snapshot
+# just as journal.compare_trees would between the two snapshots.
+
+import os
+import json
+import stat
+
+from libzzzfs.checksum import file_checksum
+
+BOOKMARK_VERSION = 1
+
+
+def _entries(data, path, digests):
+    for name in sorted(os.listdir(os.path.join(data, path))):
+        relpath = os.path.join(path, name)
+        full_path = os.path.join(data, relpath)
+        try:
+            st = os.stat(full_path)
+        except OSError:  # a dangling symlink
+            st = os.lstat(full_path)
+        if os.path.isdir(full_path):
+            yield {'path': relpath, 'type': 'dir', 'size': st.st_size,
+                   'mtime': st.st_mtime}
+            for entry in _entries(data, relpath, digests):
+                yield entry
+            continue
+
+        digest = digests.get(relpath)
+        if digest is None:
+            try:
+                digest = file_checksum(full_path)[0]
+            except (IOError, OSError):
+                pass
+        yield {'path': relpath, 'type': 'file', 'size': st.st_size,
+               'mtime': st.st_mtime, 'sha256': digest}
+
+
+def write_bookmark(path, snapshot_name, creation, data, digests=None,
+                   mark=None):
+    '''Record a bookmark of the named snapshot, created at the given time,
+    whose data (as it reads) is the tree at data. The SHA-256 of files are
+    taken from digests (by relative path) where known, and read otherwise.
+    The snapshot's change journal mark, if any, is kept too.
+    '''
+    # not a valid bookmark name, so never listed as one
+    tmp = os.path.join(
+        os.path.dirname(path), '.%s.tmp' % os.path.basename(path))
+    with open(tmp, 'w') as f:
+        f.write(json.dumps({
+            'version': BOOKMARK_VERSION, 'snapshot': snapshot_name,
+            'creation': creation, 'mark': mark}, sort_keys=True) + '\n')
+        for entry in _entries(data, '', digests or {}):
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    os.rename(tmp, path)
+
+
+def _read_header(f, path):
+    header = json.loads(f.readline())
+    if header.get('version') != BOOKMARK_VERSION:
+        raise ValueError('%s: unsupported bookmark version' % path)
+    if str is bytes:  # Python 2: json gives back unicode strings
+        header['snapshot'] = header['snapshot'].encode('utf-8')
+    return header
+
+
+def read_header(path):
+    '''Return the header of a bookmark, without reading its entries.'''
+    with open(path) as f:
+        return _read_header(f, path)
+
+
+def read_bookmark(path):
+    '''Return the header and entries of a bookmark.'''
+    with open(path) as f:
+        header = _read_header(f, path)
+        entries = [json.loads(line) for line in f]
+    if str is bytes:
+        for entry in entries:
+            entry['path'] = entry['path'].encode('utf-8')
+    return header, entries
+
+
+class Manifest(object):
+    '''A bookmark's entries, compared as though they were the tree itself.'''
+    def __init__(self, entries):
+        self.entries = dict((entry['path'], entry) for entry in entries)
+        self.children = {}
+        for relpath in self.entries:
+            self.children.setdefault(os.path.dirname(relpath), set()).add(
+                os.path.basename(relpath))
+
+    def names(self, path):
+        return self.children.get(path, set())
+
+    def entry(self, path):
+        return self.entries.get(path)
+
+    def digest(self, path):
+        return self.entries[path]['sha256']
+
+
+class Tree(object):
+    '''A directory tree, compared by the same entries a bookmark records. The
+    SHA-256 of files are taken from digests (by relative path) where known,
+    and read otherwise.
+    '''
+    def __init__(self, root, digests=None):
+        self.root = root
+        self.digests = dict(digests or {})
+
+    def names(self, path):
+        return set(os.listdir(os.path.join(self.root, path)))
+
+    def entry(self, path):
+        full_path = os.path.join(self.root, path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            try:  # a dangling symlink
+                st = os.lstat(full_path)
+            except OSError:
+                return None
+        return {'type': 'dir' if stat.S_ISDIR(st.st_mode) else 'file',
+                'size': st.st_size, 'mtime': st.st_mtime}
+
+    def digest(self, path):
+        if path not in self.digests:
+            self.digests[path] = file_checksum(
+                os.path.join(self.root, path))[0]
+        return self.digests[path]
+
+
+def _modified(left, right, path, left_entry, right_entry):
+    # as filecmp.cmp would compare the two files
+    if (left_entry['type'] == 'dir') != (right_entry['type'] == 'dir'):
+        return True
+    if left_entry['size'] != right_entry['size']:
+        return True
+    return left_entry['mtime'] != right_entry['mtime'] and (
+        left.digest(path) != right.digest(path))
+
+
+def _walk_differences(left, right, path):
+    left_names = left.names(path)
+    right_names = right.names(path)
+
+    subdirs = []
+    modified = []
+    for name in sorted(left_names & right_names):
+        relpath = os.path.join(path, name)
+        left_entry, right_entry = left.entry(relpath), right.entry(relpath)
+        if left_entry['type'] == right_entry['type'] == 'dir':
+            subdirs.append(relpath)
+        elif _modified(left, right, relpath, left_entry, right_entry):
+            modified.append(relpath)
+
+    for relpath in modified:
+        yield ('M', relpath)
+    for name in sorted(left_names - right_names):
+        yield ('-', os.path.join(path, name))
+    for name in sorted(right_names - left_names):
+        yield ('+', os.path.join(path, name))
+    for relpath in subdirs:
+        for difference in _walk_differences(left, right, relpath):
+            yield difference
+
+
+def compare_contents(left, right, paths=None):
+    '''Generate (change, path) for each difference between two Manifests or
+    Trees, as journal.compare_trees does between two trees.
+    '''
+    if paths is None:
+        for difference in _walk_differences(left, right, ''):
+            yield difference
+        return
+
+    one_sided = []  # directories only on one side
+    for path in sorted(paths):
+        if not path or any(path.startswith(d + os.sep) for d in one_sided):
+            continue
+        left_entry, right_entry = left.entry(path), right.entry(path)
+
+        if left_entry is not None and right_entry is not None:
+            if left_entry['type'] == right_entry['type'] == 'dir':
+                continue
+            if _modified(left, right, path, left_entry, right_entry):
+                yield ('M', path)
+        elif left_entry is not None or right_entry is not None:
+            yield ('-' if left_entry is not None else '+', path)
+            if (left_entry or right_entry)['type'] == 'dir':
+                one_sided.append(path)
+
+
+def compare_manifest(entries, right, paths=None, digests=None):
+    '''Generate (change, path) for each difference between a bookmark's
+    entries and a directory tree, as journal.compare_trees does between two
+    trees. The SHA-256 of files in right are taken from digests (by relative
+    path) where known, and read otherwise.
+    '''
+    return compare_contents(Manifest(entries), Tree(right, digests), paths)
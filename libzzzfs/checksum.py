@@ -0,0 +1,114 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Snapshots record the SHA-256 of each of their files as stored (that is,
+# compressed, if it is) in <snapshot root>/checksums, one per line:
+#
+#   {"path": <relative path>, "sha256": <hex digest>}
+#
+# for zzzpool scrub to check them against (see scrub.py). The chunks of
+# deduplicated snapshots need no such record, being named by their SHA-256.
+
+import os
+import json
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from libzzzfs import treecopy
+
+BUFFER_SIZE = 1 << 20
+
+
+def file_checksum(path, throttle=None):
+    '''Return the SHA-256 of a file's contents, and their size.'''
+    h = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(BUFFER_SIZE)
+            if not buf:
+                break
+            if throttle is not None:
+                throttle.consume(len(buf))
+            h.update(buf)
+            size += len(buf)
+    return h.hexdigest(), size
+
+
+def read_checksums(path):
+    '''Return a snapshot's recorded checksums, by relative path.'''
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if str is bytes:  # Python 2: json gives back unicode paths
+                entry['path'] = entry['path'].encode('utf-8')
+            checksums[entry['path']] = entry['sha256']
+    return checksums
+
+
+def write_checksums(path, data, linked=()):
+    '''Record the checksum of every file in a snapshot's data. Files
+    hardlinked from another snapshot, per (checksums, data) pairs in linked,
+    keep that snapshot's record of them rather than being read again.
+    '''
+    files = [
+        os.path.relpath(os.path.join(dirpath, name), data)
+        for dirpath, _, filenames in os.walk(data) for name in filenames]
+
+    checksums = {}
+    for other_checksums, other_data in linked:
+        try:
+            recorded = read_checksums(other_checksums)
+        except IOError:  # taken before checksums were recorded
+            continue
+        for relpath in files:
+            if relpath in recorded and relpath not in checksums and (
+                    treecopy.is_linked(os.path.join(other_data, relpath),
+                                       os.path.join(data, relpath))):
+                checksums[relpath] = recorded[relpath]
+
+    unknown = [relpath for relpath in files if relpath not in checksums]
+    threads = min(treecopy.default_threads(data), len(unknown))
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            digests = pool.map(
+                lambda relpath: file_checksum(os.path.join(data, relpath))[0],
+                unknown, chunksize=16)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        digests = [file_checksum(os.path.join(data, relpath))[0]
+                   for relpath in unknown]
+    checksums.update(zip(unknown, digests))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        for relpath in sorted(checksums):
+            f.write(json.dumps(
+                {'path': relpath, 'sha256': checksums[relpath]},
+                sort_keys=True) + '\n')
+    os.rename(tmp, path)
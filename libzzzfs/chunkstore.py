@@ -0,0 +1,315 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Snapshots of filesystems with dedup=on keep their data in a pool-wide,
+# content-addressed store instead of a copy of the tree:
+#
+#   <pool_root>/chunks/
+#     lock
+#     <2 hex digits>/<62 more>    (a chunk, named by its SHA-256)
+#
+# Files are split into CHUNK_SIZE chunks, each stored once however many
+# files and snapshots share it. A snapshot's manifest lists its tree, one JSON
+# object per line after a header line:
+#
+#   {"version": 1, "chunk_size": <bytes>}
+#   {"path": <relative path>, "type": "dir"|"file", "mode": ..., "atime": ...,
+#    "mtime": ..., "size": <bytes>, "chunks": [<hash, or null>, ...]}
+#
+# Null chunks are all zeros, and are left as holes when a file is recreated.
+# Chunks are written before the manifest naming them, under a shared lock;
+# zzzpool gc takes the lock exclusively to remove chunks no manifest names.
+
+import os
+import json
+import stat
+import fcntl
+import hashlib
+import tempfile
+import contextlib
+
+CHUNK_SIZE = 1 << 17
+MANIFEST_VERSION = 1
+
+
+class ChunkStore(object):
+    '''Content-addressed chunks shared by a pool's deduplicated snapshots.'''
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = os.path.join(path, 'lock')
+
+    def chunk_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:  # made by another process meanwhile
+                pass
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put(self, chunk):
+        '''Store a chunk, returning its key, or None if it's all zeros.'''
+        if chunk.count(b'\0') == len(chunk):
+            return None
+        key = hashlib.sha256(chunk).hexdigest()
+        path = self.chunk_path(key)
+        if os.path.exists(path):
+            return key
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError:
+                pass
+        # a chunk only ever appears under its name complete
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(chunk)
+        os.rename(tmp, path)
+        return key
+
+    def get(self, key):
+        with open(self.chunk_path(key), 'rb') as f:
+            return f.read()
+
+    def put_file(self, path):
+        '''Store a file's contents, returning the keys of its chunks.'''
+        keys = []
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                keys.append(self.put(chunk))
+        return keys
+
+    def _entries(self, src, path):
+        # manifest entries for path (relative to src) and everything beneath
+        # it, parents first; symlinks are followed, as by treecopy.copytree
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            full_path = os.path.join(src, path)
+            st = os.stat(full_path)
+            entry = _metadata(path, st)
+            if stat.S_ISDIR(st.st_mode):
+                entry['type'] = 'dir'
+                pending.extend(sorted(
+                    (os.path.join(path, name) for name in os.listdir(
+                        full_path)), reverse=True))
+            else:
+                entry['type'] = 'file'
+                entry['size'] = st.st_size
+                entry['chunks'] = self.put_file(full_path)
+            yield entry
+
+    def snapshot(self, src, manifest, base=None, changes=None):
+        '''Store the tree at src and write its manifest. Given the manifest of
+        an earlier snapshot of the same tree and the relative paths changed
+        since then, only those paths are read.
+        '''
+        with self.locked():
+            if base is None or changes is None:
+                entries = list(self._entries(src, ''))
+            else:
+                entries = self._updated(src, read_manifest(base), changes)
+            write_manifest(manifest, entries)
+
+    def _updated(self, src, entries, changes):
+        entries = dict((e['path'], e) for e in entries)
+        replaced = set()
+        for path in sorted(changes):
+            if _parents(path) & replaced:
+                continue  # already read along with its parent
+            full_path = os.path.join(src, path)
+            old = entries.get(path)
+            if os.path.isdir(full_path) and old and old['type'] == 'dir':
+                # only the directory's own metadata has changed
+                entries[path] = _directory_entry(src, path)
+                continue
+            replaced.add(path)
+
+        # drop everything replaced, then read it again
+        entries = dict(
+            (p, e) for p, e in entries.items()
+            if p not in replaced and not (_parents(p) & replaced))
+        for path in replaced:
+            if os.path.exists(os.path.join(src, path)):
+                for entry in self._entries(src, path):
+                    entries[entry['path']] = entry
+
+        # directory times change with their contents
+        for parent in set(os.path.dirname(p) for p in changes):
+            if parent in entries and os.path.isdir(os.path.join(src, parent)):
+                entries[parent] = _directory_entry(src, parent)
+        return [entries[p] for p in sorted(entries, key=_sort_key)]
+
+    def materialize(self, manifest, dst):
+        '''Recreate the tree described by a manifest at dst, which must not
+        already exist.
+        '''
+        directories = []
+        chunk_size, entries = _read(manifest)
+        for entry in entries:
+            path = os.path.join(dst, entry['path']) if entry['path'] else dst
+            if entry['type'] == 'dir':
+                os.makedirs(path)
+                directories.append((path, entry))
+                continue
+
+            with open(path, 'wb') as f:
+                for key in entry['chunks']:
+                    if key is None:
+                        f.seek(chunk_size, os.SEEK_CUR)
+                    else:
+                        f.write(self.get(key))
+                f.truncate(entry['size'])
+            _set_metadata(path, entry)
+
+        # directory times are set after their contents, deepest first
+        for path, entry in reversed(directories):
+            _set_metadata(path, entry)
+
+    def usage(self, manifests):
+        '''Return the set of keys named by the given manifests, and the number
+        of (non-zero) bytes of file data they describe.
+        '''
+        referenced = set()
+        logical = 0
+        for manifest in manifests:
+            chunk_size, entries = _read(manifest)
+            for entry in entries:
+                for i, key in enumerate(entry.get('chunks', [])):
+                    if key is not None:
+                        referenced.add(key)
+                        logical += min(
+                            chunk_size, entry['size'] - i * chunk_size)
+        return referenced, logical
+
+    def stored(self):
+        '''Generate (key, size) for every chunk in the store.'''
+        if not os.path.isdir(self.path):
+            return
+        for prefix in sorted(os.listdir(self.path)):
+            directory = os.path.join(self.path, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if name.endswith('.tmp'):
+                    yield (None, path)
+                else:
+                    yield (prefix + name, path)
+
+    def dedup_ratio(self, manifests):
+        '''Bytes of data described by the manifests, per byte stored.'''
+        with self.locked():
+            referenced, logical = self.usage(manifests)
+            physical = sum(os.path.getsize(self.chunk_path(key))
+                           for key in referenced)
+        return float(logical) / physical if physical else 1.0
+
+    def collect_garbage(self, manifests):
+        '''Remove every chunk not named by any of the manifests (which must
+        be all of the pool's), returning the number of chunks and bytes freed.
+        '''
+        count = freed = 0
+        with self.locked(exclusive=True):
+            referenced, _ = self.usage(manifests)
+            for key, path in self.stored():
+                # temporary files are left by writers that crashed, since
+                # none can be writing now
+                if key not in referenced:
+                    freed += os.path.getsize(path)
+                    count += 1
+                    os.remove(path)
+        return count, freed
+
+
+def _metadata(path, st):
+    return {'path': path, 'mode': stat.S_IMODE(st.st_mode),
+            'atime': st.st_atime, 'mtime': st.st_mtime}
+
+
+def _directory_entry(src, path):
+    entry = _metadata(path, os.stat(os.path.join(src, path)))
+    entry['type'] = 'dir'
+    return entry
+
+
+def _parents(path):
+    parents = set()
+    while path:
+        path = os.path.dirname(path)
+        parents.add(path)
+    return parents
+
+
+def _sort_key(path):
+    # parents before their contents
+    return path.split(os.sep) if path else []
+
+
+def _set_metadata(path, entry):
+    os.chmod(path, entry['mode'])
+    os.utime(path, (entry['atime'], entry['mtime']))
+
+
+def write_manifest(path, entries):
+    # written aside and renamed, so a manifest is never seen incomplete
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(
+            {'version': MANIFEST_VERSION, 'chunk_size': CHUNK_SIZE}) + '\n')
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def _read(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('version') != MANIFEST_VERSION:
+            raise ValueError('%s: unsupported manifest version' % path)
+        entries = [json.loads(line) for line in f]
+    if str is bytes:  # Python 2: json gives back unicode paths
+        for entry in entries:
+            entry['path'] = entry['path'].encode('utf-8')
+    return header['chunk_size'], entries
+
+
+def read_manifest(path):
+    '''Return the entries of a manifest, parents first.'''
+    return _read(path)[1]
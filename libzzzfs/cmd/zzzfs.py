@@ -22,36 +22,174 @@
 # Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
 
 import sys
-from libzzzfs import zfs
-from libzzzfs.dataset import Dataset, Pool
+import shlex
+import datetime
+
+from libzzzfs import trace, zfs
+from libzzzfs.dataset import Dataset, DatasetCache, Pool
 from libzzzfs.interpreter import ZzzfsCommandInterpreter
-from libzzzfs.util import ZzzFSException
+from libzzzfs.util import OutputLines, write_output, ZzzFSException
+
+# commands which don't modify any pool, and so aren't logged in pool history
+READ_ONLY_COMMANDS = ('diff', 'get', 'list', 'send', 'watch')
+
+# command parameters that may name a dataset
+DATASET_PARAMS = (
+    'clone_filesystem', 'filesystem', 'filesystems', 'identifier',
+    'identifiers', 'other_identifier', 'snapshot', 'snapshots')
 
 
-def zzzfs_main(argv):
-    cmd = ZzzfsCommandInterpreter(argv[1:])
+def modified_pools(cmd):
+    '''Return the names of the pools an interpreted zzzfs command may modify,
+    or None if they can't be told before it runs.
+    '''
+    if cmd.args.command in READ_ONLY_COMMANDS or cmd.params.get('dry_run'):
+        return set()
+    if cmd.args.command == 'autosnap' and not cmd.params['filesystems']:
+        # every pool's filesystems
+        return set(pool.name for pool in Pool.all())
 
-    if cmd.args.command is None:
-        sys.exit(cmd.parser.print_usage())
+    pool_names = set(
+        identifier.split('/', 1)[0].split('@', 1)[0].split('#', 1)[0]
+        for key in DATASET_PARAMS if cmd.params.get(key)
+        for identifier in (
+            cmd.params[key] if isinstance(cmd.params[key], list)
+            else [cmd.params[key]]))
+    return pool_names or None
 
+
+def run_command(cmd):
+    '''Run an interpreted zzzfs command, returning its output (or None) and
+    the names of any pools whose history should record it.
+    '''
     retval = getattr(zfs, cmd.args.command)(**cmd.params)
 
-    if type(retval) is str:
-        return retval
+    if type(retval) is str or isinstance(retval, OutputLines):
+        return (retval, [])
 
-    elif cmd.args.command not in ('diff', 'get', 'list', 'send'):
+    elif cmd.args.command not in READ_ONLY_COMMANDS:
         # pool-modifying commands; log in pool history
         if isinstance(retval, Dataset):
-            retval.pool.log_history_event(argv)
+            return (None, [retval.pool.name])
         else:
             # multiple affected datasets; only log command once per pool
-            for pool_name in list(set(dataset.pool.name for dataset in retval)):
+            return (None, sorted(set(dataset.pool.name for dataset in retval)))
+
+    return (None, [])
+
+
+def zzzfs_main(argv, stdout=None):
+    with trace.command(argv):
+        cmd = ZzzfsCommandInterpreter(argv[1:])
+
+        if cmd.args.command is None:
+            sys.exit(cmd.parser.print_usage())
+
+        if cmd.args.command == 'program':
+            try:
+                return zzzfs_program(argv[0], **cmd.params)
+            finally:
+                if cmd.args.program_file is not sys.stdin:
+                    cmd.args.program_file.close()
+
+        with DatasetCache():
+            output, pool_names = run_command(cmd)
+            output = write_output(output, stdout)
+        with trace.phase('history'):
+            for pool_name in pool_names:
                 Pool(pool_name).log_history_event(argv)
 
+        return output
+
+
+def zzzfs_program(
+        argv0, program_file, stop_on_error=False, rollback=False):
+    '''Run a sequence of zzzfs commands, one per line of program_file (blank
+    lines and #-comments are ignored), in a single process sharing one dataset
+    cache. History is written once per pool after the program ends. By default
+    every command is attempted; with stop_on_error, the first failure ends the
+    program, and with rollback, every affected pool is additionally rewound to
+    its state before the program began.
+    '''
+    # parse the whole program before running any of it
+    commands = []
+    for line_number, line in enumerate(program_file, 1):
+        args = shlex.split(line, comments=True)
+        if not args:
+            continue
+        if args[0] == 'zzzfs':
+            args = args[1:]
+
+        try:
+            cmd = ZzzfsCommandInterpreter(args)
+        except SystemExit:
+            # argparse has already explained the problem on stderr
+            raise ZzzFSException('line %d: invalid command' % line_number)
+        if cmd.args.command in (None, 'program'):
+            raise ZzzFSException('line %d: invalid command' % line_number)
+        commands.append((line_number, [argv0] + args, cmd))
+
+    checkpointed = []
+    if rollback:
+        stop_on_error = True
+        pool_names = set()
+        for line_number, _, cmd in commands:
+            pools = modified_pools(cmd)
+            if pools is None:
+                raise ZzzFSException(
+                    'line %d: cannot tell which pools %s modifies, so it '
+                    'cannot be rolled back' % (line_number, cmd.args.command))
+            pool_names |= pools
+        for pool_name in sorted(pool_names):
+            pool = Pool(pool_name)
+            if pool.exists():
+                pool.checkpoint()
+                checkpointed.append(pool)
+
+    output = []
+    errors = []
+    events = {}
+    with DatasetCache() as cache:
+        for line_number, argv, cmd in commands:
+            cache.new_command()
+            try:
+                result, pool_names = run_command(cmd)
+            except (ZzzFSException, EnvironmentError) as e:
+                errors.append('line %d: %s' % (line_number, e))
+                if stop_on_error:
+                    break
+                continue
+
+            result = write_output(result, None)
+            if result:
+                output.append(result)
+            for pool_name in pool_names:
+                events.setdefault(pool_name, []).append(
+                    (argv, datetime.datetime.now()))
+
+    if errors and checkpointed:
+        for pool in checkpointed:
+            pool.rewind_to_checkpoint()
+        raise ZzzFSException(
+            'program rolled back\n%s' % '\n'.join(errors))
+
+    for pool in checkpointed:
+        pool.discard_checkpoint()
+    with trace.phase('history'):
+        for pool_name, pool_events in sorted(events.items()):
+            Pool(pool_name).log_history_events(pool_events)
+
+    if errors:
+        raise ZzzFSException(
+            '%d of %d commands failed\n%s' % (
+                len(errors), len(commands), '\n'.join(errors)))
+
+    return '\n'.join(output)
+
 
 def main():
     try:
-        output = zzzfs_main(sys.argv)
+        output = zzzfs_main(sys.argv, sys.stdout)
     except ZzzFSException as e:
         sys.exit('%s: %s' % (sys.argv[0], e))
 
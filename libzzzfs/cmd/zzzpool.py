@@ -23,28 +23,34 @@
 
 import sys
 
-from libzzzfs import zpool
-from libzzzfs.dataset import Pool, ZzzFSException
+from libzzzfs import trace, zpool
+from libzzzfs.dataset import DatasetCache, Pool, ZzzFSException
 from libzzzfs.interpreter import ZzzpoolCommandInterpreter
+from libzzzfs.util import OutputLines, write_output
 
 
-def zzzpool_main(argv):
-    cmd = ZzzpoolCommandInterpreter(argv[1:])
+def zzzpool_main(argv, stdout=None):
+    with trace.command(argv):
+        cmd = ZzzpoolCommandInterpreter(argv[1:])
 
-    if cmd.args.command is None:
-        sys.exit(cmd.parser.print_usage())
+        if cmd.args.command is None:
+            sys.exit(cmd.parser.print_usage())
 
-    retval = getattr(zpool, cmd.args.command)(**cmd.params)
-    if type(retval) is str:
-        return retval
+        with DatasetCache():
+            retval = getattr(zpool, cmd.args.command)(**cmd.params)
+            if isinstance(retval, OutputLines):
+                return write_output(retval, stdout)
+        if type(retval) is str:
+            return retval
 
-    if isinstance(retval, Pool) and cmd.args.command == 'create':
-        retval.log_history_event(argv)
+        if isinstance(retval, Pool) and cmd.args.command == 'create':
+            with trace.phase('history'):
+                retval.log_history_event(argv)
 
 
 def main():
     try:
-        output = zzzpool_main(sys.argv)
+        output = zzzpool_main(sys.argv, sys.stdout)
     except ZzzFSException as e:
         sys.exit('%s: %s' % (sys.argv[0], e))
 
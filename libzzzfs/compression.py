@@ -0,0 +1,248 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Snapshots of filesystems with the compression property set store their
+# files compressed, each as a single zlib or xz stream in place of the
+# original. Which files those are is recorded in <snapshot root>/compressed,
+# one JSON object per line after a header line of totals:
+#
+#   {"logical": <bytes of file data>, "physical": <bytes stored>}
+#   {"path": <relative path>, "algorithm": "zlib-6"|"lzma", "size": <bytes>}
+#
+# Files too small to gain anything, with holes, or which don't compress well
+# (judging by their first SAMPLE_SIZE bytes, and then by the result) are
+# stored as they are.
+
+import os
+import json
+import zlib
+import shutil
+import threading
+import multiprocessing
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+from libzzzfs import trace, treecopy
+from libzzzfs.util import ZzzFSException
+
+MIN_SIZE = 1 << 12
+SAMPLE_SIZE = 1 << 16
+BUFFER_SIZE = 1 << 20
+# files are stored raw unless compression saves at least this much
+MIN_SAVINGS = 0.125
+
+
+def parse(value):
+    '''Return the algorithm named by a compression property value, or None if
+    compression is off.
+    '''
+    if value in (None, 'off'):
+        return None
+    if value in ('on', 'zlib'):
+        return 'zlib-6'
+    if value.startswith('zlib-') and value[5:] in list('123456789'):
+        return value
+    if value == 'lzma':
+        if lzma is None:
+            raise ZzzFSException('%s: compression not supported' % value)
+        return value
+    raise ZzzFSException('%s: invalid compression' % value)
+
+
+def _compressor(algorithm):
+    if algorithm == 'lzma':
+        return lzma.LZMACompressor()
+    return zlib.compressobj(int(algorithm.split('-')[1]))
+
+
+def _decompressor(algorithm):
+    if algorithm == 'lzma':
+        return lzma.LZMADecompressor()
+    return zlib.decompressobj()
+
+
+def copy_threads(path):
+    '''Number of files to compress at once onto the device holding path.'''
+    threads = treecopy.default_threads(path)
+    if os.environ.get('ZZZFS_COPY_THREADS'):
+        return threads
+    # compressing is bound by the CPUs rather than the disk
+    try:
+        return max(threads, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return threads
+
+
+class Compressor(object):
+    '''Copies files into a snapshot's data (see treecopy.copytree's
+    copy_function), compressing those worth it, and writes the snapshot's
+    index of compressed files.
+    '''
+    def __init__(self, algorithm, data):
+        self.algorithm = algorithm
+        self.data = data
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.linked = []
+
+    def threads(self, path):
+        # for treecopy.copytree; None for its default
+        if self.algorithm is not None:
+            return copy_threads(path)
+
+    def copy_file(self, src, dst, st=None):
+        if st is None:
+            st = os.stat(src)
+        if self.algorithm is None or st.st_size < MIN_SIZE or (
+                treecopy.has_holes(st)):
+            return treecopy.copy_file(src, dst, st)
+
+        with open(src, 'rb') as fsrc:
+            sample = fsrc.read(SAMPLE_SIZE)
+            # a quick estimate, whatever the algorithm
+            if len(zlib.compress(sample, 1)) > (1 - MIN_SAVINGS) * len(sample):
+                return treecopy.copy_file(src, dst, st)
+
+            compressor = _compressor(self.algorithm)
+            size = len(sample)
+            with open(dst, 'wb') as fdst:
+                fdst.write(compressor.compress(sample))
+                while True:
+                    buf = fsrc.read(BUFFER_SIZE)
+                    if not buf:
+                        break
+                    size += len(buf)
+                    fdst.write(compressor.compress(buf))
+                fdst.write(compressor.flush())
+                stored = fdst.tell()
+
+        if stored > (1 - MIN_SAVINGS) * size:
+            return treecopy.copy_file(src, dst, st)
+        shutil.copystat(src, dst)
+        with self.lock:
+            self.entries[os.path.relpath(dst, self.data)] = {
+                'algorithm': self.algorithm, 'size': size}
+        trace.add('files_compressed')
+        trace.add('bytes_compressed', size)
+        return size
+
+    def link_from(self, index, data):
+        '''Keep the index entries of another snapshot's files which end up
+        hardlinked into this one (see treecopy.linktree).
+        '''
+        self.linked.append((index, data))
+
+    def write_index(self, path):
+        '''Write the index of compressed files, if there are any, once all of
+        the snapshot's data is in place.
+        '''
+        entries = dict(self.entries)
+        for index, data in self.linked:
+            for entry in read_index(index):
+                if entry['path'] not in entries and treecopy.is_linked(
+                        os.path.join(data, entry['path']),
+                        os.path.join(self.data, entry['path'])):
+                    entries[entry['path']] = entry
+        if not entries:
+            return
+
+        logical = physical = 0
+        for dirpath, _, filenames in os.walk(self.data):
+            for name in filenames:
+                file_path = os.path.join(dirpath, name)
+                stored = os.lstat(file_path).st_size
+                entry = entries.get(os.path.relpath(file_path, self.data))
+                logical += entry['size'] if entry else stored
+                physical += stored
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'logical': logical, 'physical': physical}))
+            f.write('\n')
+            for relpath in sorted(entries):
+                entry = dict(entries[relpath], path=relpath)
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+        os.rename(tmp, path)
+
+
+def read_totals(index):
+    with open(index) as f:
+        return json.loads(f.readline())
+
+
+def read_index(index):
+    entries = []
+    with open(index) as f:
+        f.readline()  # totals
+        for line in f:
+            entry = json.loads(line)
+            if str is bytes:  # Python 2: json gives back unicode paths
+                entry['path'] = entry['path'].encode('utf-8')
+            entries.append(entry)
+    return entries
+
+
+def compressratio(index):
+    '''Format the compression ratio recorded in a snapshot's index.'''
+    try:
+        totals = read_totals(index)
+    except (IOError, OSError):  # no index, so nothing compressed
+        return '1.00x'
+    if not totals['physical']:
+        return '1.00x'
+    return '%.2fx' % (float(totals['logical']) / totals['physical'])
+
+
+def decompress_file(src, dst, algorithm):
+    decompressor = _decompressor(algorithm)
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            while True:
+                buf = fsrc.read(BUFFER_SIZE)
+                if not buf:
+                    break
+                fdst.write(decompressor.decompress(buf))
+            if hasattr(decompressor, 'flush'):
+                fdst.write(decompressor.flush())
+    shutil.copystat(src, dst)
+
+
+def restore(index, src, dst):
+    '''Copy a snapshot's data from src to dst, decompressing files as they
+    are copied.
+    '''
+    entries = dict((e['path'], e) for e in read_index(index))
+
+    def copy(src_path, dst_path, st=None):
+        entry = entries.get(os.path.relpath(src_path, src))
+        if entry is None:
+            return treecopy.copy_file(src_path, dst_path, st)
+        decompress_file(src_path, dst_path, entry['algorithm'])
+        return entry['size']
+
+    return treecopy.copytree(
+        src, dst, threads=copy_threads(dst), copy_function=copy)
@@ -27,14 +27,32 @@
 #   <ZZZFS_ROOT>/
 #     <pool_name>/
 #       data -> <disk>
+#       autosnap.lock     (see autosnap.py)
+#       checkpoint/       (while a zzzfs program with --rollback runs)
+#       chunks/           (see chunkstore.py)
+#       dedup/            (see dedup.py)
+#       history/          (see history.py)
+#       history.lock
+#       intent.log        (see intent.py)
 #       properties/
+#       scrub/            (see scrub.py)
+#       vdevs/            (with more than one disk; see vdev.py)
+#       mirrors/          (with mirrored disks; see vdev.py)
 #       filesystems/
 #         <fs_name>/
 #           data -> ../data/<fs_name>/
+#           journal/      (while zzzfs watch runs; see journal.py)
 #           properties/
+#           receive/      (while receiving, or after an interrupted
+#                          receive -s; see sendstream.py)
 #           snapshots/
 #             <snapshot_name>/
-#               data/
+#               archive     (once in a cold tier, with a catalog in place of
+#                            its data; see tier.py)
+#               checksums   (unless dedup=on; see checksum.py)
+#               compressed  (with compression=...; see compression.py)
+#               data/     (or manifest, with dedup=on)
+#               journal_mark  (if made while zzzfs watch ran; see journal.py)
 #               properties/
 #             [...]
 #         <fs_name>%<sub_fs_name>/
@@ -44,112 +62,257 @@
 #         [...]
 #     [...]
 
-import io
 import os
-import csv
-import pwd
-import gzip
 import time
 import shutil
 import logging
-import tarfile
 import datetime
-import platform
-
-from libzzzfs.util import validate_component_name, ZzzFSException
+import uuid
+import tempfile
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+from libzzzfs import (
+    autosnap, bookmark, checksum, compression, sendstream, tier, trace,
+    treecopy, vdev)
+from libzzzfs.chunkstore import ChunkStore
+from libzzzfs.dedup import Deduplicator
+from libzzzfs.history import (
+    current_host, current_user, DATE_FORMAT, PoolHistory)
+from libzzzfs.intent import IntentLog
+from libzzzfs.journal import ChangeJournal, compare_trees, read_mark
+from libzzzfs.scrub import format_status, Scrub
+from libzzzfs.util import (
+    parse_size, validate_component_name, ZzzFSException)
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 ZZZFS_DEFAULT_ROOT = os.path.expanduser('~/.zzzfs')
+# seconds between saves of a resumable receive's progress
+RECEIVE_CHECKPOINT_INTERVAL = 1
+
+
+def get_zzzfs_root():
+    cache = DatasetCache.current
+    if cache is not None:
+        return cache.zzzfs_root
+    return os.environ.get('ZZZFS_ROOT', ZZZFS_DEFAULT_ROOT)
+
+
+class DatasetCache(object):
+    '''Per-process memo of dataset handles, property reads, and filesystem
+    lookups, active while used as a context manager and shared by every
+    command run meanwhile (e.g. all of the commands in a zzzfs program).
+
+    Handles are interned, so each dataset is resolved once. Property writes
+    made through Dataset methods keep the cache current; operations that
+    replace a dataset's files wholesale invalidate everything under the
+    dataset's root. Existence checks and other lookups are only trusted for
+    the duration of one command; see new_command().
+    '''
+    current = None
+
+    # Each memo is simply emptied when it reaches this size, which keeps a
+    # long listing's memory use bounded without any bookkeeping.
+    max_entries = 10000
+
+    def __init__(self):
+        self.zzzfs_root = os.environ.get('ZZZFS_ROOT', ZZZFS_DEFAULT_ROOT)
+        self.handles = {}
+        self.properties = {}
+        self.lookups = {}
+
+    def __enter__(self):
+        # nested caches share the outermost one
+        if DatasetCache.current is not None:
+            return DatasetCache.current
+        DatasetCache.current = self
+        return self
+
+    def __exit__(self, *exc_info):
+        if DatasetCache.current is self:
+            DatasetCache.current = None
+            # one sync for all of the operations completed meanwhile
+            IntentLog.sync_all()
+
+    def new_command(self):
+        # another process may have changed anything between commands
+        self.lookups.clear()
+
+    @classmethod
+    def handle(cls, dataset_class, *args):
+        cache = cls.current
+        if cache is None:
+            return dataset_class(*args)
+
+        key = (dataset_class,) + args
+        if key not in cache.handles:
+            if len(cache.handles) >= cls.max_entries:
+                cache.handles.clear()
+            cache.handles[key] = dataset_class(*args)
+        return cache.handles[key]
+
+    @classmethod
+    def lookup(cls, function, path):
+        '''Memoized function(path), e.g. os.path.exists(path).'''
+        cache = cls.current
+        if cache is None:
+            return function(path)
+
+        key = (function, path)
+        if key not in cache.lookups:
+            if len(cache.lookups) >= cls.max_entries:
+                cache.lookups.clear()
+            cache.lookups[key] = function(path)
+        return cache.lookups[key]
+
+    @classmethod
+    def invalidate(cls, root):
+        cache = cls.current
+        if cache is None:
+            return
+        # keys are copied at once, since other threads may be adding more
+        for path in [p for p in list(cache.properties) if p.startswith(root)]:
+            cache.properties.pop(path, None)
+        for key in [k for k in list(cache.lookups) if k[1].startswith(root)]:
+            cache.lookups.pop(key, None)
 
 
+@trace.traced('resolve')
 def get_dataset_by(dataset_name, should_be=None, should_exist=True):
-    '''Handle user-specified dataset name, returning a Filesystem or Snapshot
-    based on the name. If should_be is specified, an exception is raised if the
-    dataset is not an instance of the specified class. If should_exist is
-    False/True, an exception is raised if the dataset does/does not already
-    exist; no check is performed if should_exist is None.
+    '''Handle user-specified dataset name, returning a Filesystem, Snapshot or
+    Bookmark based on the name. If should_be is specified, an exception is
+    raised if the dataset is not an instance of the specified class. If
+    should_exist is False/True, an exception is raised if the dataset
+    does/does not already exist; no check is performed if should_exist is
+    None.
     '''
     # validate dataset identifier
     filesystem_name = dataset_name
     snapshot_name = None
-    # distinguish between "fs_name" and "fs_name@snapshot"
+    bookmark_name = None
+    # distinguish between "fs_name", "fs_name@snapshot" and "fs_name#bookmark"
     if dataset_name.count('@') == 1:
         filesystem_name, snapshot_name = dataset_name.split('@', 1)
+    elif dataset_name.count('#') == 1:
+        filesystem_name, bookmark_name = dataset_name.split('#', 1)
 
     if not validate_component_name(filesystem_name, allow_slashes=True):
         raise ZzzFSException('%s: invalid dataset identifier' % dataset_name)
 
-    obj = Filesystem(dataset_name)
     if snapshot_name:
         if not validate_component_name(snapshot_name):
             raise ZzzFSException('%s: invalid snapshot name' % snapshot_name)
 
-        obj = Snapshot(filesystem_name, snapshot_name)
+        obj = DatasetCache.handle(Snapshot, filesystem_name, snapshot_name)
+    elif bookmark_name:
+        if not validate_component_name(bookmark_name):
+            raise ZzzFSException('%s: invalid bookmark name' % bookmark_name)
+
+        obj = DatasetCache.handle(Bookmark, filesystem_name, bookmark_name)
+    else:
+        obj = DatasetCache.handle(Filesystem, dataset_name)
 
     if should_be:
         if not isinstance(obj, should_be):
             raise ZzzFSException(
                 '%s: not a %s' % (dataset_name, should_be.__name__.lower()))
 
-    if should_exist and not obj.exists():
-        raise ZzzFSException('%s: no such dataset' % dataset_name)
-    if obj.exists() and should_exist == False:
-        raise ZzzFSException('%s: dataset exists' % dataset_name)
+    if should_exist is not None:
+        exists = obj.exists()
+        if should_exist and not exists:
+            raise ZzzFSException('%s: no such dataset' % dataset_name)
+        if exists and not should_exist:
+            raise ZzzFSException('%s: dataset exists' % dataset_name)
 
     # pool should exist, even if dataset itself shouldn't
     #logger.debug('%s, in pool %s', obj, obj.pool)
     if not obj.pool.exists():
         raise ZzzFSException('%s: no such pool' % obj.pool.name)
+    obj.pool.recover_intents()
 
     return obj
 
 
-def get_all_datasets(identifiers, types, recursive, max_depth):
-    '''Get all datasets matching the given identifier names and dataset types,
-    and optionally all or a generational subset of their descendants.
+def iterdir(path):
+    '''Generate the names of the entries in a directory, reading it
+    incrementally where os.scandir is available. Yields nothing if the
+    directory doesn't exist.
     '''
-    types.validate_against(['all', 'filesystem', 'snapshot', 'snap'])
+    try:
+        entries = os.scandir(path) if hasattr(os, 'scandir') else iter(
+            os.listdir(path))
+    except OSError:  # dataset is currently being destroyed, perhaps
+        return
 
-    # start with set of all filesystems and snapshots
-    filesystems = [f for p in Pool.all() for f in p.get_filesystems()]
-    snapshots = [s for f in filesystems for s in f.get_snapshots()]
-    datasets = filesystems + snapshots
+    try:
+        for entry in entries:
+            yield getattr(entry, 'name', entry)
+    finally:
+        if hasattr(entries, 'close'):
+            entries.close()
 
-    # filter to specific identifiers if requested
-    if identifiers:
-        datasets = [get_dataset_by(i) for i in identifiers]
 
-        # add children of specified identifiers, if requested
-        if recursive or max_depth:
-            children = []
-            for d in datasets:
-                if isinstance(d, Filesystem):
-                    children += d.get_children(max_depth)
-            datasets += children
-
-        # add any snapshots of identifiers and their descendants
-        # it's safe to modify the list as we iterate, because we're only adding
-        # snapshots, not filesystems
-        for d in datasets:
-            if isinstance(d, Filesystem):
-                datasets += d.get_snapshots()
+def get_all_datasets(identifiers, types, recursive, max_depth):
+    '''Get all datasets matching the given identifier names and dataset types,
+    and optionally all or a generational subset of their descendants.
+    Datasets are generated as they are read from disk; snapshot directories
+    are only read if snapshots were requested.
+    '''
+    types.validate_against(
+        ['all', 'filesystem', 'snapshot', 'snap', 'bookmark'])
+    want_filesystems = any(t in ('all', 'filesystem') for t in types.items)
+    want_snapshots = any(t in ('all', 'snapshot', 'snap') for t in types.items)
+    want_bookmarks = any(t in ('all', 'bookmark') for t in types.items)
+
+    # resolve any identifiers up front, so a bad one fails before any output
+    datasets = [get_dataset_by(i) for i in identifiers or []]
+
+    def expand(filesystem):
+        # a filesystem, followed by its snapshots and bookmarks
+        if want_filesystems:
+            yield filesystem
+        if want_snapshots:
+            for snapshot in filesystem.get_snapshots():
+                yield snapshot
+        if want_bookmarks:
+            for mark in filesystem.get_bookmarks():
+                yield mark
+
+    def generate():
+        # start with set of all filesystems and snapshots
+        if not identifiers:
+            for pool in Pool.all():
+                for filesystem in pool.get_filesystems():
+                    for d in expand(filesystem):
+                        yield d
+            return
 
-    # filter out filesystems, if not requested
-    if not any(t in ('all', 'filesystem') for t in types.items):
-        datasets = [d for d in datasets if not isinstance(d, Filesystem)]
+        for dataset in datasets:
+            if isinstance(dataset, Snapshot):
+                if want_snapshots:
+                    yield dataset
+                continue
+            if isinstance(dataset, Bookmark):
+                if want_bookmarks:
+                    yield dataset
+                continue
 
-    # filter out snapshots, if not requested
-    if not any(t in ('all', 'snapshot', 'snap') for t in types.items):
-        datasets = [d for d in datasets if not isinstance(d, Snapshot)]
+            for d in expand(dataset):
+                yield d
+            # add children of specified identifiers, if requested
+            if recursive or max_depth:
+                for child in dataset.iter_children(max_depth):
+                    for d in expand(child):
+                        yield d
 
-    return datasets
+    return generate()
 
 
 class Dataset(object):
-    '''Base class for Pool, Filesystem, and Snapshot. Contains methods that
-    apply to all three objects.
+    '''Base class for Pool, Filesystem, Snapshot, and Bookmark. Contains
+    methods that apply to all of them.
     '''
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.name)
@@ -166,32 +329,66 @@ class Dataset(object):
     def base_attrs(self):
         return {'name': self.name}
 
+    @contextlib.contextmanager
+    def data_tree(self):
+        '''Path to a readable copy of the dataset's data, for as long as the
+        context lasts.
+        '''
+        yield self.data
+
+    @contextlib.contextmanager
+    def contents(self):
+        '''The dataset's data, as bookmark.compare_contents compares it, for
+        as long as the context lasts.
+        '''
+        with self.data_tree() as data:
+            yield bookmark.Tree(data)
+
     @property
-    def creation(self):
+    def creation_time(self):
         # On POSIX systems, ctime is metadata change time, not file creation
         # time, but these should be the same value for our dataset roots.
+        return DatasetCache.lookup(os.path.getctime, self.root)
+
+    @property
+    def creation(self):
         try:
-            return time.ctime(os.path.getctime(self.root))
+            return time.ctime(self.creation_time)
         except OSError:  # dataset is currently being destroyed, perhaps
             return None
 
     def get_parent(self):
         if '/' in self.name:
-            return Filesystem(self.name.rsplit('/', 1)[-2])
-        return Pool(self.name)
+            return DatasetCache.handle(
+                Filesystem, self.name.rsplit('/', 1)[-2])
+        return DatasetCache.handle(Pool, self.name)
 
-    def get_local_properties(self):
-        attrs = self.base_attrs
+    @trace.traced('properties')
+    def read_local_properties(self):
+        cache = DatasetCache.current
+        if cache is not None and self.properties in cache.properties:
+            return cache.properties[self.properties]
+
+        attrs = {}
         try:
             keys = os.listdir(self.properties)
         except OSError:
             # no local attributes
-            return attrs
+            keys = []
 
         for key in keys:
             with open(os.path.join(self.properties, key), 'r') as f:
                 attrs[key] = f.read()
 
+        if cache is not None:
+            if len(cache.properties) >= cache.max_entries:
+                cache.properties.clear()
+            cache.properties[self.properties] = attrs
+        return attrs
+
+    def get_local_properties(self):
+        attrs = self.base_attrs
+        attrs.update(self.read_local_properties())
         #logger.debug('%s local attributes: %s', self.name, attrs)
         return attrs
 
@@ -210,13 +407,32 @@ class Dataset(object):
         return attrs
 
     def add_local_property(self, key, val):
-        if not os.path.exists(self.properties):
-            os.makedirs(self.properties)
         if '/' in key:
             raise ZzzFSException('%s: invalid property' % key)
+        if key == 'compression':
+            compression.parse(val)
+        if key == 'placement':
+            vdev.parse_placement(val)
+        if key == 'coldtier':
+            tier.parse_directory(val)
+        if key == 'coldage':
+            tier.parse_age(val)
+        if key == 'hotsize':
+            parse_size(val)
+        if key.startswith(autosnap.TAG + ':'):
+            frequency = key[len(autosnap.TAG) + 1:]
+            if frequency not in dict(autosnap.FREQUENCIES):
+                raise ZzzFSException('%s: invalid property' % key)
+            autosnap.parse_keep(frequency, val)
+        if not os.path.exists(self.properties):
+            os.makedirs(self.properties)
         with open(os.path.join(self.properties, key), 'w') as f:
             f.write(val)
 
+        cache = DatasetCache.current
+        if cache is not None and self.properties in cache.properties:
+            cache.properties[self.properties][key] = val
+
     def get_property_and_source(self, key):
         local = self.get_local_properties()
         if key in local:
@@ -236,6 +452,9 @@ class Dataset(object):
     def remove_local_property(self, key):
         if self.get_property_and_source(key)[1] == 'local':
             os.remove(os.path.join(self.properties, key))
+            cache = DatasetCache.current
+            if cache is not None and self.properties in cache.properties:
+                cache.properties[self.properties].pop(key, None)
             return True
         else:
             # property did not exist, or is not local
@@ -245,14 +464,16 @@ class Dataset(object):
 class Pool(Dataset):
     def __init__(self, name, should_exist=None):
         self.name = name
-
-        zzzfs_root = os.environ.get('ZZZFS_ROOT', ZZZFS_DEFAULT_ROOT)
-        if not os.path.exists(zzzfs_root):
-            os.makedirs(zzzfs_root)
-
-        self.root = os.path.join(zzzfs_root, self.name)
+        self.root = os.path.join(get_zzzfs_root(), self.name)
         self.filesystems = os.path.join(self.root, 'filesystems')
+        self.vdevs_dir = os.path.join(self.root, 'vdevs')
+        self.mirrors_dir = os.path.join(self.root, 'mirrors')
         self.history = os.path.join(self.root, 'history')
+        self.checkpoint_dir = os.path.join(self.root, 'checkpoint')
+        self.intent_log = os.path.join(self.root, 'intent.log')
+        self.autosnap_lock = os.path.join(self.root, 'autosnap.lock')
+        self.chunk_store = ChunkStore(os.path.join(self.root, 'chunks'))
+        self.recovered = False
 
         if should_exist and not self.exists():
             raise ZzzFSException('%s: no such pool' % self.name)
@@ -267,70 +488,399 @@ class Pool(Dataset):
     def all(self):
         # return an array of all Pool objects
         try:
-            return [Pool(name) for name in os.listdir(
-                os.environ.get('ZZZFS_ROOT', ZZZFS_DEFAULT_ROOT))]
+            return [DatasetCache.handle(Pool, name)
+                    for name in sorted(os.listdir(get_zzzfs_root()))]
         except OSError:
             # zzzfs_root doesn't exist, so no pools have been created
             return []
 
     def exists(self):
-        return self.name in os.listdir(
-            os.environ.get('ZZZFS_ROOT', ZZZFS_DEFAULT_ROOT))
+        return DatasetCache.lookup(os.path.isdir, self.root)
 
-    def create(self, disk):
-        if os.path.exists(disk) and len(os.listdir(disk)) != 0:
-            raise ZzzFSException('%s: disk in use' % self.name)
+    def create(self, vdevs):
+        # vdevs are lists of disks, more than one for a mirror
+        disks = [disk for disks in vdevs for disk in disks]
+        for disk in disks:
+            if os.path.exists(disk) and len(os.listdir(disk)) != 0:
+                raise ZzzFSException('%s: disk in use' % self.name)
+        if len(set(os.path.abspath(disk) for disk in disks)) != len(disks):
+            raise ZzzFSException('%s: disk given more than once' % self.name)
 
         os.makedirs(self.root)
-        pool_target = os.path.join(os.path.abspath(disk), self.name)
-        os.makedirs(pool_target)
-        os.symlink(pool_target, self.data)
+        for i, disks in enumerate(vdevs):
+            for side, disk in enumerate(disks):
+                pool_target = os.path.join(os.path.abspath(disk), self.name)
+                if i == side == 0:
+                    os.makedirs(pool_target)
+                    os.symlink(pool_target, self.data)
+                    continue
+                names = ['data', 'filesystems'] if side == 0 else [
+                    'filesystems']
+                for name in names:
+                    os.makedirs(os.path.join(pool_target, name))
+                link = os.path.join(self.vdevs_dir, str(i)) if side == 0 else (
+                    os.path.join(self.mirrors_dir, str(i), str(side)))
+                if not os.path.exists(os.path.dirname(link)):
+                    os.makedirs(os.path.dirname(link))
+                os.symlink(pool_target, link)
 
         # create initial root filesystem for this pool
-        Filesystem(self.name).create()
+        DatasetCache.invalidate(self.root)
+        DatasetCache.handle(Filesystem, self.name).create()
 
     def destroy(self):
-        if os.path.exists(os.path.realpath(self.data)):
-            shutil.rmtree(os.path.realpath(self.data))
+        for filesystem in self.get_filesystems():
+            for snapshot in filesystem.get_snapshots():
+                if snapshot.is_archived():
+                    tier.remove_archive(os.readlink(snapshot.archive_link))
+        for path in [self.data] + self.get_disk_links():
+            if os.path.exists(os.path.realpath(path)):
+                shutil.rmtree(os.path.realpath(path))
         shutil.rmtree(self.root)
+        DatasetCache.invalidate(self.root)
+
+    def get_vdevs(self):
+        '''Paths of the pool's vdevs, each with data and filesystems
+        directories: the pool's root, then the links to any other disks.
+        '''
+        return [self.root] + [
+            os.path.join(self.vdevs_dir, name)
+            for name in sorted(iterdir(self.vdevs_dir), key=int)]
+
+    def get_mirrors(self, vdev_path):
+        # links to the other sides of a vdev, if it is a mirror
+        sides = os.path.join(
+            self.mirrors_dir, str(self.get_vdevs().index(vdev_path)))
+        return [os.path.join(sides, name)
+                for name in sorted(iterdir(sides), key=int)]
+
+    def get_disk_links(self):
+        # links to every disk but the first, whose link is data
+        return self.get_vdevs()[1:] + [
+            side for path in self.get_vdevs()
+            for side in self.get_mirrors(path)]
+
+    def vdev_usage(self):
+        '''Generate, for each of the pool's vdevs, a list of (disk, size,
+        alloc, free) for each of its disks (more than one for a mirror).
+        '''
+        for path in self.get_vdevs():
+            disks = [self.data if path == self.root else path]
+            disks += self.get_mirrors(path)
+            yield [(os.path.dirname(os.path.realpath(disk)), ) +
+                   vdev.usage(os.path.realpath(disk)) for disk in disks]
+
+    def get_filesystem_names(self):
+        self.recover_intents()
+        for x in iterdir(self.filesystems):
+            # unescape slashes in filesystem names
+            yield x.replace('%', '/')
 
     def get_filesystems(self):
+        for name in self.get_filesystem_names():
+            yield DatasetCache.handle(Filesystem, name)
+
+    def get_manifests(self):
+        for filesystem in self.get_filesystems():
+            for snapshot in filesystem.get_snapshots():
+                if snapshot.is_deduplicated():
+                    yield snapshot.manifest
+
+    def dedup_ratio(self):
+        return self.chunk_store.dedup_ratio(self.get_manifests())
+
+    def collect_garbage(self):
+        '''Remove chunks no longer used by any snapshot, returning the number
+        of chunks and bytes freed.
+        '''
+        return self.chunk_store.collect_garbage(self.get_manifests())
+
+    def deduplicate(self, rate=None):
+        '''Hardlink identical files across the pool's snapshots, reading at
+        most rate bytes per second. Returns the number of files linked and
+        the number of bytes reclaimed.
+        '''
+        snapshots = [
+            (snapshot.data, snapshot.compression_index)
+            for filesystem in self.get_filesystems()
+            for snapshot in filesystem.get_snapshots()
+            if not (snapshot.is_deduplicated() or snapshot.is_archived())]
+        return Deduplicator(os.path.join(self.root, 'dedup'), rate).run(
+            snapshots)
+
+    @property
+    def scrubber(self):
+        return Scrub(os.path.join(self.root, 'scrub'))
+
+    def scrub(self, rate=None):
+        '''Check every snapshot in the pool against its checksums, reading at
+        most rate bytes per second. Returns the scrub's status.
+        '''
+        snapshots, manifests = [], []
+        for filesystem in self.get_filesystems():
+            for snapshot in filesystem.get_snapshots():
+                if snapshot.is_deduplicated():
+                    manifests.append((snapshot.full_name, snapshot.manifest))
+                elif not snapshot.is_archived():
+                    snapshots.append((
+                        snapshot.full_name, snapshot.data,
+                        snapshot.checksums, [
+                            os.path.join(path, 'data')
+                            for path in snapshot.replica_roots
+                            if os.path.isdir(path)]))
+        return self.scrubber.run(snapshots, self.chunk_store, manifests, rate)
+
+    def tier(self, now=None):
+        '''Move snapshots to the pool's cold tier, per its coldtier, coldage
+        and hotsize properties (see tier.py). Returns the snapshots moved.
+        '''
+        # as set on the pool, or its root filesystem
+        root = DatasetCache.handle(Filesystem, self.name)
+        directory = root.get_property('coldtier')
+        if not directory:
+            raise ZzzFSException('%s: no coldtier set' % self.name)
+        directory = os.path.join(directory, self.name)
+        age, budget = root.get_property('coldage'), root.get_property(
+            'hotsize')
+
+        snapshots = [
+            snapshot for filesystem in self.get_filesystems()
+            for snapshot in filesystem.get_snapshots()]
+        chosen = tier.select([
+            (snapshot.creation_order[0], snapshot.data, snapshot)
+            for snapshot in snapshots
+            if not (snapshot.is_deduplicated() or snapshot.is_archived())],
+            now or time.time(), tier.parse_age(age) if age else None,
+            parse_size(budget) if budget else None)
+        for snapshot in chosen:
+            snapshot.archive_to(directory)
+
+        # unless the pool could be rewound to when others were in use
+        if not os.path.exists(self.checkpoint_dir):
+            tier.collect_garbage(directory, set(
+                os.path.realpath(snapshot.archive_link)
+                for snapshot in snapshots if snapshot.is_archived()))
+        return chosen
+
+    def autosnap(self, filesystems, now=None, dry_run=False, threads=None):
+        '''Take the automatic snapshots due for the given filesystems of the
+        pool, and prune those beyond what each frequency keeps (see
+        autosnap.py), several at once. Returns the snapshots taken and
+        destroyed.
+        '''
+        now = now or datetime.datetime.now()
+        with autosnap.locked(self.autosnap_lock):
+            # anything another run did before this one got the lock
+            DatasetCache.invalidate(self.root)
+            due, doomed = [], []
+            for filesystem in filesystems:
+                keeps = dict(
+                    (frequency, autosnap.parse_keep(
+                        frequency, filesystem.get_property(
+                            '%s:%s' % (autosnap.TAG, frequency))))
+                    for frequency, _ in autosnap.FREQUENCIES)
+                names, old = autosnap.plan(
+                    [s.name for s in filesystem.get_snapshots()], keeps, now)
+                due += [DatasetCache.handle(Snapshot, filesystem.name, name)
+                        for name in names]
+                doomed += [DatasetCache.handle(Snapshot, filesystem.name, name)
+                           for name in old]
+            if dry_run:
+                return due, doomed
+
+            def take(snapshots):
+                for snapshot in snapshots:
+                    snapshot.create()
+
+            # filesystems at once, but each one's snapshots in turn
+            by_filesystem = {}
+            for snapshot in due:
+                by_filesystem.setdefault(snapshot.filesystem.name, []).append(
+                    snapshot)
+            pool = ThreadPool(threads or treecopy.default_threads(self.root))
+            try:
+                pool.map(take, list(by_filesystem.values()))
+                pool.map(Snapshot.destroy, doomed, autosnap.BATCH_SIZE)
+            finally:
+                pool.terminate()
+                pool.join()
+        return due, doomed
+
+    def status(self, verbose=False):
+        scrubber = self.scrubber
+        return format_status(
+            self.name, scrubber.read_status(), scrubber.running(), verbose)
+
+    @contextlib.contextmanager
+    def intent(self, op, **args):
+        '''Record a multi-step operation in the pool's intent log while it
+        runs, so that recover_intents() can finish or undo it after a crash.
+        An operation which raises an exception is left for recovery too.
+        '''
+        log = IntentLog.open(self.intent_log)
+        intent_id = log.begin(op, args)
         try:
-            fs = os.listdir(self.filesystems)
-        except OSError:  # dataset is currently being destroyed, perhaps
+            yield
+        except:
+            log.abandon(intent_id)
+            raise
+        # if a cache is active, it syncs all done records on exit
+        log.end(intent_id, sync=DatasetCache.current is None)
+
+    def recover_intents(self):
+        '''Finish or undo any operations interrupted by a crash.'''
+        if self.recovered:
+            return
+        self.recovered = True
+        try:
+            if os.path.getsize(self.intent_log) == 0:
+                return
+        except OSError:  # no operations logged yet
             return
 
-        for x in fs:
-            # unescape slashes when instantiating Filesystem object
-            yield Filesystem(x.replace('%', '/'))
+        try:
+            IntentLog.open(self.intent_log).recover(self.recover_intent)
+        except EnvironmentError:  # pool is currently being destroyed, perhaps
+            return
+        DatasetCache.invalidate(self.root)
 
-    def get_history(self, long_format=False):
+    def recover_intent(self, op, args):
         try:
-            with open(self.history, 'r') as f:
-                history = csv.reader(f)
-                for (date, command, user, host) in history:
-                    if long_format:
-                        yield '%s %s [user %s on %s]' % (date, command, user, host)
-                    else:
-                        yield '%s %s' % (date, command)
-
-        except IOError:
-            # no logged history
-            pass
+            if op in ('create', 'clone'):
+                # undo: remove whatever the operation may have created
+                Filesystem.remove_root(args['root'])
+                paths = [args.get('vdev_root')]
+                if not args['mountpoint_existed']:
+                    paths.append(args['mountpoint'])
+                for path in paths:
+                    if path and os.path.lexists(path):
+                        shutil.rmtree(path)
+
+            elif op in ('snapshot', 'destroy'):
+                # undo a snapshot, or finish destroying one
+                for path in [args['root']] + args.get('replicas', []):
+                    if os.path.lexists(path):
+                        shutil.rmtree(path)
+                if args.get('archive'):
+                    tier.remove_archive(args['archive'])
+
+            elif op == 'archive':
+                # finish, once the archive is linked in; undo otherwise
+                if os.path.lexists(os.path.join(args['root'], 'archive')):
+                    for path in [args['root']] + args['replicas']:
+                        if os.path.exists(os.path.join(path, 'data')):
+                            shutil.rmtree(os.path.join(path, 'data'))
+                else:
+                    # the catalog stays, for the creation time it records
+                    tier.remove_archive(args['archive'])
+
+            elif op == 'rollback':
+                # redo: copy the whole snapshot again
+                DatasetCache.handle(Filesystem, args['filesystem']).rollback_to(
+                    DatasetCache.handle(
+                        Snapshot, args['filesystem'], args['snapshot']))
+
+            elif op == 'rename':
+                Filesystem.finish_rename(**args)
+
+        except EnvironmentError as e:
+            logger.warning('%s: could not recover %s: %s', self.name, op, e)
+            return False
+
+    def get_history(self, long_format=False, since=None, until=None,
+                    tail=None):
+        history = PoolHistory(self.history)
+        for (date, command, user, host) in history.events(since, until, tail):
+            if long_format:
+                yield '%s %s [user %s on %s]' % (date, command, user, host)
+            else:
+                yield '%s %s' % (date, command)
 
     def log_history_event(self, argv, date=None, user=None, host=None):
-        command = ' '.join(argv)
-        if not date:  # default date is now
-            date = datetime.datetime.now()
+        self.log_history_events([(argv, date)], user, host)
+
+    def log_history_events(self, events, user=None, host=None):
+        '''Append a batch of (argv, date) events to the pool history with a
+        single write.
+        '''
         if not user:  # default user is user executing this script
-            user = pwd.getpwuid(os.getuid()).pw_name
+            user = current_user()
         if not host:  # default host is the current platform host
-            host = platform.node()
-
-        with open(self.history, 'a') as f:
-            history = csv.writer(f)
-            history.writerow(
-                [date.strftime('%Y-%m-%d.%H:%M:%S'), command, user, host])
+            host = current_host()
+
+        rows = []
+        for argv, date in events:
+            if not date:  # default date is now
+                date = datetime.datetime.now()
+            rows.append([date.strftime(DATE_FORMAT), ' '.join(argv), user, host])
+        PoolHistory(self.history).append(rows)
+
+    def checkpoint(self):
+        '''Save a copy of the pool's metadata and data, so that the pool can
+        later be rewound to its current state.
+        '''
+        if os.path.exists(self.checkpoint_dir):
+            raise ZzzFSException('%s: pool already has a checkpoint' % self.name)
+
+        os.makedirs(self.checkpoint_dir)
+        for name in os.listdir(self.root):
+            src = os.path.join(self.root, name)
+            if src in (self.data, self.checkpoint_dir, self.vdevs_dir,
+                       self.mirrors_dir):
+                continue
+            dst = os.path.join(self.checkpoint_dir, name)
+            if os.path.isdir(src) and not os.path.islink(src):
+                treecopy.copytree(src, dst, symlinks=True)
+            else:
+                treecopy.copy_file(src, dst)
+        treecopy.copytree(
+            os.path.realpath(self.data),
+            os.path.join(self.checkpoint_dir, 'data'), symlinks=True)
+        # and of the other disks, by the relative paths of their links
+        for path in self.get_disk_links():
+            treecopy.copytree(
+                os.path.realpath(path), os.path.join(
+                    self.checkpoint_dir, os.path.relpath(path, self.root)),
+                symlinks=True)
+
+    def rewind_to_checkpoint(self):
+        '''Discard all changes made since checkpoint() was called.'''
+        if not os.path.exists(self.checkpoint_dir):
+            raise ZzzFSException('%s: pool has no checkpoint' % self.name)
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if path in (self.data, self.checkpoint_dir, self.vdevs_dir,
+                        self.mirrors_dir):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+        pool_target = os.path.realpath(self.data)
+        shutil.rmtree(pool_target)
+        treecopy.move(os.path.join(self.checkpoint_dir, 'data'), pool_target)
+        for path in self.get_disk_links():
+            disk_target = os.path.realpath(path)
+            shutil.rmtree(disk_target)
+            treecopy.move(os.path.join(
+                self.checkpoint_dir, os.path.relpath(path, self.root)),
+                disk_target)
+        for name in ('vdevs', 'mirrors'):
+            if os.path.exists(os.path.join(self.checkpoint_dir, name)):
+                shutil.rmtree(os.path.join(self.checkpoint_dir, name))
+        for name in os.listdir(self.checkpoint_dir):
+            treecopy.move(
+                os.path.join(self.checkpoint_dir, name),
+                os.path.join(self.root, name))
+
+        os.rmdir(self.checkpoint_dir)
+        DatasetCache.invalidate(self.root)
+
+    def discard_checkpoint(self):
+        if os.path.exists(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
 
 
 class Filesystem(Dataset):
@@ -339,22 +889,24 @@ class Filesystem(Dataset):
         self.name = filesystem
         self.safe_name = self.name.replace('/', '%')
 
-        # get pool name by walking up tree
-        obj = self
-        while obj.get_parent():
-            obj = obj.get_parent()
-        self.pool = Pool(obj.name)
+        # pool name is the first component of the filesystem name
+        self.pool = DatasetCache.handle(Pool, self.name.split('/', 1)[0])
         self.poolless_name = self.name[len(self.pool.name)+1:]
 
         self.root = os.path.join(self.pool.root, 'filesystems', self.safe_name)
         self.snapshots = os.path.join(self.root, 'snapshots')
+        self.bookmarks = os.path.join(self.root, 'bookmarks')
+        self.receive_dir = os.path.join(self.root, 'receive')
+        self.receive_state = os.path.join(self.receive_dir, 'state')
+        self.journal = ChangeJournal(os.path.join(self.root, 'journal'))
+        self.placed_on = None  # the vdev chosen for it, until created
 
     @property
     def mountpoint(self):
         # before the filesystem is created, the symlink doesn't resolve, so
         # this is a method that recomputes te property whenever it is accessed
         try:
-            return os.path.realpath(self.data)
+            return DatasetCache.lookup(os.path.realpath, self.data)
         except OSError:  # dataset is currently being destroyed, perhaps
             return None
 
@@ -363,34 +915,124 @@ class Filesystem(Dataset):
         data = super(Filesystem, self).base_attrs
         data['mountpoint'] = self.mountpoint
         data['creation'] = self.creation
+        # live data is never compressed
+        data['compressratio'] = '1.00x'
+        token = DatasetCache.lookup(
+            sendstream.resume_token, self.receive_state)
+        if token is not None:
+            data['receive_resume_token'] = token
         return data
 
     def exists(self):
-        return os.path.exists(self.root)
+        return DatasetCache.lookup(os.path.exists, self.root)
 
-    def get_children(self, max_depth=0):  # 0 = all descendants
-        children = [
-            f for f in self.pool.get_filesystems()
-            if f.name.startswith(self.name + '/')]
-        #logger.debug('%s children: %s', self, children)
-
-        if max_depth > 0:
-            # use number of slashes to count depth
-            depth = max_depth + self.name.count('/')
-            children = [f for f in children if f.name.count('/') <= depth]
+    @property
+    def vdev(self):
+        '''Path of the vdev (see Pool.get_vdevs) the filesystem is on, or is
+        to be created on.
+        '''
+        if DatasetCache.lookup(os.path.islink, self.root):
+            return os.path.normpath(os.path.join(
+                self.pool.filesystems,
+                os.path.dirname(os.path.dirname(os.readlink(self.root)))))
+        if self.exists():
+            return self.pool.root
+        if self.placed_on is None:
+            self.placed_on = self.choose_vdev()
+        return self.placed_on
+
+    def choose_vdev(self):
+        vdevs = self.pool.get_vdevs()
+        if len(vdevs) == 1 or not self.poolless_name:
+            return self.pool.root
+        policy = vdev.parse_placement(
+            self.get_parent().get_property('placement'))
+        counts = [0] * len(vdevs)
+        if policy == 'roundrobin':
+            for filesystem in self.pool.get_filesystems():
+                if filesystem.poolless_name:  # the root is always first
+                    counts[vdevs.index(filesystem.vdev)] += 1
+        return vdevs[vdev.choose(policy, vdevs, self.name, counts)]
+
+    @staticmethod
+    def make_root(root, vdev_root=None):
+        '''Create a filesystem's root directory: in the pool's root, or on
+        another vdev (at vdev_root), linked from the pool's root.
+        '''
+        if vdev_root is None:
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            return
+        if not os.path.isdir(vdev_root):
+            os.makedirs(vdev_root)
+        if not os.path.lexists(root):
+            os.symlink(
+                os.path.relpath(vdev_root, os.path.dirname(root)), root)
+
+    @staticmethod
+    def remove_root(root):
+        if os.path.islink(root):
+            if os.path.exists(root):
+                shutil.rmtree(os.path.realpath(root))
+            os.remove(root)
+        elif os.path.exists(root):
+            shutil.rmtree(root)
 
+    @property
+    def replica_roots(self):
+        # where its snapshots are copied, if its vdev is a mirror
+        return [os.path.join(side, 'filesystems', self.safe_name)
+                for side in self.pool.get_mirrors(self.vdev)]
+
+    def vdev_root(self, on_vdev):
+        # where the root is kept on a vdev other than the pool's first
+        if on_vdev == self.pool.root:
+            return None
+        return os.path.join(on_vdev, 'filesystems', self.safe_name)
+
+    def iter_children(self, max_depth=0):  # 0 = all descendants
+        # filter on names alone, only creating handles for matches
+        # use number of slashes to count depth
+        depth = max_depth + self.name.count('/')
+        for name in self.pool.get_filesystem_names():
+            if not name.startswith(self.name + '/'):
+                continue
+            if max_depth > 0 and name.count('/') > depth:
+                continue
+            yield DatasetCache.handle(Filesystem, name)
+
+    def get_children(self, max_depth=0):
+        children = list(self.iter_children(max_depth))
+        #logger.debug('%s children: %s', self, children)
         return children
 
     def get_snapshots(self):
-        try:
-            snaps = os.listdir(self.snapshots)
-        except OSError:  # dataset is currently being destroyed, perhaps
-            return
+        for x in iterdir(self.snapshots):
+            if not x.startswith('.'):  # a snapshot's data being read
+                yield DatasetCache.handle(Snapshot, self.name, x)
+
+    def get_bookmarks(self):
+        for x in iterdir(self.bookmarks):
+            if not x.startswith('.'):  # one being written
+                yield DatasetCache.handle(Bookmark, self.name, x)
+
+    def find_incremental_source(self, snapshot_name):
+        '''Return the named snapshot of this filesystem, or failing that, a
+        bookmark of it; or None if there is neither.
+        '''
+        snapshot = DatasetCache.handle(Snapshot, self.name, snapshot_name)
+        if snapshot.exists():
+            return snapshot
+        for mark in self.get_bookmarks():
+            if mark.snapshot_name == snapshot_name:
+                return mark
+        return None
 
-        for x in snaps:
-            yield Snapshot(self.name, x)
+    def deduplicates(self):
+        # whether new snapshots go in the pool's chunk store
+        return self.get_property('dedup') in ('on', 'sha256')
 
-    def create(self, create_parents=False, from_stream=None):
+    def create(self, create_parents=False):
         if not self.get_parent().exists():
             if create_parents:
                 #logger.debug('%s: need to create %s', self, self.get_parent())
@@ -399,48 +1041,317 @@ class Filesystem(Dataset):
                 raise ZzzFSException(
                     '%s: parent filesystem missing' % self.name)
 
-        # create relative symlink into pool data
-        target = os.path.join('..', '..', 'data', self.poolless_name)
-        try:
-            os.makedirs(os.path.join(self.root, target))
-        except OSError:
-            # already exists
-            pass
-        os.symlink(target, self.data)
-        os.makedirs(self.properties)
-        os.makedirs(self.snapshots)
-        #logger.debug('%s: pointed %s at %s', self, self.data, target)
-
-        if from_stream:
-            # for receive command: inverse of Snapshot.to_stream
+        intent = self.creation_intent()
+        with self.pool.intent('create', **intent):
+            self.make_root(self.root, intent['vdev_root'])
+            # create relative symlink into its vdev's data
+            target = os.path.join('..', '..', 'data', self.poolless_name)
             try:
-                # gzip needs a seekable object, not a stream
-                #XXX this entails fitting the entire snapshot itno memeory
-                buf = io.BytesIO(from_stream.read())
-                buf.seek(0)
-                with gzip.GzipFile(fileobj=buf) as g:
-                    with tarfile.TarFile(fileobj=g) as t:
-                        #logger.debug('files in stream: %s', t.getnames())
-                        # extract into snapshots directory
-                        t.extractall(self.snapshots)
-
-                        # "rollback" filesystem to snapshot just received
-                        self.rollback_to(
-                            Snapshot(self.name, os.listdir(self.snapshots)[0]))
-
-            except Exception as e:
-                # if anything goes wrong, destroy target filesystem and exit
-                self.destroy()
-                raise ZzzFSException(e)
+                os.makedirs(os.path.join(self.root, target))
+            except OSError:
+                # already exists
+                pass
+            os.symlink(target, self.data)
+            os.makedirs(self.properties)
+            os.makedirs(self.snapshots)
+            DatasetCache.invalidate(self.root)
+            #logger.debug('%s: pointed %s at %s', self, self.data, target)
 
         #logger.debug(
         #    'after creating %s, filesystems in %s: %s', self, self.pool,
         #    self.pool.get_filesystems())
 
+    @trace.traced('receive')
+    def receive(self, from_stream, resumable=False, rollback=True,
+                unchanged=False):
+        '''Receive a stream from Snapshot.to_stream: a new filesystem from a
+        full stream, a snapshot added to this one from an incremental stream,
+        or the rest of an interrupted receive, then (unless not to) roll back
+        to the snapshot received. With resumable, an interrupted receive keeps
+        what arrived, for zzzfs send -t to continue from (see
+        receive_resume_token). Replication streams are passed on to
+        receive_replication.
+
+        The rollback of a new filesystem is written as the stream arrives,
+        rather than copied from the snapshot afterwards; so is that of an
+        incremental stream, if unchanged says this filesystem is known to be
+        as it was at the incremental source.
+        '''
+        stream = sendstream.reading(from_stream)
+        header = stream.header
+        if header.get('replicate') is not None:
+            if resumable:
+                raise ZzzFSException('cannot resume a replication stream')
+            return self.receive_replication(stream, header)
+        state = sendstream.read_state(self.receive_state)
+        if header.get('resume') is not None:
+            if state is None:
+                raise ZzzFSException(
+                    '%s: no interrupted receive to resume' % self.name)
+            if header['snapshot'] != state['snapshot'] or (
+                    header['resume']['members'] != state['members']) or (
+                    header['resume']['offset'] != state['offset']) or (
+                    header.get('dedup', False) != state.get('dedup', False)):
+                raise ZzzFSException(
+                    '%s: stream does not match resume token' % self.name)
+            state['resumable'] = resumable
+            return self.finish_receive(stream, state, rollback)
+        if state is not None:
+            raise ZzzFSException(
+                '%s: receive interrupted; resume it, or abort it with '
+                'zzzfs receive -A' % self.name)
+
+        state = {
+            'snapshot': header['snapshot'], 'from': header['from'],
+            'name': header['snapshot'].split('@', 1)[1], 'base': None,
+            'removed': header.get('removed', []), 'created': False,
+            'resumable': resumable, 'mirror': False,
+            'dedup': header.get('dedup', False)}
+        if header['from'] is None:
+            if self.exists():
+                raise ZzzFSException('%s: dataset exists' % self.name)
+            state['created'] = True
+        elif not self.exists():
+            raise ZzzFSException(
+                'incremental stream requires an existing filesystem')
+        else:
+            state['base'] = header['from'].split('@', 1)[1]
+            base = DatasetCache.handle(Snapshot, self.name, state['base'])
+            if not base.exists():
+                raise ZzzFSException(
+                    '%s: incremental source does not exist' % base.full_name)
+            snapshot = DatasetCache.handle(Snapshot, self.name, state['name'])
+            if snapshot.exists():
+                raise ZzzFSException('%s: dataset exists' % snapshot.full_name)
+        state['mirror'] = rollback and (state['created'] or unchanged)
+
+        if resumable:
+            if state['created']:
+                self.create()
+            self.begin_receive(state)
+            return self.finish_receive(stream, state, rollback)
+
+        # otherwise, a crash leaves nothing behind
+        if state['created']:
+            with self.pool.intent('create', **self.creation_intent()):
+                self.create()
+                self.begin_receive(state)
+                return self.finish_receive(stream, state, rollback)
+        with self.pool.intent('snapshot', root=self.receive_dir):
+            self.begin_receive(state)
+            return self.finish_receive(stream, state, rollback)
+
+    def begin_receive(self, state):
+        partial = os.path.join(self.receive_dir, 'snapshots', state['name'])
+        os.makedirs(partial)
+        if state['base'] is not None:
+            # the stream holds only what changed since the base
+            base = DatasetCache.handle(Snapshot, self.name, state['base'])
+            if base.is_deduplicated():
+                base.copy_data_to(os.path.join(partial, 'data'))
+            else:
+                treecopy.linktree(base.data, os.path.join(partial, 'data'))
+        elif state['mirror']:
+            # the mountpoint is filled as the stream arrives
+            if os.path.exists(self.mountpoint):
+                shutil.rmtree(self.mountpoint)
+            os.makedirs(self.mountpoint)
+        state.update(members=0, offset=0, directories=[])
+        if state['resumable']:
+            sendstream.write_state(self.receive_state, state)
+
+    def finish_receive(self, stream, state, rollback=True):
+        mirror = None
+        if state.get('mirror'):
+            mirror = ('%s/data' % state['name'], self.mountpoint)
+        extractor = sendstream.Extractor(
+            os.path.join(self.receive_dir, 'snapshots'), state, mirror)
+        saved = [time.time()]
+
+        def checkpoint(progress):
+            # so that a crash loses at most a few seconds' progress
+            if time.time() - saved[0] > RECEIVE_CHECKPOINT_INTERVAL:
+                state.update(progress)
+                sendstream.write_state(self.receive_state, state)
+                saved[0] = time.time()
+
+        try:
+            extractor.extract(
+                stream, checkpoint if state['resumable'] else None)
+        except BaseException as e:
+            if not state['resumable']:
+                if state['created']:
+                    self.destroy()
+                else:
+                    shutil.rmtree(self.receive_dir)
+                if isinstance(e, Exception):
+                    raise ZzzFSException(e)
+                raise
+            state.update(extractor.progress)
+            sendstream.write_state(self.receive_state, state)
+            DatasetCache.invalidate(self.root)
+            if isinstance(e, Exception):
+                raise ZzzFSException(
+                    '%s: receive interrupted (%s); resume with zzzfs send -t '
+                    '%s' % (self.name, e, sendstream.encode_token(state)))
+            raise
+        extractor.finish()
+
+        partial = os.path.join(self.receive_dir, 'snapshots', state['name'])
+        data = os.path.join(partial, 'data')
+        for path in state['removed']:
+            treecopy.remove(os.path.join(data, path))
+            if mirror is not None:
+                treecopy.remove(os.path.join(self.mountpoint, path))
+        compressor = compression.Compressor(None, data)
+        linked = []
+        if state['base'] is not None:
+            base = DatasetCache.handle(Snapshot, self.name, state['base'])
+            if not base.is_deduplicated():
+                if base.is_compressed():
+                    compressor.link_from(base.compression_index, base.data)
+                linked.append((base.checksums, base.data))
+        compressor.write_index(os.path.join(partial, 'compressed'))
+        checksum.write_checksums(
+            os.path.join(partial, 'checksums'), data, linked)
+
+        snapshot = DatasetCache.handle(Snapshot, self.name, state['name'])
+        os.rename(partial, snapshot.root)
+        shutil.rmtree(self.receive_dir)
+        snapshot.replicate()
+        DatasetCache.invalidate(self.root)
+        if mirror is not None:
+            self.restore_properties(snapshot)
+        elif rollback:
+            self.rollback_to(snapshot)
+        return snapshot
+
+    def replication_set(self, snapshot_name):
+        '''Return (filesystem, snapshots) for this filesystem and each of its
+        descendants with the named snapshot (whose parents are included too,
+        parents first), with every snapshot up to that one, oldest first.
+        '''
+        filesystems = []
+        included = set()
+        for filesystem in [self] + self.get_children():
+            last = DatasetCache.handle(
+                Snapshot, filesystem.name, snapshot_name)
+            if not last.exists() or (filesystem is not self and (
+                    filesystem.get_parent().name not in included)):
+                continue
+            included.add(filesystem.name)
+            snapshots = sorted(
+                filesystem.get_snapshots(), key=lambda s: s.creation_order)
+            filesystems.append((filesystem, [
+                s for s in snapshots
+                if s.creation_order <= last.creation_order]))
+        return filesystems
+
+    def to_replication_stream(self, stream, snapshot_name, dedup=False):
+        '''Write a replication stream of this filesystem and its descendants
+        with the named snapshot (see replication_set), each with its local
+        properties and every snapshot up to that one (deduplicated, with
+        dedup; see Snapshot.to_stream).
+        '''
+        filesystems = self.replication_set(snapshot_name)
+        sendstream.write_header(stream, {
+            'replicate': '%s@%s' % (self.name, snapshot_name),
+            'filesystems': [{
+                'name': filesystem.name[len(self.name) + 1:],
+                'properties': filesystem.read_local_properties(),
+                'snapshots': [s.name for s in snapshots],
+            } for filesystem, snapshots in filesystems]})
+        for filesystem, snapshots in filesystems:
+            previous = None
+            for snapshot in snapshots:
+                snapshot.to_stream(stream, previous, dedup=dedup)
+                previous = snapshot
+
+    def receive_replication(self, stream, header):
+        '''Receive a stream from to_replication_stream, as this filesystem
+        and its descendants, each rolled back to its latest snapshot.
+        '''
+        stream.finish()
+        received = []
+        for entry in header['filesystems']:
+            filesystem = self
+            if entry['name']:
+                filesystem = DatasetCache.handle(
+                    Filesystem, '%s/%s' % (self.name, entry['name']))
+            # each snapshot received is rolled back to as it arrives, so the
+            # next one's changes can be written to the filesystem as well
+            for i, _ in enumerate(entry['snapshots']):
+                snapshot = filesystem.receive(stream.stream, unchanged=i > 0)
+            received.append((snapshot, entry['properties']))
+
+        for snapshot, properties in received:
+            snapshot.filesystem.replace_local_properties(properties)
+        return [snapshot.filesystem for snapshot, _ in received]
+
+    def copy_snapshots(self, snapshots):
+        '''Create this filesystem with copies of the given snapshots of
+        another, oldest first, and roll back to the last, as receiving a
+        stream of each would; but copying directly, without any streams.
+        '''
+        if self.exists():
+            raise ZzzFSException('%s: dataset exists' % self.name)
+        with self.pool.intent('create', **self.creation_intent()):
+            self.create()
+            previous = None
+            for snapshot in snapshots:
+                copied = snapshot.copy_to(self, previous)
+                previous = (snapshot, copied)
+            self.rollback_to(copied)
+        return copied
+
+    def copy_replication(self, snapshot):
+        '''Copy the filesystem of a snapshot and its descendants to this
+        filesystem, as a replication stream of them would be received.
+        '''
+        source = snapshot.filesystem
+        copies = []
+        for filesystem, snapshots in source.replication_set(snapshot.name):
+            copy = self
+            if filesystem is not source:
+                copy = DatasetCache.handle(Filesystem, '%s/%s' % (
+                    self.name, filesystem.name[len(source.name) + 1:]))
+            copy.copy_snapshots(snapshots)
+            copy.replace_local_properties(filesystem.read_local_properties())
+            copies.append(copy)
+        return copies
+
+    def replace_local_properties(self, properties):
+        for key in self.read_local_properties():
+            if key not in properties:
+                self.remove_local_property(key)
+        for key, val in properties.items():
+            self.add_local_property(key, val)
+
+    def abort_receive(self):
+        '''Discard an interrupted receive, along with the filesystem if it
+        was created by the receive.
+        '''
+        state = sendstream.read_state(self.receive_state)
+        if state is None:
+            raise ZzzFSException(
+                '%s: no interrupted receive to abort' % self.name)
+        if state['created']:
+            self.destroy()
+        else:
+            shutil.rmtree(self.receive_dir)
+            DatasetCache.invalidate(self.root)
+
+    def creation_intent(self):
+        # what recovery must remove, if creating this filesystem is interrupted
+        mountpoint = os.path.realpath(
+            os.path.join(self.vdev, 'data', self.poolless_name))
+        return {
+            'root': self.root, 'vdev_root': self.vdev_root(self.vdev),
+            'mountpoint': mountpoint,
+            'mountpoint_existed': os.path.exists(mountpoint)}
+
     def destroy(self, recursive=False):
-        dependencies = [
-            f for f in self.pool.get_filesystems()
-            if f.name.startswith(self.name + '/')]
+        dependencies = self.get_children()
         #logger.debug('%s dependencies: %s', self, dependencies)
 
         if len(dependencies) > 0 and not recursive:
@@ -452,51 +1363,115 @@ class Filesystem(Dataset):
         # user may have already deleted data
         if os.path.exists(self.mountpoint):
             shutil.rmtree(self.mountpoint)
-        shutil.rmtree(self.root)
+        for path in self.replica_roots:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        for snapshot in self.get_snapshots():
+            if snapshot.disposable_archive is not None:
+                tier.remove_archive(snapshot.disposable_archive)
+        self.remove_root(self.root)
+        DatasetCache.invalidate(self.root)
 
         # delete any child filesystems
         for f in dependencies:
             f.destroy(recursive)
 
     def rollback_to(self, snapshot):
-        shutil.rmtree(self.mountpoint)
-        shutil.copytree(snapshot.data, self.mountpoint)
-
+        with self.pool.intent(
+                'rollback', filesystem=self.name, snapshot=snapshot.name):
+            if os.path.exists(self.mountpoint):
+                shutil.rmtree(self.mountpoint)
+            snapshot.copy_data_to(self.mountpoint)
+            self.restore_properties(snapshot)
+
+    def restore_properties(self, snapshot):
         # restore any local properties
         if os.path.exists(snapshot.properties):
-            shutil.rmtree(self.properties)
-            shutil.copytree(snapshot.properties, self.properties)
+            if os.path.exists(self.properties):
+                shutil.rmtree(self.properties)
+            treecopy.copytree(snapshot.properties, self.properties)
+            DatasetCache.invalidate(self.root)
 
     def rename(self, new_dataset):
-        # re-create relative symlink into pool data
+        # re-create relative symlink into the data of the same vdev
         target = os.path.join('..', '..', 'data', new_dataset.poolless_name)
-        try:
-            os.makedirs(os.path.join(new_dataset.root, target))
-        except OSError:
-            # already exists
-            pass
-
-        # move each component individually
-        os.symlink(target, new_dataset.data)
-
-        # shutil.move treats destination as parent if it is a directory
-        #logger.debug(
-        #    '%s: %s -> %s', self, self.mountpoint, new_dataset.mountpoint)
-        os.rmdir(new_dataset.mountpoint)
-        shutil.move(self.mountpoint, new_dataset.mountpoint)
-        shutil.move(self.properties, new_dataset.root)
-        shutil.move(self.snapshots, new_dataset.root)
-
-        # all data has been moved
-        self.destroy()
+        new_mountpoint = os.path.realpath(
+            os.path.join(self.vdev, 'data', new_dataset.poolless_name))
+        vdev_root = new_dataset.vdev_root(self.vdev)
+        replicas = [
+            (path, os.path.join(os.path.dirname(path), new_dataset.safe_name))
+            for path in self.replica_roots]
+
+        with self.pool.intent(
+                'rename', src_root=self.root, src_mountpoint=self.mountpoint,
+                dst_root=new_dataset.root, dst_mountpoint=new_mountpoint,
+                target=target, dst_vdev_root=vdev_root, replicas=replicas):
+            self.make_root(new_dataset.root, vdev_root)
+            try:
+                os.makedirs(os.path.join(new_dataset.root, target))
+            except OSError:
+                # already exists
+                pass
+
+            # move each component individually
+            os.symlink(target, new_dataset.data)
+
+            #logger.debug(
+            #    '%s: %s -> %s', self, self.mountpoint, new_dataset.mountpoint)
+            os.rmdir(new_dataset.mountpoint)
+            treecopy.move(self.mountpoint, new_dataset.mountpoint)
+            treecopy.move(self.properties, new_dataset.properties)
+            treecopy.move(self.snapshots, new_dataset.snapshots)
+            if os.path.exists(self.bookmarks):
+                treecopy.move(self.bookmarks, new_dataset.bookmarks)
+            for src, dst in replicas:
+                if os.path.exists(src):
+                    os.rename(src, dst)
+            DatasetCache.invalidate(new_dataset.root)
+
+            # all data has been moved
+            self.destroy()
+
+    @staticmethod
+    def finish_rename(src_root, src_mountpoint, dst_root, dst_mountpoint,
+                      target, dst_vdev_root=None, replicas=()):
+        '''Complete an interrupted rename, from whichever step it reached.'''
+        dst_data = os.path.join(dst_root, 'data')
+        if not os.path.lexists(dst_data):
+            Filesystem.make_root(dst_root, dst_vdev_root)
+            os.symlink(target, dst_data)
+
+        if os.path.exists(src_mountpoint):
+            if os.path.isdir(dst_mountpoint) and not os.listdir(dst_mountpoint):
+                os.rmdir(dst_mountpoint)
+            treecopy.move(src_mountpoint, dst_mountpoint)
+        elif not os.path.exists(dst_mountpoint):
+            os.makedirs(dst_mountpoint)
+
+        for name in ('properties', 'snapshots', 'bookmarks'):
+            src = os.path.join(src_root, name)
+            dst = os.path.join(dst_root, name)
+            if os.path.exists(src) and not os.path.exists(dst):
+                treecopy.move(src, dst)
+        for src, dst in replicas:
+            if os.path.exists(src) and not os.path.exists(dst):
+                os.rename(src, dst)
+
+        Filesystem.remove_root(src_root)
 
 
 class Snapshot(Dataset):
     def __init__(self, filesystem, snapshot):
-        self.filesystem = Filesystem(filesystem)
+        self.filesystem = DatasetCache.handle(Filesystem, filesystem)
         self.name = snapshot
         self.full_name = '%s@%s' % (filesystem, snapshot)
         self.root = os.path.join(self.filesystem.root, 'snapshots', self.name)
+        self.manifest = os.path.join(self.root, 'manifest')
+        self.compression_index = os.path.join(self.root, 'compressed')
+        self.checksums = os.path.join(self.root, 'checksums')
+        self.archive_link = os.path.join(self.root, 'archive')
+        self.catalog = os.path.join(self.root, 'catalog')
+        self.journal_mark_file = os.path.join(self.root, 'journal_mark')
         self.pool = self.filesystem.pool
 
     @property
@@ -504,38 +1479,448 @@ class Snapshot(Dataset):
         data = super(Snapshot, self).base_attrs
         data['name'] = self.full_name
         data['creation'] = self.creation
+        data['compressratio'] = DatasetCache.lookup(
+            compression.compressratio, self.compression_index)
+        data['tier'] = 'cold' if self.is_archived() else 'hot'
         return data
 
     def exists(self):
-        return os.path.exists(self.root)
+        return DatasetCache.lookup(os.path.exists, self.root)
+
+    @property
+    def creation_order(self):
+        # snapshots of a filesystem sort by this in the order they were made
+        return (self.creation_time, self.name)
+
+    @property
+    def creation_time(self):
+        # archiving changes the root's ctime, so the catalog records it
+        if DatasetCache.lookup(os.path.exists, self.catalog):
+            return DatasetCache.lookup(
+                bookmark.read_header, self.catalog)['creation']
+        return super(Snapshot, self).creation_time
+
+    @property
+    def journal_mark(self):
+        # its mark in the change journal, if made while a watcher ran
+        return DatasetCache.lookup(read_mark, self.journal_mark_file)
+
+    def is_deduplicated(self):
+        # data is in the pool's chunk store, rather than a tree of its own
+        return DatasetCache.lookup(os.path.exists, self.manifest)
+
+    def is_compressed(self):
+        return DatasetCache.lookup(os.path.exists, self.compression_index)
+
+    def is_archived(self):
+        # data is in an archive in the pool's cold tier
+        return DatasetCache.lookup(os.path.lexists, self.archive_link)
+
+    @property
+    def replica_roots(self):
+        # its copies on the other sides of a mirrored vdev
+        return [os.path.join(path, 'snapshots', self.name)
+                for path in self.filesystem.replica_roots]
+
+    @contextlib.contextmanager
+    def reading(self):
+        '''The root of whichever copy of the snapshot is least loaded, for
+        as long as the context lasts.
+        '''
+        roots = [self.root] + [
+            path for path in self.replica_roots if os.path.isdir(path)]
+        if len(roots) == 1 or self.is_deduplicated():  # data is in chunks
+            yield self.root
+            return
+        with vdev.least_loaded(roots) as root:
+            yield root
+
+    @contextlib.contextmanager
+    def data_tree(self):
+        with self.reading() as root:
+            if not (self.is_deduplicated() or self.is_compressed() or (
+                    self.is_archived())):
+                yield os.path.join(root, 'data')
+                return
+
+            # beside the snapshot's root, since adding to the root would
+            # change its ctime, and so its creation time
+            tmp = tempfile.mkdtemp(
+                prefix='.data-', dir=self.filesystem.snapshots)
+            try:
+                self.copy_data_to(os.path.join(tmp, 'data'), root)
+                yield os.path.join(tmp, 'data')
+            finally:
+                shutil.rmtree(tmp)
+
+    def copy_data_to(self, dst, root=None):
+        if root is None:
+            with self.reading() as root:
+                return self.copy_data_to(dst, root)
+
+        data = os.path.join(root, 'data')
+        with trace.phase('restore'):
+            if self.is_deduplicated():
+                self.pool.chunk_store.materialize(self.manifest, dst)
+            elif self.is_archived() and self.is_compressed():
+                tmp = tempfile.mkdtemp(
+                    prefix='.data-', dir=self.filesystem.snapshots)
+                try:
+                    self.extract_archive(os.path.join(tmp, 'data'))
+                    compression.restore(self.compression_index, os.path.join(
+                        tmp, 'data'), dst)
+                finally:
+                    shutil.rmtree(tmp)
+            elif self.is_archived():
+                self.extract_archive(dst)
+            elif self.is_compressed():
+                compression.restore(
+                    os.path.join(root, 'compressed'), data, dst)
+            else:
+                treecopy.copytree(data, dst)
+
+    @trace.traced('replicate')
+    def replicate(self, previous=None):
+        '''Copy the snapshot to every other side of a mirrored vdev at once.
+        Files it shares with an earlier snapshot (by default, the latest
+        other) are linked to that snapshot's copies.
+        '''
+        replicas = self.replica_roots
+        if not replicas:
+            return
+        if previous is None:
+            earlier = sorted(
+                (s for s in self.filesystem.get_snapshots()
+                 if s.name != self.name), key=lambda s: s.creation_order)
+            previous = earlier[-1] if earlier else None
+
+        def copy(i):
+            base = None
+            if previous is not None and os.path.isdir(
+                    previous.replica_roots[i]):
+                base = (previous.root, previous.replica_roots[i])
+            vdev.replicate(self.root, replicas[i], base)
+
+        pool = ThreadPool(len(replicas))
+        try:
+            pool.map(copy, range(len(replicas)))
+        finally:
+            pool.terminate()
+            pool.join()
 
     def create(self):
-        os.makedirs(self.root)
-        shutil.copytree(self.filesystem.data, self.data)
-        if os.path.exists(self.filesystem.properties):
-            shutil.copytree(self.filesystem.properties, self.properties)
-        else:
-            # no local properties associated with current working filesystem;
-            #  use an empty directory for the snapshot's filesystem
-            os.makedirs(self.properties)
+        with self.pool.intent(
+                'snapshot', root=self.root, replicas=self.replica_roots):
+            os.makedirs(self.root)
+
+            # with a change journal, only what changed since the last
+            # snapshot needs copying; the rest is linked from that snapshot
+            journal = self.filesystem.journal
+            previous, changes = None, None
+            # marked by a name of its own, not the snapshot's, which may be
+            # renamed or reused after this snapshot is destroyed
+            mark = uuid.uuid4().hex
+            if journal.mark(mark):
+                with open(self.journal_mark_file, 'w') as f:
+                    f.write(mark)
+                marks = dict(
+                    (s.journal_mark, s.name)
+                    for s in self.filesystem.get_snapshots()
+                    if s.name != self.name and s.journal_mark is not None)
+                previous, changes = journal.find(mark, marks)
+            if previous is not None:
+                previous = DatasetCache.handle(
+                    Snapshot, self.filesystem.name, marks[previous])
+
+            compressor = compression.Compressor(compression.parse(
+                self.filesystem.get_property('compression')), self.data)
+            linked = []
+            with trace.phase('copy'):
+                if self.filesystem.deduplicates():
+                    self.pool.chunk_store.snapshot(
+                        self.filesystem.data, self.manifest,
+                        previous.manifest if changes is not None and (
+                            previous.is_deduplicated()) else None, changes)
+                elif changes is None or previous.is_deduplicated() or (
+                        previous.is_archived()):
+                    treecopy.copytree(
+                        self.filesystem.data, self.data,
+                        threads=compressor.threads(self.root),
+                        copy_function=compressor.copy_file)
+                else:
+                    treecopy.linktree(previous.data, self.data)
+                    if previous.is_compressed():
+                        compressor.link_from(
+                            previous.compression_index, previous.data)
+                    linked.append((previous.checksums, previous.data))
+                    treecopy.update(
+                        self.filesystem.data, self.data, changes,
+                        copy_function=compressor.copy_file)
+                compressor.write_index(self.compression_index)
+            if not self.filesystem.deduplicates():
+                with trace.phase('checksum'):
+                    checksum.write_checksums(
+                        self.checksums, self.data, linked)
+
+            if os.path.exists(self.filesystem.properties):
+                treecopy.copytree(self.filesystem.properties, self.properties)
+            else:
+                # no local properties associated with current working
+                # filesystem; use an empty directory for the snapshot's
+                # filesystem
+                os.makedirs(self.properties)
+            self.replicate(previous)
+        DatasetCache.invalidate(self.root)
+
+    def archive_to(self, directory):
+        '''Move the snapshot's data to an archive in directory (see tier.py),
+        leaving a catalog of it in its place.
+        '''
+        path = tier.new_archive(directory, self.full_name)
+        replicas = [root for root in self.replica_roots if os.path.isdir(root)]
+        with self.pool.intent(
+                'archive', root=self.root, replicas=replicas, archive=path):
+            creation = self.creation_time
+            with self.data_tree() as data:
+                bookmark.write_bookmark(
+                    self.catalog, self.name, creation, data,
+                    self.recorded_digests(data))
+            tier.write_archive(path, self.full_name, self.data)
+            os.symlink(path, self.archive_link)
+            for root in [self.root] + replicas:
+                shutil.rmtree(os.path.join(root, 'data'))
+        DatasetCache.invalidate(self.root)
+
+    def extract_archive(self, dst):
+        # its stored data, as it was before archiving
+        tier.extract_archive(os.readlink(self.archive_link), dst)
+
+    @property
+    def disposable_archive(self):
+        # its archive, if there is one and destroying the snapshot should
+        # remove it: not while the pool can be rewound to a checkpoint where
+        # it's in use (zzzpool tier removes it later)
+        if self.is_archived() and not os.path.exists(
+                self.pool.checkpoint_dir):
+            return os.readlink(self.archive_link)
+        return None
 
     def rename(self, new_snapshot):
         os.rename(self.root, new_snapshot.root)
+        for src, dst in zip(self.replica_roots, new_snapshot.replica_roots):
+            if os.path.exists(src):
+                os.rename(src, dst)
+        DatasetCache.invalidate(self.root)
+        DatasetCache.invalidate(new_snapshot.root)
 
     def clone_to(self, new_filesystem):
-        new_filesystem.create()
-        #logger.debug('%s: cloning to %s', self, new_filesystem.mountpoint)
+        with new_filesystem.pool.intent(
+                'clone', **new_filesystem.creation_intent()):
+            new_filesystem.create()
+            #logger.debug('%s: cloning to %s', self, new_filesystem.mountpoint)
+
+            # remove folders to be replaced by copytree
+            #logger.debug(
+            #    '%s: %s -> %s', self, self.data, new_filesystem.mountpoint)
+            os.rmdir(new_filesystem.mountpoint)
+            os.rmdir(new_filesystem.properties)
+            self.copy_data_to(new_filesystem.mountpoint)
+            treecopy.copytree(self.properties, new_filesystem.properties)
+        DatasetCache.invalidate(new_filesystem.root)
+
+    def copy_to(self, filesystem, previous=None):
+        '''Copy this snapshot to another filesystem, as a snapshot of the
+        same name. Its stored data is hardlinked if both are on the same
+        device, and copied otherwise: given previous, (an earlier snapshot,
+        its copy on that filesystem), only what changed since is copied.
+        '''
+        copy = DatasetCache.handle(Snapshot, filesystem.name, self.name)
+        # put together out of sight, then moved into place
+        partial = os.path.join(filesystem.receive_dir, 'snapshots', self.name)
+        os.makedirs(partial)
+        data = os.path.join(partial, 'data')
+        if self.is_deduplicated():
+            self.copy_data_to(data)
+            checksum.write_checksums(os.path.join(partial, 'checksums'), data)
+        else:
+            if self.is_archived():
+                self.extract_archive(data)
+            elif treecopy.same_device(self.data, partial):
+                treecopy.linktree(self.data, data)
+            elif previous is not None and not any(
+                    s.is_deduplicated() or s.is_archived() for s in previous):
+                base, base_copy = previous
+                treecopy.linktree(base_copy.data, data)
+                treecopy.update(self.data, data, [
+                    path for _, path in compare_trees(
+                        base.data, self.data, self.changes_since(base))])
+            else:
+                treecopy.copytree(self.data, data)
+            # the same files, so the same checksums and compression
+            for path in (self.compression_index, self.checksums):
+                if os.path.exists(path):
+                    shutil.copy2(path, partial)
+        treecopy.copytree(self.properties, os.path.join(partial, 'properties'))
+
+        os.rename(partial, copy.root)
+        shutil.rmtree(filesystem.receive_dir)
+        copy.replicate(previous[1] if previous is not None else None)
+        DatasetCache.invalidate(filesystem.root)
+        return copy
+
+    def changes_since(self, snapshot):
+        '''Paths changed in this snapshot since an earlier snapshot of the same
+        filesystem, per the change journal, or None if unknown.
+        '''
+        if snapshot.journal_mark is None or self.journal_mark is None:
+            return None
+        return self.filesystem.journal.changes_between(
+            snapshot.journal_mark, self.journal_mark)
 
-        # remove folders to be replaced by copytree
-        #logger.debug(
-        #    '%s: %s -> %s', self, self.data, new_filesystem.mountpoint)
-        os.rmdir(new_filesystem.mountpoint)
-        os.rmdir(new_filesystem.properties)
-        shutil.copytree(self.data, new_filesystem.mountpoint)
-        shutil.copytree(self.properties, new_filesystem.properties)
-
-    def to_stream(self, stream):
-        # write a gzipped tar of the snapshot to the stream
-        with gzip.GzipFile(fileobj=stream, mode='w') as g:
-            with tarfile.open(fileobj=g, mode='w') as t:
-                t.add(self.root, arcname=self.name)
+    def read_entries(self):
+        # of an archived snapshot's data, from its catalog
+        return bookmark.read_bookmark(self.catalog)[1]
+
+    @contextlib.contextmanager
+    def contents(self):
+        if self.is_archived():
+            yield bookmark.Manifest(self.read_entries())
+            return
+        with self.data_tree() as data:
+            yield bookmark.Tree(data, self.recorded_digests(data))
+
+    def recorded_digests(self, data):
+        # SHA-256 of the files in its data by relative path, as recorded
+        # when the snapshot was taken; usable if data is a stored tree
+        stored = [os.path.join(root, 'data')
+                  for root in [self.root] + self.replica_roots]
+        if data not in stored or not os.path.exists(self.checksums):
+            return {}
+        return checksum.read_checksums(self.checksums)
+
+    def destroy(self):
+        replicas = self.replica_roots
+        archive = self.disposable_archive
+        with self.pool.intent(
+                'destroy', root=self.root, replicas=replicas, archive=archive):
+            if archive is not None:
+                tier.remove_archive(archive)
+            for path in [self.root] + replicas:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+        DatasetCache.invalidate(self.root)
+
+    @trace.traced('send')
+    def to_stream(self, stream, since=None, resume=None, dedup=False):
+        # write a send stream of the snapshot (or of its differences from an
+        # earlier snapshot, or a bookmark of one); given the progress in a
+        # resume token, only what the receiver is missing is written. With
+        # dedup, files identical to one already sent are sent as references
+        # to it.
+        header = {'snapshot': self.full_name, 'from': None}
+        if isinstance(since, Bookmark):
+            header['from'] = since.snapshot_full_name
+        elif since is not None:
+            header['from'] = since.full_name
+        skip, offset = 0, 0
+        if resume is not None:
+            header['resume'] = resume
+            skip, offset = resume['members'], resume['offset']
+        if dedup:
+            header['dedup'] = True
+
+        with self.data_tree() as data:
+            duplicates = None
+            if dedup:
+                # recorded as stored, which is as sent here
+                duplicates = sendstream.Duplicates(data, dict(
+                    (os.path.join(data, relpath), digest)
+                    for relpath, digest in self.recorded_digests(
+                        data).items()))
+
+            if since is None:
+                with sendstream.writing(stream, header) as t:
+                    sendstream.add_members(t, sendstream.snapshot_members(
+                        t, self.root, self.name, data), skip, offset,
+                        duplicates)
+                return
+
+            with trace.phase('walk'):
+                if isinstance(since, Bookmark) or since.is_archived():
+                    differences = list(bookmark.compare_manifest(
+                        since.read_entries(), data,
+                        self.changes_since(since),
+                        self.recorded_digests(data)))
+                else:
+                    with since.data_tree() as since_data:
+                        differences = list(compare_trees(
+                            since_data, data, self.changes_since(since)))
+            # in a stable order, for resuming
+            differences.sort(key=lambda difference: difference[1])
+            if resume is None:
+                header['removed'] = [
+                    path for change, path in differences if change == '-']
+            with sendstream.writing(stream, header) as t:
+                sendstream.add_members(t, sendstream.incremental_members(
+                    t, self.root, self.name, data, differences),
+                    skip, offset, duplicates)
+
+
+class Bookmark(Dataset):
+    '''What a snapshot's data was, without the data itself, from which
+    incremental streams can be sent even once the snapshot is destroyed.
+    '''
+    def __init__(self, filesystem, mark):
+        self.filesystem = DatasetCache.handle(Filesystem, filesystem)
+        self.name = mark
+        self.full_name = '%s#%s' % (filesystem, mark)
+        self.root = os.path.join(self.filesystem.bookmarks, self.name)
+        self.pool = self.filesystem.pool
+
+    @property
+    def base_attrs(self):
+        data = super(Bookmark, self).base_attrs
+        data['name'] = self.full_name
+        data['creation'] = self.creation
+        return data
+
+    def exists(self):
+        return DatasetCache.lookup(os.path.exists, self.root)
+
+    @property
+    def snapshot_name(self):
+        # of the snapshot it was made from
+        return DatasetCache.lookup(
+            bookmark.read_header, self.root)['snapshot']
+
+    @property
+    def journal_mark(self):
+        # that of the snapshot it was made from
+        return DatasetCache.lookup(
+            bookmark.read_header, self.root).get('mark')
+
+    @property
+    def snapshot_full_name(self):
+        return '%s@%s' % (self.filesystem.name, self.snapshot_name)
+
+    def read_entries(self):
+        return bookmark.read_bookmark(self.root)[1]
+
+    def create(self, snapshot):
+        if not os.path.isdir(self.filesystem.bookmarks):
+            os.makedirs(self.filesystem.bookmarks)
+        with snapshot.data_tree() as data:
+            bookmark.write_bookmark(
+                self.root, snapshot.name, snapshot.creation_time,
+                data, snapshot.recorded_digests(data),
+                snapshot.journal_mark)
+        DatasetCache.invalidate(self.root)
+
+    def rename(self, new_bookmark):
+        os.rename(self.root, new_bookmark.root)
+        DatasetCache.invalidate(self.root)
+        DatasetCache.invalidate(new_bookmark.root)
+
+    def destroy(self):
+        os.remove(self.root)
+        DatasetCache.invalidate(self.root)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# zzzpool dedup replaces identical files in a pool's snapshots with hardlinks
+# to a single copy. Snapshot files are never modified in place (see
+# treecopy.update), so they can safely be shared; live mountpoints are never
+# read or touched. Since hardlinks share metadata too, files are only linked
+# if their mode, owner and times match as well as their contents.
+#
+# Candidates are grouped by size and metadata, then by a hash of their first
+# PARTIAL_SIZE bytes, then by a hash of their entire contents, largest files
+# first. Progress is saved in <pool_root>/dedup/checkpoint,
+#
+#   {"snapshots": [<snapshot data>, ...], "done": [<group>, ...]}
+#
+# so that an interrupted pass over the same snapshots resumes where it left
+# off. Files already linked are recognized by their inode, and not re-read.
+
+import os
+import json
+import stat
+import time
+import errno
+import fcntl
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from libzzzfs import compression, treecopy
+from libzzzfs.util import Throttle, ZzzFSException
+
+PARTIAL_SIZE = 1 << 16
+BUFFER_SIZE = 1 << 20
+# seconds between checkpoints
+CHECKPOINT_INTERVAL = 5
+
+
+class Deduplicator(object):
+    '''Hardlinks identical files across a pool's snapshots.'''
+    def __init__(self, state_dir, rate=None, threads=None):
+        self.state_dir = state_dir
+        self.checkpoint = os.path.join(state_dir, 'checkpoint')
+        self.throttle = Throttle(rate)
+        self.threads = threads
+        self.linked = 0
+        self.reclaimed = 0
+
+    def run(self, snapshots):
+        '''Deduplicate the files of the given snapshots, as (data, compression
+        index) pairs. Returns the number of files linked and bytes reclaimed.
+        '''
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        with open(os.path.join(self.state_dir, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                raise ZzzFSException('dedup already in progress')
+
+            roots = sorted(data for data, _ in snapshots)
+            done = self.read_checkpoint(roots)
+            groups = scan(snapshots)
+            keys = sorted(
+                (key for key, inodes in groups.items()
+                 if len(inodes) > 1 and _checkpoint_key(key) not in done),
+                key=lambda key: key[1], reverse=True)
+
+            threads = self.threads or treecopy.default_threads(self.state_dir)
+            pool = ThreadPool(threads)
+            saved = time.time()
+            try:
+                for key in keys:
+                    self.deduplicate(pool, groups[key])
+                    done.add(_checkpoint_key(key))
+                    if time.time() - saved > CHECKPOINT_INTERVAL:
+                        self.write_checkpoint(roots, done)
+                        saved = time.time()
+            except BaseException:
+                self.write_checkpoint(roots, done)
+                raise
+            finally:
+                pool.terminate()
+                pool.join()
+
+            # finished, so nothing to resume
+            if os.path.exists(self.checkpoint):
+                os.remove(self.checkpoint)
+        return self.linked, self.reclaimed
+
+    def read_checkpoint(self, roots):
+        try:
+            with open(self.checkpoint) as f:
+                checkpoint = json.load(f)
+        except (IOError, OSError, ValueError):
+            return set()
+        if checkpoint['snapshots'] != roots:
+            # snapshots have come or gone since, so start over
+            return set()
+        return set(checkpoint['done'])
+
+    def write_checkpoint(self, roots, done):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'snapshots': roots, 'done': sorted(done)}, f)
+        os.rename(tmp, self.checkpoint)
+
+    def hash(self, path, limit=None):
+        # None if the file can't be read, e.g. if destroyed meanwhile
+        h = hashlib.sha256()
+        remaining = limit
+        try:
+            with open(path, 'rb') as f:
+                while remaining is None or remaining > 0:
+                    buf = f.read(BUFFER_SIZE if remaining is None else min(
+                        BUFFER_SIZE, remaining))
+                    if not buf:
+                        break
+                    self.throttle.consume(len(buf))
+                    h.update(buf)
+                    if remaining is not None:
+                        remaining -= len(buf)
+        except (IOError, OSError):
+            return None
+        return h.hexdigest()
+
+    def deduplicate(self, pool, inodes):
+        # inodes: {(st_dev, st_ino): (stat result, [paths])} of one group
+        candidates = [list(inodes.values())]
+        size = candidates[0][0][0].st_size
+        for limit in (PARTIAL_SIZE, None):
+            matches = []
+            for files in candidates:
+                hashes = pool.map(
+                    lambda f: self.hash(f[1][0], limit), files)
+                by_hash = {}
+                for f, digest in zip(files, hashes):
+                    if digest is not None:
+                        by_hash.setdefault(digest, []).append(f)
+                matches.extend(
+                    same for same in by_hash.values() if len(same) > 1)
+            candidates = matches
+            if size <= PARTIAL_SIZE:  # the partial hash was of everything
+                break
+
+        for files in candidates:
+            self.link(files)
+
+    def link(self, files):
+        # keep whichever file already has the most links
+        files.sort(key=lambda f: len(f[1]), reverse=True)
+        (keep_st, keep_paths), others = files[0], files[1:]
+        keep = keep_paths[0]
+
+        for st, paths in others:
+            linked = 0
+            for path in paths:
+                # beside the file it replaces, on the same device
+                tmp = os.path.join(
+                    os.path.dirname(path), '.zzzfs-dedup-link.tmp')
+                try:
+                    # not if either file was replaced since it was read
+                    if not (os.path.samestat(os.lstat(path), st) and (
+                            os.path.samestat(os.lstat(keep), keep_st))):
+                        continue
+                    if os.path.lexists(tmp):
+                        os.remove(tmp)
+                    os.link(keep, tmp)
+                    os.rename(tmp, path)
+                except OSError as e:
+                    # EXDEV for files on different vdevs, which scan keeps
+                    # apart anyway
+                    if e.errno in (errno.ENOENT, errno.EMLINK, errno.EXDEV):
+                        continue
+                    raise
+                linked += 1
+            self.linked += linked
+            if linked == st.st_nlink:
+                # no link to the old copy remains
+                self.reclaimed += getattr(st, 'st_blocks', 0) * 512 or (
+                    st.st_size)
+
+
+def scan(snapshots):
+    '''Group the files of the given (data, compression index) pairs by
+    device, size and metadata, and within each group by inode, as {group:
+    {(st_dev, st_ino): (stat result, [paths])}}. Files on different devices
+    (e.g. vdevs) are never grouped together, since they can't be linked.
+    '''
+    groups = {}
+    for data, index in snapshots:
+        algorithms = {}
+        if index and os.path.exists(index):
+            # a compressed file may only be linked to one compressed the same
+            algorithms = dict(
+                (e['path'], e['algorithm'])
+                for e in compression.read_index(index))
+
+        for dirpath, _, filenames in os.walk(data):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:  # destroyed meanwhile
+                    continue
+                if not stat.S_ISREG(st.st_mode) or not st.st_size:
+                    continue
+                key = (st.st_dev, st.st_size,
+                       algorithms.get(os.path.relpath(path, data)),
+                       st.st_mode, st.st_uid, st.st_gid, st.st_mtime)
+                inodes = groups.setdefault(key, {})
+                inodes.setdefault((st.st_dev, st.st_ino), (st, []))[1].append(
+                    path)
+    return groups
+
+
+def _checkpoint_key(key):
+    return json.dumps(list(key))
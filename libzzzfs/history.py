@@ -0,0 +1,289 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Pool history structure:
+#
+#   <pool_root>/history/
+#     index             CSV of (segment, row, offset, date), for the first row
+#                       of every segment, every INDEX_INTERVAL rows thereafter,
+#                       and one past the last row of each closed segment
+#     00000000.csv      CSV of (date, command, user, host)
+#     00000001.csv
+#     [...]
+#
+# Older pools kept all history in a single <pool_root>/history file, which is
+# split into segments the next time history is written.
+
+import io
+import os
+import csv
+import pwd
+import fcntl
+import datetime
+import platform
+import collections
+
+from libzzzfs.util import ZzzFSException
+
+DATE_FORMAT = '%Y-%m-%d.%H:%M:%S'
+
+if str is bytes:  # Python 2: csv works with byte strings
+    _StringIO = io.BytesIO
+    _decoded = lambda lines: lines
+    _encoded = lambda text: text
+else:
+    _StringIO = io.StringIO
+    _decoded = lambda lines: (line.decode('utf-8') for line in lines)
+    _encoded = lambda text: text.encode('utf-8')
+
+
+_identity = {}
+
+
+def current_user():
+    if 'user' not in _identity:
+        _identity['user'] = pwd.getpwuid(os.getuid()).pw_name
+    return _identity['user']
+
+
+def current_host():
+    if 'host' not in _identity:
+        _identity['host'] = platform.node()
+    return _identity['host']
+
+
+def parse_date(user_string, end_of_day=False):
+    '''Convert a user-specified date into the format used in history records,
+    which sorts chronologically as a string. A date without a time is taken
+    as the start of that day, or with end_of_day (for inclusive upper
+    bounds), its last second.
+    '''
+    for date_format in (DATE_FORMAT, '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(
+                user_string, date_format).strftime(DATE_FORMAT)
+        except ValueError:
+            pass
+    try:
+        date = datetime.datetime.strptime(user_string, '%Y-%m-%d')
+    except ValueError:
+        raise ZzzFSException('%s: invalid date' % user_string)
+    if end_of_day:
+        date = date.replace(hour=23, minute=59, second=59)
+    return date.strftime(DATE_FORMAT)
+
+
+def csv_line(row):
+    buf = _StringIO()
+    csv.writer(buf).writerow(row)
+    return _encoded(buf.getvalue())
+
+
+class PoolHistory(object):
+    '''Pool command history, kept in size- and month-rotated segments with a
+    sparse index of row offsets, so that ranges and tails of the history can
+    be read without reading all of it.
+    '''
+    INDEX_INTERVAL = 128
+    SEGMENT_SIZE = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        self.index = os.path.join(path, 'index')
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, segment)
+
+    def read_index(self):
+        '''Return an ordered dict of segment -> [(row, offset, date), ...].'''
+        segments = collections.OrderedDict()
+        try:
+            with open(self.index, 'rb') as f:
+                for segment, row, offset, date in csv.reader(_decoded(f)):
+                    segments.setdefault(segment, []).append(
+                        (int(row), int(offset), date))
+        except IOError:
+            # no history recorded yet
+            pass
+        return segments
+
+    def read_rows(self, segment, offset=0):
+        '''Generate (offset, row) for each record in a segment from offset.'''
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                # quoted fields may span lines
+                while line.count(b'"') % 2:
+                    more = f.readline()
+                    if not more:
+                        break
+                    line += more
+                for row in csv.reader(_decoded([line])):
+                    yield (offset, row)
+                offset += len(line)
+
+    def count_rows(self, segments, segment):
+        # a closed segment ends with an entry one past its last row
+        entries = segments[segment]
+        if segment != next(reversed(segments)):
+            return entries[-1][0]
+        row, offset, _ = entries[-1]
+        return row + sum(1 for _ in self.read_rows(segment, offset))
+
+    def events(self, since=None, until=None, tail=None):
+        '''Generate (date, command, user, host) records, optionally limited to
+        those between since and until (inclusive, in DATE_FORMAT) and then to
+        the last tail records.
+        '''
+        if os.path.isfile(self.path):
+            rows = self.legacy_events(since, until)
+            return iter(collections.deque(rows, tail)) if tail else rows
+
+        segments = self.read_index()
+        if tail and not (since or until):
+            return self.tail_events(segments, tail)
+
+        rows = self.range_events(segments, since, until)
+        return iter(collections.deque(rows, tail)) if tail else rows
+
+    def legacy_events(self, since, until):
+        with open(self.path, 'r') as f:
+            for row in csv.reader(f):
+                if since and row[0] < since:
+                    continue
+                if until and row[0] > until:
+                    return
+                yield tuple(row)
+
+    def range_events(self, segments, since, until):
+        last = next(reversed(segments), None)
+        for segment, entries in segments.items():
+            if until and entries[0][2] > until:
+                return
+            if since and segment != last and entries[-1][2] < since:
+                # every record in this closed segment is too old
+                continue
+
+            # seek to the last indexed row known to be older than since
+            offset = 0
+            for _, entry_offset, date in entries:
+                if since and date < since:
+                    offset = entry_offset
+            for _, row in self.read_rows(segment, offset):
+                if since and row[0] < since:
+                    continue
+                if until and row[0] > until:
+                    return
+                yield tuple(row)
+
+    def tail_events(self, segments, tail):
+        # walk back from the newest segment until enough rows are found
+        skip = tail
+        start = []
+        for segment in reversed(segments):
+            count = self.count_rows(segments, segment)
+            start.insert(0, (segment, max(count - skip, 0)))
+            skip -= count
+            if skip <= 0:
+                break
+
+        for segment, first_row in start:
+            row_number, offset = 0, 0
+            for entry_row, entry_offset, _ in segments[segment]:
+                if entry_row <= first_row:
+                    row_number, offset = entry_row, entry_offset
+            for _, row in self.read_rows(segment, offset):
+                if row_number >= first_row:
+                    yield tuple(row)
+                row_number += 1
+
+    def append(self, rows):
+        '''Append (date, command, user, host) rows, rotating segments as
+        needed.
+        '''
+        if os.path.isfile(self.path):
+            self.split_legacy_file()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        with open(self.index, 'ab') as index:
+            # serialize concurrent writers
+            fcntl.flock(index, fcntl.LOCK_EX)
+            self.append_locked(index, rows)
+
+    def append_locked(self, index, rows):
+        segments = self.read_index()
+        segment = next(reversed(segments), None)
+        row_number = self.count_rows(segments, segment) if segment else 0
+        first_date = segments[segment][0][2] if segment else None
+        last_date = None
+        new_entries = []
+
+        f = open(self.segment_path(segment), 'ab') if segment else None
+        try:
+            for row in rows:
+                if f is None or f.tell() >= self.SEGMENT_SIZE or (
+                        row[0][:7] != first_date[:7]):
+                    if f is not None:
+                        # close this segment, one past its last row
+                        new_entries.append(
+                            (segment, row_number, f.tell(), last_date))
+                        f.close()
+                    segment = '%08d.csv' % (
+                        int(segment.split('.')[0]) + 1 if segment else 0)
+                    f = open(self.segment_path(segment), 'ab')
+                    row_number, first_date = 0, row[0]
+
+                if row_number % self.INDEX_INTERVAL == 0:
+                    new_entries.append((segment, row_number, f.tell(), row[0]))
+                f.write(csv_line(row))
+                row_number += 1
+                last_date = row[0]
+        finally:
+            if f is not None:
+                f.close()
+
+        # only index rows once they've been written
+        for entry in new_entries:
+            index.write(csv_line(entry))
+
+    def split_legacy_file(self):
+        # the index lives in the directory replacing the file, so a lock
+        # beside it serializes processes converting it at once
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(self.path):
+                return  # split by another process meanwhile
+            legacy = self.path + '.legacy'
+            os.rename(self.path, legacy)
+            os.makedirs(self.path)
+            with open(legacy, 'r') as f:
+                rows = list(csv.reader(f))
+            with open(self.index, 'ab') as index:
+                fcntl.flock(index, fcntl.LOCK_EX)
+                self.append_locked(index, rows)
+            os.remove(legacy)
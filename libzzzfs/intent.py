@@ -0,0 +1,195 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Each pool has an append-only <pool_root>/intent.log of JSON lines:
+#
+#   {"id": ..., "op": "create", "args": {...}}   before an operation starts
+#   {"id": ..., "done": true}                    after it finishes
+#
+# A begin record is synced to disk before its operation changes anything.
+# Done records are only synced when the enclosing command (or zzzfs program)
+# finishes, so that a batch of operations costs one sync each plus one more.
+#
+# Processes hold a shared lock on the log while an operation is in progress.
+# Whoever can take an exclusive lock knows that any operation lacking a done
+# record was interrupted by a crash, and may recover it and empty the log.
+
+import os
+import json
+import fcntl
+import itertools
+import threading
+import collections
+
+_logs = {}
+_ids = itertools.count()
+
+
+class IntentLog(object):
+    '''Write-ahead log of multi-step operations on one pool.'''
+    # empty the log when it grows past this size and nothing is in progress
+    TRUNCATE_SIZE = 1 << 16
+
+    @classmethod
+    def open(cls, path):
+        # one open file per log per process, since flock()s are per open file
+        if path not in _logs:
+            _logs[path] = cls(path)
+        return _logs[path]
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.unsynced = False
+        # operations (possibly nested) in progress in this process
+        self.depth = 0
+        self.recovering = False
+        # operations may run on several threads at once
+        self.lock = threading.RLock()
+
+    def ensure_open(self):
+        if self.f is not None:
+            # the pool may have been destroyed and re-created meanwhile
+            try:
+                current = os.path.samestat(
+                    os.fstat(self.f.fileno()), os.stat(self.path))
+            except OSError:
+                current = False
+            if not current:
+                self.f.close()
+                self.f = None
+
+        if self.f is None:
+            self.f = open(self.path, 'ab')
+
+    def write(self, record, sync):
+        self.ensure_open()
+        self.f.write(json.dumps(record, sort_keys=True).encode('utf-8') + b'\n')
+        self.f.flush()
+        if sync:
+            os.fsync(self.f.fileno())
+        else:
+            self.unsynced = True
+
+    def begin(self, op, args):
+        '''Durably record an operation about to start, returning its id.
+        Operations performed while recovering aren't recorded.
+        '''
+        if self.recovering:
+            return None
+
+        with self.lock:
+            self.ensure_open()
+            if self.depth == 0:
+                fcntl.flock(self.f, fcntl.LOCK_SH)
+            self.depth += 1
+            intent_id = '%d.%d' % (os.getpid(), next(_ids))
+            self.write({'id': intent_id, 'op': op, 'args': args}, sync=True)
+        return intent_id
+
+    def end(self, intent_id, sync):
+        '''Record an operation as finished.'''
+        if intent_id is None:
+            return
+
+        with self.lock:
+            self.write({'id': intent_id, 'done': True}, sync=sync)
+            self.depth -= 1
+            if self.depth == 0:
+                fcntl.flock(self.f, fcntl.LOCK_UN)
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.f.fileno())
+            self.unsynced = False
+            if os.fstat(self.f.fileno()).st_size > self.TRUNCATE_SIZE:
+                self.recover()
+
+    @classmethod
+    def sync_all(cls):
+        '''Sync deferred done records of every log this process wrote.'''
+        for path, log in list(_logs.items()):
+            if not os.path.exists(path):  # pool destroyed meanwhile
+                if log.f is not None:
+                    log.f.close()
+                del _logs[path]
+                continue
+            log.sync()
+
+    def abandon(self, intent_id):
+        '''Leave a failed operation unfinished, for recovery to clean up.'''
+        if intent_id is None:
+            return
+
+        with self.lock:
+            self.depth -= 1
+            if self.depth == 0:
+                fcntl.flock(self.f, fcntl.LOCK_UN)
+
+    def recover(self, handler=None):
+        '''If no operation is in progress, call handler(op, args) for each
+        unfinished operation, newest first, then empty the log. Without a
+        handler, the log is only emptied if no operation is unfinished; if the
+        handler returns False for any operation, the log is left as is.
+        Returns False if operations are in progress.
+        '''
+        if self.depth > 0 or self.recovering:
+            return False
+
+        self.ensure_open()
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False
+
+        try:
+            unfinished = collections.OrderedDict()
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # torn write of a record whose operation never started
+                        continue
+                    if record.get('done'):
+                        unfinished.pop(record['id'], None)
+                    else:
+                        unfinished[record['id']] = record
+
+            if unfinished and handler is None:
+                return True
+            self.recovering = True
+            recovered = [
+                handler(record['op'], record['args'])
+                for record in reversed(list(unfinished.values()))]
+            if False in recovered:
+                return True
+
+            self.f.truncate(0)
+            os.fsync(self.f.fileno())
+            self.unsynced = False
+        finally:
+            self.recovering = False
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        return True
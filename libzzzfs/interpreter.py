@@ -23,7 +23,21 @@
 
 import argparse
 
-from libzzzfs.util import PropertyAssignment, PropertyList
+from libzzzfs.util import parse_size, PropertyAssignment, PropertyList
+
+
+def add_output_arguments(parser):
+    '''Add the -p, -j and --ndjson options accepted by listing commands.'''
+    parser.add_argument(
+        '-p', action='store_true', dest='parsable',
+        help='print exact numeric values')
+    output_format = parser.add_mutually_exclusive_group()
+    output_format.add_argument(
+        '-j', '--json', action='store_const', const='json',
+        dest='output_format', default='table', help='print a JSON array')
+    output_format.add_argument(
+        '--ndjson', action='store_const', const='ndjson',
+        dest='output_format', help='print one JSON object per line')
 
 
 class CommandInterpreter(object):
@@ -45,11 +59,34 @@ class ZzzfsCommandInterpreter(CommandInterpreter):
             dest='command', title='subcommands')
 
         # per-command arguments
+        autosnap = subparsers.add_parser(
+            'autosnap', help='take and prune automatic snapshots')
+        autosnap.add_argument('action', choices=['run'])
+        autosnap.add_argument(
+            'filesystems', metavar='filesystem', nargs='*', default=[],
+            help='only this filesystem and its descendants')
+        autosnap.add_argument(
+            '-n', action='store_true', dest='dry_run',
+            help='list the snapshots to take and destroy, without doing so')
+
+        bookmark = subparsers.add_parser(
+            'bookmark', help='keep a snapshot as an incremental send source')
+        bookmark.add_argument('snapshot')
+        bookmark.add_argument('bookmark', metavar='filesystem#bookmark')
+
         clone = subparsers.add_parser(
             'clone', help='turn a snapshot into a filesystem with a new name')
         clone.add_argument('snapshot')
         clone.add_argument('filesystem')
 
+        copy = subparsers.add_parser(
+            'copy', help='create a filesystem from a snapshot in any pool')
+        copy.add_argument('snapshot')
+        copy.add_argument('filesystem')
+        copy.add_argument(
+            '-R', action='store_true', dest='replicate',
+            help='also copy descendants, properties and earlier snapshots')
+
         create = subparsers.add_parser('create', help='create a filesystem')
         create.add_argument('filesystem')
         create.add_argument(
@@ -60,8 +97,10 @@ class ZzzfsCommandInterpreter(CommandInterpreter):
             default=[], type=PropertyAssignment,
             help='set the specified property')
 
-        destroy = subparsers.add_parser('destroy', help='destroy a filesystem')
-        destroy.add_argument('filesystem')
+        destroy = subparsers.add_parser(
+            'destroy', help='destroy a filesystem, snapshot or bookmark')
+        destroy.add_argument(
+            'filesystem', metavar='filesystem|snapshot|bookmark')
         destroy.add_argument(
             '-r', action='store_true', dest='recursive',
             help='destroy child filesystems')
@@ -95,11 +134,13 @@ class ZzzfsCommandInterpreter(CommandInterpreter):
         get.add_argument(
             '-t', metavar='type[,type...]', dest='types', type=PropertyList,
             default=PropertyList('filesystem'),
-            help='comma-separated list of types (all, filesystem, snapshot)')
+            help='comma-separated list of types '
+                 '(all, filesystem, snapshot, bookmark)')
         get.add_argument(
             '-s', metavar='source[,source...]', type=PropertyList,
             dest='sources', default=PropertyList('local,inherited'),
             help='comma-separated list of sources (local, inherited)')
+        add_output_arguments(get)
 
         inherit = subparsers.add_parser(
             'inherit', help='unset a property from datasets')
@@ -125,16 +166,31 @@ class ZzzfsCommandInterpreter(CommandInterpreter):
         list_.add_argument(
             '-t', metavar='type[,type...]', dest='types', type=PropertyList,
             default=PropertyList('filesystem'),
-            help='comma-separated list of types (all, filesystem, snapshot)')
+            help='comma-separated list of types '
+                 '(all, filesystem, snapshot, bookmark)')
         list_.add_argument(
             '-s', metavar='property', dest='sort_asc', action='append',
             default=[], help='sort by property (ascending)')
         list_.add_argument(
             '-S', metavar='property', dest='sort_desc', action='append',
             default=[], help='sort by property (descending)')
+        add_output_arguments(list_)
         list_.add_argument(
             'identifiers', metavar='filesystem|snapshot', nargs='*')
 
+        program = subparsers.add_parser(
+            'program', help='run a file of zzzfs commands in one process')
+        program.add_argument(
+            'program_file', metavar='file', type=argparse.FileType('r'),
+            help='file with one zzzfs command per line ("-" for stdin)')
+        on_error = program.add_mutually_exclusive_group()
+        on_error.add_argument(
+            '-e', action='store_true', dest='stop_on_error',
+            help='stop at the first failed command')
+        on_error.add_argument(
+            '--rollback', action='store_true', dest='rollback',
+            help='stop at the first failed command and undo the program')
+
         promote = subparsers.add_parser(
             'promote',
             help='turn a cloned snapshot into a standalone filesystem')
@@ -143,6 +199,12 @@ class ZzzfsCommandInterpreter(CommandInterpreter):
         receive = subparsers.add_parser(
             'receive', help='create a new filesystem from "zzzfs send" output')
         receive.add_argument('filesystem')
+        receive.add_argument(
+            '-s', action='store_true', dest='resumable',
+            help='keep what an interrupted receive got, to resume it')
+        receive.add_argument(
+            '-A', action='store_true', dest='abort',
+            help='discard an interrupted receive')
 
         rename = subparsers.add_parser(
             'rename', help='move or rename a dataset')
@@ -155,7 +217,19 @@ class ZzzfsCommandInterpreter(CommandInterpreter):
 
         send = subparsers.add_parser(
             'send', help='serialize snapshot into a data stream')
-        send.add_argument('snapshot')
+        send.add_argument('snapshot', nargs='?')
+        send.add_argument(
+            '-i', metavar='snapshot|bookmark', dest='incremental_from',
+            help='send only the differences from an earlier snapshot')
+        send.add_argument(
+            '-t', metavar='token', dest='resume_token',
+            help='send the rest of an interrupted receive -s')
+        send.add_argument(
+            '-R', action='store_true', dest='replicate',
+            help='also send descendants, properties and earlier snapshots')
+        send.add_argument(
+            '-D', action='store_true', dest='dedup',
+            help='send files identical to one already sent as references')
 
         set_ = subparsers.add_parser(
             'set', help='set a property value for a dataset')
@@ -172,6 +246,10 @@ class ZzzfsCommandInterpreter(CommandInterpreter):
             default=[], type=PropertyAssignment,
             help='set the specified property')
 
+        watch = subparsers.add_parser(
+            'watch', help='journal changes to a filesystem until interrupted')
+        watch.add_argument('filesystem')
+
 
 class ZzzpoolCommandInterpreter(CommandInterpreter):
     def interpret(self):
@@ -181,11 +259,29 @@ class ZzzpoolCommandInterpreter(CommandInterpreter):
         # per-command arguments
         create = subparsers.add_parser('create', help='create a pool')
         create.add_argument('pool_name', metavar='pool', help='pool name')
-        create.add_argument('disk', help='directory in which to create pool')
+        create.add_argument(
+            'disks', metavar='disk', nargs='+',
+            help='directory in which to create pool (one per vdev, or '
+                 '"mirror" and two or more mirrored directories)')
+        create.add_argument(
+            '-o', metavar='property=value', action='append', dest='properties',
+            default=[], type=PropertyAssignment,
+            help='set the specified property (e.g. placement=freespace)')
+
+        dedup = subparsers.add_parser(
+            'dedup', help='hardlink identical files in snapshots')
+        dedup.add_argument('pool_name', metavar='pool', help='pool name')
+        dedup.add_argument(
+            '-r', metavar='rate', type=parse_size, dest='rate',
+            help='read at most this many bytes per second (e.g. 50M)')
 
         destroy = subparsers.add_parser('destroy', help='destroy a pool')
         destroy.add_argument('pool_name', metavar='pool', help='pool name')
 
+        gc = subparsers.add_parser(
+            'gc', help='free deduplicated data no longer used by snapshots')
+        gc.add_argument('pool_name', metavar='pool', help='pool name')
+
         history = subparsers.add_parser(
             'history', help='display pool command history')
         history.add_argument(
@@ -194,6 +290,15 @@ class ZzzpoolCommandInterpreter(CommandInterpreter):
         history.add_argument(
             '-l', action='store_true', dest='long_format',
             help='show log records in long format')
+        history.add_argument(
+            '--since', metavar='date',
+            help='show records from this date (YYYY-MM-DD[.HH:MM:SS]) on')
+        history.add_argument(
+            '--until', metavar='date',
+            help='show records up to this date (YYYY-MM-DD[.HH:MM:SS])')
+        history.add_argument(
+            '--tail', metavar='N', type=int,
+            help='show only the last N records of each pool')
 
         list_ = subparsers.add_parser('list', help='list pools and properties')
         list_.add_argument(
@@ -205,3 +310,27 @@ class ZzzpoolCommandInterpreter(CommandInterpreter):
             '-o', metavar='property[,...]', type=PropertyList, dest='headers',
             default=PropertyList('name,size,alloc,free,cap,health,altroot'),
             help='comma-separated list of properties')
+        list_.add_argument(
+            '-v', action='store_true', dest='verbose',
+            help='also list the usage of each vdev')
+        add_output_arguments(list_)
+
+        scrub = subparsers.add_parser(
+            'scrub', help='verify snapshot data against its checksums')
+        scrub.add_argument('pool_name', metavar='pool', help='pool name')
+        scrub.add_argument(
+            '-r', metavar='rate', type=parse_size, dest='rate',
+            help='read at most this many bytes per second (e.g. 50M)')
+
+        status = subparsers.add_parser(
+            'status', help='display pool health and scrub progress')
+        status.add_argument(
+            'pool_names', metavar='pool', nargs='*', default=[],
+            help='pool name')
+        status.add_argument(
+            '-v', action='store_true', dest='verbose',
+            help='list files with errors')
+
+        tier = subparsers.add_parser(
+            'tier', help='archive old snapshots to a cold tier')
+        tier.add_argument('pool_name', metavar='pool', help='pool name')
@@ -0,0 +1,459 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# While "zzzfs watch <filesystem>" runs, it records every path changed under
+# the filesystem's mountpoint, using inotify, in a change journal:
+#
+#   <filesystem_root>/journal/
+#     pid               process id of the running watcher
+#     changes           one line per event, since the watcher started:
+#                         !start, !overflow or !stop
+#                         @<mark>
+#                         "<path changed, relative to the mountpoint>"
+#     mark.<name>       (briefly) a request for the watcher to write @<name>
+#
+# A mark is requested by creating a mark file, which the watcher sees in
+# order with the events of the mountpoint. Once the watcher has written the
+# mark and removed the file, every change made before the request has been
+# journaled before the mark, and every later change after it. Snapshots are
+# marked as they are created, each with a name of its own kept in the
+# snapshot (see read_mark) rather than its own name, which may be renamed,
+# or reused once it is destroyed. The paths changed between two snapshots
+# (or since one) are the lines between their marks. If a !-line
+# intervenes, some changes weren't recorded, and callers must look at
+# everything instead.
+
+import os
+import sys
+import json
+import time
+import errno
+import ctypes
+import ctypes.util
+import signal
+import struct
+import filecmp
+import itertools
+
+from libzzzfs.util import ZzzFSException
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+_sync_ids = itertools.count()
+
+if hasattr(os, 'fsencode'):
+    _encode, _decode = os.fsencode, os.fsdecode
+else:  # Python 2 paths are already bytes
+    _encode = _decode = lambda path: path
+
+if str is bytes:  # Python 2: json gives back unicode paths
+    _from_json = lambda line: json.loads(line).encode('utf-8')
+else:
+    _from_json = json.loads
+
+
+class Inotify(object):
+    '''Minimal ctypes binding of inotify(7).'''
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(
+                ctypes.util.find_library('c') or None, use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise ZzzFSException('inotify is not available on this system')
+        self.fd = self.check(init(IN_CLOEXEC))
+
+    def check(self, result):
+        if result < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+
+    def add_watch(self, path, mask):
+        return self.check(
+            self.libc.inotify_add_watch(self.fd, _encode(path), mask))
+
+    def rm_watch(self, wd):
+        # the watch may already be gone, with whatever it watched
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        '''Block until events arrive, then generate (wd, mask, name).'''
+        buf = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield (wd, mask, _decode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_mark(path):
+    '''Return the mark recorded in the file at path, or None if there is none
+    (e.g. for a snapshot made while no watcher ran).
+    '''
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+class ChangeJournal(object):
+    '''Reads, and requests marks in, a filesystem's change journal.'''
+    # how long to wait for the watcher to write a mark
+    MARK_TIMEOUT = 5.0
+
+    def __init__(self, path):
+        self.path = path
+        self.changes = os.path.join(path, 'changes')
+        self.pid_file = os.path.join(path, 'pid')
+
+    def running(self):
+        try:
+            with open(self.pid_file) as f:
+                os.kill(int(f.read()), 0)
+            return True
+        except (EnvironmentError, ValueError):
+            return False
+
+    def mark(self, name):
+        '''Have the watcher mark the journal, returning whether it did.'''
+        if not self.running():
+            return False
+
+        request = os.path.join(self.path, 'mark.' + name)
+        open(request, 'w').close()
+        deadline = time.time() + self.MARK_TIMEOUT
+        delay = 0.001
+        while os.path.exists(request):
+            if time.time() > deadline:
+                os.remove(request)
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return True
+
+    def sync(self):
+        '''Mark the journal with a name no snapshot can have, returning it, or
+        None if the journal isn't being kept.
+        '''
+        name = '.sync-%d-%d' % (os.getpid(), next(_sync_ids))
+        return name if self.mark(name) else None
+
+    def read(self):
+        # lines since the last !-line
+        lines = []
+        try:
+            with open(self.changes, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):  # being written
+                        break
+                    line = line[:-1].decode('utf-8')
+                    if line.startswith('!'):
+                        lines = []
+                    else:
+                        lines.append(line)
+        except IOError:
+            pass
+        return lines
+
+    def find(self, until, candidates):
+        '''Return (candidate, paths) for whichever of the candidate marks came
+        last before the mark until, and the set of paths changed between
+        them; or (None, None) if the journal doesn't cover any such span.
+        '''
+        if until is None:
+            return (None, None)
+        lines = self.read()
+        try:
+            end = len(lines) - 1 - lines[::-1].index('@' + until)
+        except ValueError:
+            return (None, None)
+
+        paths = set()
+        for line in reversed(lines[:end]):
+            if line.startswith('@'):
+                if line[1:] in candidates:
+                    return (line[1:], paths)
+            else:
+                paths.add(_from_json(line))
+        return (None, None)
+
+    def changes_between(self, since, until):
+        '''The set of paths changed between two marks, or None if unknown.'''
+        return self.find(until, [since])[1]
+
+
+class Watcher(object):
+    '''Records changes under a mountpoint in a change journal until stopped.
+    '''
+    # the journal starts over (invalidating its marks) past this size
+    MAX_SIZE = 1 << 23
+
+    def __init__(self, journal, mountpoint):
+        self.journal = journal
+        self.mountpoint = mountpoint
+        self.inotify = None
+        self.paths = {}  # watch descriptor -> path relative to mountpoint
+        self.root_wd = None
+        self.journal_wd = None
+        # paths already journaled since the last mark
+        self.recorded = set()
+        self.f = None
+
+    def write(self, line):
+        self.f.write(line.encode('utf-8') + b'\n')
+
+    def record(self, path):
+        if path not in self.recorded:
+            self.recorded.add(path)
+            self.write(json.dumps(path))
+
+    def restart(self, reason):
+        # changes may have gone unrecorded; marks so far are worthless
+        self.write('!' + reason)
+        self.recorded.clear()
+
+    def watch_tree(self, path, record=False):
+        '''Watch a directory and everything beneath it, optionally recording
+        everything found (which may have been created unwatched).
+        '''
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            try:
+                wd = self.inotify.add_watch(
+                    os.path.join(self.mountpoint, path), WATCH_MASK)
+                names = os.listdir(os.path.join(self.mountpoint, path))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise ZzzFSException(
+                        'too many directories to watch; raise '
+                        'fs.inotify.max_user_watches')
+                # removed meanwhile, or not a directory
+                continue
+
+            self.paths[wd] = path
+            if not path:
+                self.root_wd = wd
+            for name in names:
+                child = os.path.join(path, name)
+                if record:
+                    self.record(child)
+                child_path = os.path.join(self.mountpoint, child)
+                if os.path.isdir(child_path) and not os.path.islink(child_path):
+                    pending.append(child)
+
+    def rewatch(self):
+        '''Start over after the mountpoint itself was removed or replaced,
+        e.g. by a rollback.
+        '''
+        for wd in self.paths:
+            self.inotify.rm_watch(wd)
+        self.paths.clear()
+        self.root_wd = None
+        self.restart('overflow')
+        self.f.flush()
+
+        while not os.path.isdir(self.mountpoint):
+            if not os.path.isdir(self.journal.path):
+                return False
+            time.sleep(0.1)
+        self.watch_tree('')
+        return True
+
+    def handle(self, wd, mask, name):
+        '''Journal one event, returning False once the journal is gone.'''
+        if mask & IN_Q_OVERFLOW:
+            self.restart('overflow')
+
+        elif wd == self.journal_wd:
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # filesystem destroyed or renamed
+                return False
+            if mask & IN_CREATE and name.startswith('mark.'):
+                self.write('@' + name[len('mark.'):])
+                self.recorded.clear()
+                self.f.flush()
+                try:
+                    os.remove(os.path.join(self.journal.path, name))
+                except OSError:  # timed out, and removed by the requester
+                    pass
+
+        elif wd == self.root_wd and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            return self.rewatch()
+
+        elif wd in self.paths:
+            if mask & IN_IGNORED:
+                del self.paths[wd]
+            elif name:
+                path = os.path.join(self.paths[wd], name)
+                self.record(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path, record=True)
+            elif self.paths[wd] and not mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # the directory's own metadata
+                self.record(self.paths[wd])
+
+        return True
+
+    def run(self):
+        if not os.path.exists(self.journal.path):
+            os.makedirs(self.journal.path)
+        if self.journal.running():
+            raise ZzzFSException('%s: already being watched' % self.mountpoint)
+
+        def stop(signum, frame):
+            sys.exit(0)
+        try:
+            signal.signal(signal.SIGTERM, stop)
+        except ValueError:  # not the main thread
+            pass
+
+        self.inotify = Inotify()
+        self.f = open(self.journal.changes, 'wb')
+        try:
+            self.journal_wd = self.inotify.add_watch(
+                self.journal.path,
+                IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+            self.watch_tree('')
+            self.write('!start')
+            self.f.flush()
+            with open(self.journal.pid_file, 'w') as f:
+                f.write('%d' % os.getpid())
+
+            while True:
+                for wd, mask, name in self.inotify.read_events():
+                    if not self.handle(wd, mask, name):
+                        return
+                if self.f.tell() > self.MAX_SIZE:
+                    self.f.seek(0)
+                    self.f.truncate()
+                    self.restart('start')
+                self.f.flush()
+
+        finally:
+            if os.path.isdir(self.journal.path):
+                self.write('!stop')
+                try:
+                    os.remove(self.journal.pid_file)
+                except OSError:
+                    pass
+            self.f.close()
+            self.inotify.close()
+
+
+def compare_trees(left, right, paths=None):
+    '''Generate (change, path) for each difference between two directory
+    trees: 'M' for a modified file, '-' for one only in left, and '+' for
+    one only in right (in which case nothing beneath it is listed). Only the
+    given relative paths are compared, if known; otherwise everything is.
+    '''
+    if paths is None:
+        for difference in _walk_differences(left, right, ''):
+            yield difference
+        return
+
+    one_sided = set()  # directories only on one side
+    for path in sorted(paths):
+        if not path or _ancestors(path) & one_sided:
+            continue
+        left_path = os.path.join(left, path)
+        right_path = os.path.join(right, path)
+        in_left = os.path.exists(left_path)
+        in_right = os.path.exists(right_path)
+
+        if in_left and in_right:
+            if os.path.isdir(left_path) and os.path.isdir(right_path):
+                continue
+            if os.path.isdir(left_path) or os.path.isdir(right_path) or (
+                    not filecmp.cmp(left_path, right_path)):
+                yield ('M', path)
+        elif in_left or in_right:
+            yield ('-' if in_left else '+', path)
+            if os.path.isdir(left_path if in_left else right_path):
+                one_sided.add(path)
+
+
+def _ancestors(path):
+    ancestors = set()
+    while os.sep in path:
+        path = os.path.dirname(path)
+        ancestors.add(path)
+    return ancestors
+
+
+def _walk_differences(left, right, path):
+    # like filecmp.dircmp: per directory, modified files, then files only on
+    # the left, then only on the right, then common subdirectories
+    left_dir = os.path.join(left, path)
+    right_dir = os.path.join(right, path)
+    left_names = set(os.listdir(left_dir))
+    right_names = set(os.listdir(right_dir))
+
+    subdirs = []
+    modified = []
+    for name in sorted(left_names & right_names):
+        left_path = os.path.join(left_dir, name)
+        right_path = os.path.join(right_dir, name)
+        left_isdir = os.path.isdir(left_path)
+        if left_isdir and os.path.isdir(right_path):
+            subdirs.append(name)
+        elif left_isdir or os.path.isdir(right_path) or (
+                not filecmp.cmp(left_path, right_path)):
+            modified.append(name)
+
+    for name in modified:
+        yield ('M', os.path.join(path, name))
+    for name in sorted(left_names - right_names):
+        yield ('-', os.path.join(path, name))
+    for name in sorted(right_names - left_names):
+        yield ('+', os.path.join(path, name))
+    for name in subdirs:
+        for difference in _walk_differences(
+                left, right, os.path.join(path, name)):
+            yield difference
@@ -0,0 +1,317 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# zzzpool scrub reads every file of every snapshot in a pool (and every chunk
+# used by deduplicated snapshots) and checks it against its checksum (see
+# checksum.py). The work is split into units of up to UNIT_SIZE bytes, done
+# in order by a pool of worker processes. Progress is kept in
+# <pool_root>/scrub/status, for zzzpool status, and so that an interrupted
+# scrub of the same snapshots resumes at the first unit not done:
+#
+#   {"state": "scanning"|"finished", "start": <time>, "end": <time>,
+#    "snapshots": [<name>, ...], "units": <count>, "done": <count>,
+#    "total": <bytes>, "scanned": <bytes>, "errors": [<file>, ...],
+#    "repaired": <bytes>, "run_start": <time>,
+#    "run_scanned": <bytes scanned before this run>}
+#
+# Snapshots on mirrored vdevs are checked on every side, and a bad file on
+# one side is repaired from a good copy on another (see vdev.repair).
+
+import os
+import json
+import time
+import fcntl
+import multiprocessing
+
+from libzzzfs import chunkstore, treecopy, vdev
+from libzzzfs.checksum import file_checksum, read_checksums
+from libzzzfs.util import humanized, Throttle, ZzzFSException
+
+UNIT_SIZE = 1 << 26
+# seconds between updates of the status file
+STATUS_INTERVAL = 1
+
+# per worker process
+_throttle = None
+
+
+def _init_worker(rate):
+    global _throttle
+    _throttle = Throttle(rate)
+
+
+def _matches(path, expected):
+    try:
+        return file_checksum(path, _throttle)[0] == expected
+    except (IOError, OSError):
+        return False
+
+
+def _verify(unit):
+    # check a unit of (path, expected checksum, name, copies) items, where
+    # copies are other sides' copies of the file to repair it from; returns
+    # the bytes read, the (name, checksum) of each item that didn't match and
+    # couldn't be repaired, and the bytes repaired
+    scanned = 0
+    bad = []
+    repaired = 0
+    for path, expected, name, copies in unit:
+        try:
+            actual, size = file_checksum(path, _throttle)
+        except (IOError, OSError):
+            actual, size = None, 0
+        scanned += size
+        if actual == expected:
+            continue
+        written = vdev.repair(
+            path, copies, lambda copy: _matches(copy, expected))
+        if written is None:
+            bad.append((name, expected))
+        else:
+            repaired += written
+    return scanned, bad, repaired
+
+
+def plan(snapshots, store, manifests):
+    '''Split the work of a scrub into units, returning them and their total
+    size. snapshots are (name, data, checksums, replicas), where replicas
+    are the data of its copies on a mirror's other sides, and manifests are
+    (name, manifest) of those deduplicated.
+    '''
+    units = []
+    unit = []
+    unit_size = [0]
+    total = [0]
+
+    def add(item, size):
+        unit.append(item)
+        unit_size[0] += size
+        total[0] += size
+        if unit_size[0] >= UNIT_SIZE:
+            units.append(list(unit))
+            del unit[:]
+            unit_size[0] = 0
+
+    for name, data, checksums, replicas in sorted(snapshots):
+        try:
+            recorded = read_checksums(checksums)
+        except IOError:  # taken before checksums were recorded
+            continue
+        for relpath, expected in sorted(recorded.items()):
+            paths = [os.path.join(d, relpath) for d in [data] + replicas]
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = 0
+                add((path, expected, '%s:/%s' % (name, relpath),
+                     [p for p in paths if p != path]), size)
+
+    # each chunk once, however many snapshots use it
+    if manifests:
+        referenced, _ = store.usage(m for _, m in manifests)
+        for key in sorted(referenced):
+            path = store.chunk_path(key)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            add((path, key, None, []), size)
+
+    if unit:
+        units.append(unit)
+    return units, total[0]
+
+
+class Scrub(object):
+    '''Checks a pool's snapshots against their checksums.'''
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.status_file = os.path.join(state_dir, 'status')
+        self.lock_file = os.path.join(state_dir, 'lock')
+
+    def read_status(self):
+        try:
+            with open(self.status_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_status(self, status):
+        tmp = self.status_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(status, f)
+        os.rename(tmp, self.status_file)
+
+    def running(self):
+        # a running scrub holds the lock
+        try:
+            with open(self.lock_file) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    return True
+                fcntl.flock(f, fcntl.LOCK_UN)
+        except IOError:
+            pass
+        return False
+
+    def run(self, snapshots, store, manifests, rate=None, processes=None):
+        '''Scrub the given snapshots (see plan), resuming an interrupted
+        scrub of the same snapshots. At most rate bytes are read per second.
+        Returns the final status.
+        '''
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        with open(self.lock_file, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                raise ZzzFSException('scrub already in progress')
+
+            units, total = plan(snapshots, store, manifests)
+            names = sorted(name for name, _, _, _ in snapshots) + sorted(
+                name for name, _ in manifests)
+            status = self.read_status()
+            if not (status and status['state'] == 'scanning' and (
+                    status['snapshots'] == names) and (
+                    status['units'] == len(units))):
+                status = {
+                    'state': 'scanning', 'start': time.time(), 'end': None,
+                    'snapshots': names, 'units': len(units), 'done': 0,
+                    'total': total, 'scanned': 0, 'errors': [],
+                    'repaired': 0}
+            status['run_start'] = time.time()
+            status['run_scanned'] = status['scanned']
+            self.write_status(status)
+
+            if processes is None:
+                processes = treecopy.default_threads(self.state_dir)
+                try:
+                    processes = min(processes, multiprocessing.cpu_count())
+                except NotImplementedError:
+                    processes = 1
+            processes = max(1, min(processes, len(units) - status['done']))
+            worker_rate = float(rate) / processes if rate else None
+
+            bad_chunks = []
+            if processes > 1:
+                workers = multiprocessing.Pool(
+                    processes, _init_worker, (worker_rate,))
+                results = workers.imap(_verify, units[status['done']:])
+            else:
+                workers = None
+                _init_worker(worker_rate)
+                results = (_verify(u) for u in units[status['done']:])
+
+            saved = time.time()
+            try:
+                for scanned, bad, repaired in results:
+                    status['done'] += 1
+                    status['scanned'] += scanned
+                    status['repaired'] = status.get('repaired', 0) + repaired
+                    for name, expected in bad:
+                        if name is None:
+                            bad_chunks.append(expected)
+                        else:
+                            status['errors'].append(name)
+                    if bad_chunks:
+                        status['errors'].extend(
+                            files_using(bad_chunks, manifests))
+                        del bad_chunks[:]
+                    if time.time() - saved > STATUS_INTERVAL:
+                        self.write_status(status)
+                        saved = time.time()
+            finally:
+                if workers is not None:
+                    workers.terminate()
+                    workers.join()
+                # if interrupted, the next scrub resumes from here
+                self.write_status(status)
+
+            status['state'] = 'finished'
+            status['end'] = time.time()
+            self.write_status(status)
+        return status
+
+
+def files_using(keys, manifests):
+    '''Name every file of the deduplicated snapshots (see plan) which uses
+    any of the given chunks.
+    '''
+    keys = set(keys)
+    for name, manifest in sorted(manifests):
+        for entry in chunkstore.read_manifest(manifest):
+            if keys.intersection(entry.get('chunks', [])):
+                yield '%s:/%s' % (name, entry['path'])
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return '%dh%02dm%02ds' % (
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def format_status(pool_name, status, running, verbose=False):
+    '''Generate lines describing a pool's health and last scrub, in the
+    style of zpool status.
+    '''
+    yield '  pool: %s' % pool_name
+    yield ' state: ONLINE'
+
+    if status is None:
+        yield '  scan: none requested'
+    elif status['state'] == 'scanning':
+        yield '  scan: scrub %s since %s' % (
+            'in progress' if running else 'interrupted',
+            time.ctime(status['start']))
+        line = '        %s scanned out of %s' % (
+            humanized(status['scanned']), humanized(status['total']))
+        elapsed = time.time() - status['run_start']
+        scanned = status['scanned'] - status['run_scanned']
+        if running and elapsed > 0 and scanned > 0:
+            rate = scanned / elapsed
+            line += ' at %s/s, %s to go' % (
+                humanized(int(rate)), _duration(
+                    (status['total'] - status['scanned']) / rate))
+        yield line
+        yield '        %d errors' % len(status['errors'])
+    else:
+        yield '  scan: scrub repaired %s in %s with %d errors on %s' % (
+            humanized(status.get('repaired', 0)),
+            _duration(status['end'] - status['start']),
+            len(status['errors']), time.ctime(status['end']))
+
+    yield ''
+    errors = status['errors'] if status else []
+    if not errors:
+        yield 'errors: No known data errors'
+    elif not verbose:
+        yield "errors: %d data errors, use '-v' for a list" % len(errors)
+    else:
+        yield ('errors: Permanent errors have been detected in the following '
+               'files:')
+        yield ''
+        for name in sorted(set(errors)):
+            yield '        %s' % name
@@ -0,0 +1,753 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# zzzfs send streams carry a POSIX (pax) tar archive of a snapshot's root
+# directory in frames, each compressed and checksummed on its own so that a
+# receiver knows exactly how much of an interrupted stream arrived intact:
+#
+#   ZZZFS-STREAM 1\n
+#   {"snapshot": <fs@snap>, "from": <fs@snap, for zzzfs send -i>,
+#    "removed": [<path removed from the data since then>, ...],
+#    "resume": {"members": <count>, "offset": <bytes>}, "dedup": <bool>}\n
+#   <length> <SHA-256 of the frame's data>\n<length bytes of zlib data>
+#   [...]
+#   0\n
+#
+# An incremental stream (zzzfs send -i) holds only what changed in the
+# snapshot's data since the earlier snapshot, along with the directories
+# leading to the changes. A resumed stream (zzzfs send -t) leaves out the
+# first of the archive's members, as counted by the receiver, and starts the
+# next one's file the given number of bytes in, per a pax header ZZZFS.offset.
+#
+# In a deduplicated stream (zzzfs send -D), a file with the same contents and
+# metadata as one earlier in the stream is sent as a hardlink to it, marked
+# by a pax header ZZZFS.duplicate; the receiver links it in the snapshot, and
+# copies it anywhere else.
+#
+# A replication stream (zzzfs send -R) is a header alone,
+#
+#   {"replicate": <fs@snap>, "filesystems": [{"name": <relative name>,
+#    "properties": {<local property>: <value>, ...},
+#    "snapshots": [<snapshot name>, ...]}, ...]}
+#
+# followed by a stream of each snapshot of each filesystem in turn, parents
+# first: the first snapshot of each in full, the rest incremental.
+#
+# Files with holes are stored as GNU sparse members, version 1.0, as GNU tar
+# writes them: a pax header naming the real file and size, then a member whose
+# data is a map of the file's data regions,
+#
+#   <number of regions>\n<offset>\n<length>\n[...]   (padded to 512 bytes)
+#
+# followed by the contents of those regions only.
+#
+# The receiver decodes a stream on one thread and hands the contents of each
+# file to a pool of writer threads, which may also write a second copy of
+# the snapshot's data (see Extractor).
+#
+# A receive -s that is interrupted keeps what it has received, along with its
+# progress, in <fs root>/receive/ (see Filesystem.receive). Its resume token
+# is that progress, for the sender:
+#
+#   1-<urlsafe base64 of zlib-compressed {"snapshot": ..., "from": ...,
+#       "members": ..., "offset": ..., "dedup": <if sent with -D>}>
+
+import os
+import copy
+import json
+import zlib
+import base64
+import hashlib
+import tarfile
+import shutil
+import posixpath
+import threading
+import contextlib
+import collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from libzzzfs.checksum import file_checksum
+from libzzzfs.treecopy import (
+    copy_file, data_extents, default_threads, has_holes)
+from libzzzfs.util import ZzzFSException
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+BUFFER_SIZE = 1 << 20
+FRAME_SIZE = 1 << 20
+# buffers of a file's contents waiting for its writer thread
+QUEUED_BUFFERS = 4
+MAGIC = b'ZZZFS-STREAM 1\n'
+DUPLICATE = 'ZZZFS.duplicate'
+OFFSET = 'ZZZFS.offset'
+SPARSE_HEADERS = {'GNU.sparse.major': '1', 'GNU.sparse.minor': '0'}
+TOKEN_VERSION = '1'
+
+
+def _from_json(value):
+    # Python 2: json gives back unicode strings, but paths are bytes
+    if str is bytes:
+        if isinstance(value, dict):
+            return dict((_from_json(k), _from_json(v))
+                        for k, v in value.items())
+        if isinstance(value, list):
+            return [_from_json(v) for v in value]
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+    return value
+
+
+class FrameWriter(object):
+    '''File object writing a tar archive into a send stream's frames.'''
+    def __init__(self, stream, header):
+        self.stream = stream
+        self.buf = []
+        self.size = 0
+        stream.write(MAGIC)
+        stream.write(json.dumps(header, sort_keys=True).encode('utf-8'))
+        stream.write(b'\n')
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= FRAME_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.size:
+            return
+        data = b''.join(self.buf)
+        payload = zlib.compress(data)
+        self.stream.write(('%d %s\n' % (
+            len(payload), hashlib.sha256(data).hexdigest())).encode('ascii'))
+        self.stream.write(payload)
+        self.buf = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.stream.write(b'0\n')
+
+
+class FrameReader(object):
+    '''File object reading a tar archive from a send stream's frames, each
+    checked against its checksum before any of it is returned.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = b''
+        self.ended = False
+        if stream.readline() != MAGIC:
+            raise ZzzFSException('invalid stream')
+        try:
+            self.header = _from_json(json.loads(
+                stream.readline().decode('utf-8')))
+        except ValueError:
+            raise ZzzFSException('invalid stream header')
+
+    def next_frame(self):
+        line = self.stream.readline()
+        if not line.endswith(b'\n'):
+            raise IOError('stream ended unexpectedly')
+        fields = line.split()
+        if fields == [b'0']:
+            self.ended = True
+            return
+        length, digest = int(fields[0]), fields[1].decode('ascii')
+        payload = self.stream.read(length)
+        if len(payload) != length:
+            raise IOError('stream ended unexpectedly')
+        data = zlib.decompress(payload)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError('stream corrupted: checksum mismatch')
+        self.buf += data
+
+    def read(self, size):
+        while len(self.buf) < size and not self.ended:
+            self.next_frame()
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def finish(self):
+        # read to the end of this stream, in case another follows it
+        while not self.ended:
+            self.next_frame()
+        self.buf = b''
+
+
+def write_header(stream, header):
+    '''Write a send stream of only a header.'''
+    FrameWriter(getattr(stream, 'buffer', stream), header).close()
+
+
+@contextlib.contextmanager
+def writing(stream, header):
+    '''Open a send stream with the given header as a TarFile.'''
+    frames = FrameWriter(getattr(stream, 'buffer', stream), header)
+    with tarfile.open(
+            fileobj=frames, mode='w|', format=tarfile.PAX_FORMAT) as t:
+        yield t
+    frames.close()
+
+
+def reading(stream):
+    '''Open a send stream, reading its header (see Extractor for the rest).'''
+    return FrameReader(getattr(stream, 'buffer', stream))
+
+
+class SparseMember(object):
+    '''File object reading the data of a GNU sparse member from a file.'''
+    def __init__(self, f, extents):
+        self.f = f
+        self.extents = list(extents)
+
+        numbers = [len(self.extents)]
+        for offset, length in self.extents:
+            numbers += [offset, length]
+        sparse_map = ''.join('%d\n' % n for n in numbers).encode('ascii')
+        self.map = sparse_map + b'\0' * (-len(sparse_map) % BLOCKSIZE)
+        self.size = len(self.map) + sum(l for _, l in self.extents)
+
+    def read(self, size):
+        # tarfile expects exactly size bytes, short of end of file
+        parts = []
+        while size > 0 and (self.map or self.extents):
+            if self.map:
+                data, self.map = self.map[:size], self.map[size:]
+            else:
+                offset, length = self.extents[0]
+                if not length:
+                    self.extents.pop(0)
+                    continue
+                self.f.seek(offset)
+                data = self.f.read(min(size, length))
+                if not data:
+                    raise IOError('%s: file changed while being sent' %
+                                  self.f.name)
+                if len(data) == length:
+                    self.extents.pop(0)
+                else:
+                    self.extents[0] = (offset + len(data), length - len(data))
+            parts.append(data)
+            size -= len(data)
+        return b''.join(parts)
+
+
+def tree_members(tar, path, arcname):
+    '''Generate (tarinfo, path) for each member of a directory tree, as
+    TarFile.add would add them.
+    '''
+    tarinfo = tar.gettarinfo(path, arcname)
+    if tarinfo is None:  # sockets and the like aren't archived
+        return
+    yield tarinfo, path
+    if tarinfo.isdir():
+        for name in sorted(os.listdir(path)):
+            for member in tree_members(
+                    tar, os.path.join(path, name),
+                    posixpath.join(arcname, name)):
+                yield member
+
+
+def snapshot_members(tar, root, arcname, data):
+    '''Generate the members of a snapshot, with its data read from the tree
+    at data (which need not be within the snapshot's root).
+    '''
+    yield tar.gettarinfo(root, arcname), root
+    for member in tree_members(tar, data, posixpath.join(arcname, 'data')):
+        yield member
+    for member in tree_members(tar, os.path.join(root, 'properties'),
+                               posixpath.join(arcname, 'properties')):
+        yield member
+
+
+def incremental_members(tar, root, arcname, data, differences):
+    '''Generate the members for the differences (see journal.compare_trees)
+    in a snapshot's data (read from the tree at data) since an earlier
+    snapshot, and all of its properties.
+    '''
+    yield tar.gettarinfo(root, arcname), root
+    for member in tree_members(tar, os.path.join(root, 'properties'),
+                               posixpath.join(arcname, 'properties')):
+        yield member
+
+    added = set()
+    for change, path in differences:
+        if change == '-':
+            continue
+        # directories leading to the change, for their metadata
+        parents = []
+        parent = os.path.dirname(path)
+        while parent not in added:
+            parents.insert(0, parent)
+            added.add(parent)
+            if not parent:
+                break
+            parent = os.path.dirname(parent)
+        for parent in parents:
+            yield tar.gettarinfo(
+                os.path.join(data, parent),
+                posixpath.join(arcname, 'data', parent).rstrip('/')), (
+                    os.path.join(data, parent))
+        for member in tree_members(tar, os.path.join(data, path),
+                                   posixpath.join(arcname, 'data', path)):
+            yield member
+
+
+class Duplicates(object):
+    '''Finds files added to a stream earlier with the same contents and
+    metadata as another, among those beneath data (a snapshot's data, whose
+    files are never modified in place). Files are compared by size and
+    metadata, then by SHA-256: as given in digests (by path), as found while
+    adding them, or else as read from the files.
+    '''
+    def __init__(self, data, digests=None):
+        self.data = os.path.join(data, '')
+        self.digests = dict(digests or {})
+        # (size, mode, uid, gid, mtime) -> [[path, name, digest], ...]
+        self.candidates = {}
+
+    def includes(self, tarinfo, path):
+        return tarinfo.isreg() and tarinfo.size and (
+            path.startswith(self.data)) and not has_holes(os.stat(path))
+
+    def key(self, tarinfo):
+        return (tarinfo.size, tarinfo.mode, tarinfo.uid, tarinfo.gid,
+                tarinfo.mtime)
+
+    def digest(self, path):
+        if path not in self.digests:
+            self.digests[path] = file_checksum(path)[0]
+        return self.digests[path]
+
+    def find(self, tarinfo, path):
+        '''Return the name of an earlier file like this one, if any.'''
+        for candidate in self.candidates.get(self.key(tarinfo), []):
+            if candidate[2] is None:
+                candidate[2] = self.digest(candidate[0])
+            if candidate[2] == self.digest(path):
+                return candidate[1]
+        return None
+
+    def add(self, tarinfo, path, digest=None):
+        self.candidates.setdefault(self.key(tarinfo), []).append(
+            [path, tarinfo.name, digest or self.digests.get(path)])
+
+
+class HashingReader(object):
+    '''File object finding the SHA-256 of what is read from a file.'''
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        buf = self.f.read(size)
+        self.sha256.update(buf)
+        return buf
+
+
+def add_members(tar, members, skip=0, offset=0, duplicates=None):
+    '''Add (tarinfo, path) members to a tar archive, storing files with holes
+    as sparse members. The first skip members are left out, and the next
+    one's file is started offset bytes in (see resume tokens). Given
+    Duplicates, files like one added earlier are added as hardlinks to it.
+    '''
+    for i, (tarinfo, path) in enumerate(members):
+        deduplicated = duplicates is not None and (
+            duplicates.includes(tarinfo, path))
+        if deduplicated:
+            original = duplicates.find(tarinfo, path)
+            if original is not None:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = original
+                tarinfo.size = 0
+                tarinfo.pax_headers = {DUPLICATE: '1'}
+            elif i < skip or (i == skip and offset):
+                duplicates.add(tarinfo, path)
+
+        if i < skip:
+            continue
+        if not tarinfo.isreg():
+            tar.addfile(tarinfo)
+            continue
+
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if has_holes(st):
+                add_sparse_file(tar, tarinfo, f, data_extents(
+                    f.fileno(), st.st_size))
+            elif i == skip and offset:
+                # the rest of a file cut short by an interrupted receive
+                tarinfo.pax_headers = {OFFSET: str(offset)}
+                tarinfo.size -= offset
+                f.seek(offset)
+                tar.addfile(tarinfo, f)
+            elif deduplicated:
+                reader = HashingReader(f)
+                tar.addfile(tarinfo, reader)
+                duplicates.add(tarinfo, path, reader.sha256.hexdigest())
+            else:
+                tar.addfile(tarinfo, f)
+
+
+def add_sparse_file(tar, tarinfo, f, extents):
+    extents = list(extents)
+    if not extents or sum(extents[-1]) < tarinfo.size:
+        # GNU tar only learns of a trailing hole from an empty last region
+        extents.append((tarinfo.size, 0))
+    member = SparseMember(f, extents)
+    tarinfo.pax_headers = dict(
+        SPARSE_HEADERS, **{'GNU.sparse.name': tarinfo.name,
+                           'GNU.sparse.realsize': str(tarinfo.size)})
+    dirname, basename = posixpath.split(tarinfo.name)
+    tarinfo.name = posixpath.join(dirname, 'GNUSparseFile.0', basename)
+    tarinfo.size = member.size
+    tar.addfile(tarinfo, member)
+
+
+def is_undecoded_sparse(tarinfo):
+    # older tarfile modules (Python 2) don't understand version 1.0
+    return getattr(tarinfo, 'sparse', None) is None and all(
+        tarinfo.pax_headers.get(k) == v for k, v in SPARSE_HEADERS.items())
+
+
+def extract_sparse_file(tar, tarinfo, path):
+    source = tar.extractfile(tarinfo)
+    header = b''
+    while True:
+        header += source.read(BLOCKSIZE)
+        numbers = header.split(b'\n')
+        count = int(numbers[0])
+        if len(numbers) > 2 * count + 1:
+            break
+    numbers = [int(n) for n in numbers[1:2 * count + 1]]
+
+    target = os.path.join(path, tarinfo.pax_headers['GNU.sparse.name'])
+    with open(target, 'wb') as f:
+        for offset, length in zip(numbers[::2], numbers[1::2]):
+            f.seek(offset)
+            while length > 0:
+                data = source.read(min(length, 1 << 20))
+                if not data:
+                    raise tarfile.ReadError('unexpected end of data')
+                f.write(data)
+                length -= len(data)
+        f.truncate(int(tarinfo.pax_headers['GNU.sparse.realsize']))
+
+    tar.chmod(tarinfo, target)
+    tar.utime(tarinfo, target)
+
+
+def member_path(tarinfo):
+    if is_undecoded_sparse(tarinfo):
+        return tarinfo.pax_headers['GNU.sparse.name']
+    return tarinfo.name
+
+
+def _chown(tar, tarinfo, target):
+    # only takes effect for root, as with TarFile.extract
+    if str is bytes:  # Python 2
+        tar.chown(tarinfo, target)
+    else:
+        tar.chown(tarinfo, target, False)
+
+
+class FileWriter(object):
+    '''Writes the contents of a file, handed over a buffer at a time by the
+    thread decoding a stream, to one or more copies of it on a writer thread.
+    '''
+    def __init__(self, index, targets, offset, finish, slots):
+        self.index = index  # of the file's member in the stream
+        self.targets = targets
+        self.offset = offset
+        self.written = offset
+        self.finish = finish
+        self.slots = slots
+        self.buffers = queue.Queue(QUEUED_BUFFERS)
+        self.complete = False  # set once all of its contents are handed over
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        ended = False
+        try:
+            files = [open(path, 'r+b') for path in self.targets]
+            try:
+                for f in files:
+                    f.seek(self.offset)
+                while True:
+                    buf = self.buffers.get()
+                    if buf is None:
+                        ended = True
+                        break
+                    for f in files:
+                        f.write(buf)
+                    self.written += len(buf)
+            finally:
+                for f in files:
+                    f.close()
+            if self.complete:
+                self.finish()
+        except BaseException as e:
+            self.error = e
+            # so that the decoding thread is never left waiting
+            while not ended:
+                ended = self.buffers.get() is None
+        finally:
+            self.done.set()
+            self.slots.release()
+
+
+class Extractor(object):
+    '''Extracts the members of send streams into a directory, keeping holes in
+    sparse files. Anything already in the way of a member is replaced, not
+    overwritten, so that files hardlinked elsewhere are unaffected.
+
+    Files are written by a pool of threads while the stream is decoded. Given
+    a mirror of (member name, directory), whatever the stream holds beneath
+    that member is written to the directory too, in the same pass.
+
+    Its progress counts the members extracted, and how many bytes of the next
+    one's file, across any number of streams resuming one another. Members
+    count only once every member before them is extracted, too.
+    '''
+    def __init__(self, path, progress=None, mirror=None, threads=None):
+        progress = progress or {}
+        self.path = path
+        self.members = progress.get('members', 0)
+        self.offset = progress.get('offset', 0)
+        # [path, mode, mtime], set once their contents are in place
+        self.directories = progress.get('directories', [])
+        self.mirror = mirror
+        self.threads = threads or default_threads(path)
+        self.next = self.members  # index of the next member in the stream
+        self.pending = collections.deque()  # FileWriters, in stream order
+        self.feeding = None
+
+    @property
+    def progress(self):
+        return {'members': self.members, 'offset': self.offset,
+                'directories': self.directories}
+
+    def extract(self, frames, checkpoint=None):
+        '''Extract every member of a stream (see reading), calling checkpoint
+        (if given) after each.
+        '''
+        self.writers = ThreadPool(self.threads)
+        # files handed over but not yet written, at most
+        self.slots = threading.BoundedSemaphore(self.threads + 1)
+        try:
+            with tarfile.open(fileobj=frames, mode='r|') as tar:
+                for tarinfo in tar:
+                    self.extract_next(tar, tarinfo)
+                    self.next += 1
+                    self.count_done()
+                    if checkpoint is not None:
+                        checkpoint(self.progress)
+            frames.finish()
+        finally:
+            if self.feeding is not None:
+                # left incomplete; the rest comes from a resumed stream
+                self.feeding.buffers.put(None)
+                self.feeding = None
+            self.writers.close()
+            self.writers.join()
+            self.count_done(check=False)
+        self.count_done()
+
+    def count_done(self, check=True):
+        # advance the progress over the files written; with check, raise the
+        # error of any writer which failed
+        while self.pending and self.pending[0].done.is_set() and (
+                self.pending[0].complete and self.pending[0].error is None):
+            self.pending.popleft()
+        if not self.pending:
+            self.members, self.offset = self.next, 0
+            return
+
+        writer = self.pending[0]
+        self.members = writer.index
+        # what a writer wrote is all on disk only once it's done
+        self.offset = writer.written if writer.done.is_set() else (
+            writer.offset)
+        if check and writer.error is not None:
+            raise writer.error
+
+    def targets(self, name):
+        # where a member goes: into path, and into the mirror if beneath it
+        targets = [os.path.join(self.path, name)]
+        if self.mirror is not None:
+            prefix, directory = self.mirror
+            if name == prefix:
+                targets.append(directory)
+            elif name.startswith(prefix + '/'):
+                targets.append(os.path.join(
+                    directory, name[len(prefix) + 1:]))
+        return targets
+
+    def extract_next(self, tar, tarinfo):
+        targets = self.targets(member_path(tarinfo))
+        if OFFSET in tarinfo.pax_headers:
+            if int(tarinfo.pax_headers[OFFSET]) != self.offset:
+                raise ZzzFSException(
+                    '%s: stream resumes at the wrong offset' % tarinfo.name)
+            self.extract_file(tar, tarinfo, targets, self.offset)
+        else:
+            self.extract_member(tar, tarinfo, targets)
+
+    def extract_member(self, tar, tarinfo, targets):
+        for target in targets:
+            if not (tarinfo.isdir() and os.path.isdir(target)):
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                elif os.path.lexists(target):
+                    os.remove(target)
+
+        if tarinfo.isdir():
+            for target in targets:
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                _chown(tar, tarinfo, target)
+                self.directories.append(
+                    [target, tarinfo.mode, tarinfo.mtime])
+            return
+        if tarinfo.isreg() and not getattr(tarinfo, 'sparse', None) and (
+                not is_undecoded_sparse(tarinfo)):
+            self.extract_file(tar, tarinfo, targets)
+            return
+
+        if tarinfo.islnk():
+            # linking to a file also sets its attributes
+            self.wait_for(self.targets(tarinfo.linkname)[0])
+        if is_undecoded_sparse(tarinfo):
+            extract_sparse_file(tar, tarinfo, self.path)
+        else:
+            tar.extract(tarinfo, self.path)
+        for target in targets[1:]:
+            self.mirror_member(tar, tarinfo, targets[0], target)
+
+    def wait_for(self, path):
+        # until any file being written to path is done
+        for writer in list(self.pending):
+            if path in writer.targets:
+                writer.done.wait()
+
+    def mirror_member(self, tar, tarinfo, extracted, target):
+        # copy a member extracted without a writer thread, since its data
+        # can't be read from the stream again
+        if tarinfo.isreg():
+            copy_file(extracted, target)
+            _chown(tar, tarinfo, target)
+        elif tarinfo.islnk() and DUPLICATE in tarinfo.pax_headers:
+            # the same contents as another file, but not the same file
+            copy_file(self.targets(tarinfo.linkname)[-1], target)
+            _chown(tar, tarinfo, target)
+        elif tarinfo.islnk():
+            os.link(self.targets(tarinfo.linkname)[-1], target)
+        else:
+            member = copy.copy(tarinfo)
+            member.name = os.path.relpath(target, self.mirror[1])
+            tar.extract(member, self.mirror[1])
+
+    def extract_file(self, tar, tarinfo, targets, offset=0):
+        # appending to what an interrupted receive wrote of it, if anything;
+        # each copy exists (for any hardlinks to it) before it's written
+        for target in targets:
+            with open(target, 'r+b' if offset else 'wb') as f:
+                f.truncate(offset)
+
+        def finish():
+            for target in targets:
+                _chown(tar, tarinfo, target)
+                tar.chmod(tarinfo, target)
+                tar.utime(tarinfo, target)
+
+        self.slots.acquire()
+        writer = FileWriter(self.next, targets, offset, finish, self.slots)
+        self.pending.append(writer)
+        self.feeding = writer
+        self.writers.apply_async(writer.run)
+        source = tar.extractfile(tarinfo)
+        while True:
+            buf = source.read(BUFFER_SIZE)
+            if not buf:
+                break
+            writer.buffers.put(buf)
+        writer.complete = True
+        writer.buffers.put(None)
+        self.feeding = None
+
+    def finish(self):
+        '''Set the attributes of directories, once everything is extracted.'''
+        for path, mode, mtime in reversed(self.directories):
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+
+
+def encode_token(state):
+    '''Make a resume token of a receive's state (see Filesystem.receive).'''
+    token = dict((key, state[key])
+                 for key in ('snapshot', 'from', 'members', 'offset'))
+    if state.get('dedup'):
+        token['dedup'] = True
+    return '%s-%s' % (TOKEN_VERSION, base64.urlsafe_b64encode(zlib.compress(
+        json.dumps(token, sort_keys=True).encode('utf-8'))).decode('ascii'))
+
+
+def decode_token(token):
+    try:
+        version, data = token.split('-', 1)
+        if version != TOKEN_VERSION:
+            raise ValueError(version)
+        return _from_json(json.loads(zlib.decompress(
+            base64.urlsafe_b64decode(data.encode('ascii'))).decode('utf-8')))
+    except (ValueError, TypeError, zlib.error):
+        raise ZzzFSException('%s: invalid resume token' % token)
+
+
+def read_state(path):
+    '''Return the state of an interrupted receive, or None if there is none.
+    '''
+    try:
+        with open(path) as f:
+            return _from_json(json.load(f))
+    except (IOError, OSError):
+        return None
+
+
+def write_state(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def resume_token(path):
+    # for the receive_resume_token property
+    state = read_state(path)
+    return encode_token(state) if state is not None else None
@@ -0,0 +1,162 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# zzzpool tier moves snapshots' data to a cold tier, per the pool's
+# properties:
+#
+#   coldtier=<directory>  where the pool's archives go, in <directory>/<pool>/
+#   coldage=<days>        archive snapshots at least this old
+#   hotsize=<bytes>       archive the oldest snapshots beyond the newest ones
+#                         whose data adds up to this much
+#
+# An archived snapshot's stored data (compressed files and all) is a send
+# stream (see sendstream.py) with a header of {"archive": <fs@snap>}, in
+#
+#   <directory>/<pool>/<fs_name>@<snapshot_name>.<random>.zzzfs
+#
+# and in its root, the data is replaced by
+#
+#   archive -> <the archive>
+#   catalog   (the data's entries, as a bookmark records them; see
+#              bookmark.py)
+#
+# so that it can still be listed, diffed, and sent from incrementally, while
+# clones and rollbacks (and full sends) extract the archive as they go.
+
+import os
+import shutil
+import tempfile
+
+from libzzzfs import sendstream
+from libzzzfs.util import to_number, ZzzFSException
+
+SUFFIX = '.zzzfs'
+
+
+def parse_age(value):
+    '''Return the seconds in a coldage property value, a number of days.'''
+    days = to_number(value)
+    if days is None or days < 0:
+        raise ZzzFSException('%s: invalid age' % value)
+    return days * 24 * 60 * 60
+
+
+def parse_directory(value):
+    if not os.path.isabs(value):
+        raise ZzzFSException('%s: not an absolute path' % value)
+    return value
+
+
+def _unique_size(data, seen):
+    # bytes of the files in a tree not already counted in seen
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(data):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                size += st.st_size
+    return size
+
+
+def select(snapshots, now, age=None, budget=None):
+    '''Choose which of (creation time, data, snapshot) to archive: those at
+    least age seconds old at now, and the oldest beyond the newest whose data
+    fits in budget bytes (counting files linked between them once). Returns
+    the snapshots, oldest first.
+    '''
+    chosen = []
+    seen = set()
+    total = 0
+    for creation, data, snapshot in sorted(
+            snapshots, key=lambda s: s[0], reverse=True):
+        if budget is not None and total <= budget:
+            total += _unique_size(data, seen)
+        if (budget is not None and total > budget) or (
+                age is not None and now - creation >= age):
+            chosen.append(snapshot)
+    chosen.reverse()
+    return chosen
+
+
+def new_archive(directory, full_name):
+    '''Create an empty archive file for a snapshot, returning its path.'''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, path = tempfile.mkstemp(
+        prefix='%s.' % full_name.replace('/', '%'), suffix=SUFFIX,
+        dir=directory)
+    os.close(fd)
+    return path
+
+
+def write_archive(path, full_name, data):
+    '''Write the tree at data to an archive (see new_archive).'''
+    with open(path, 'wb') as f:
+        with sendstream.writing(f, {'archive': full_name}) as t:
+            sendstream.add_members(t, sendstream.tree_members(t, data, 'data'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def extract_archive(path, dst):
+    '''Extract the tree in an archive to dst, which must not exist.'''
+    tmp = tempfile.mkdtemp(prefix='.archive-', dir=os.path.dirname(dst))
+    try:
+        with open(path, 'rb') as f:
+            extractor = sendstream.Extractor(tmp)
+            extractor.extract(sendstream.reading(f))
+            extractor.finish()
+        os.rename(os.path.join(tmp, 'data'), dst)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def remove_archive(path):
+    # and its directory, once empty
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+def collect_garbage(directory, referenced):
+    '''Remove the archives in directory whose real paths are not in
+    referenced (left by interrupted archiving, or by snapshots destroyed
+    while the pool had a checkpoint), returning how many.
+    '''
+    try:
+        names = os.listdir(directory)
+    except OSError:  # nothing archived there yet
+        return 0
+    removed = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith(SUFFIX) and (
+                os.path.realpath(path) not in referenced):
+            remove_archive(path)
+            removed += 1
+    return removed
@@ -0,0 +1,272 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Opt-in timing and I/O counts for zzzfs and zzzpool commands. With
+# ZZZFS_TRACE set, each command writes one JSON object, on a line of its
+# own, to stderr (for ZZZFS_TRACE=1 or -) or appended to the file it names:
+#
+#   {"command": ["zzzfs", "snapshot", "pool/fs@now"],
+#    "wall": 0.21, "cpu": 0.18,
+#    "calls": {"listdir": 12, "lstat": 0, "open": 4051, "scandir": 40,
+#              "stat": 8830},
+#    "counters": {"bytes_copied": 10485760, "files_copied": 2000},
+#    "io": {"read": 10612340, "written": 10536011},
+#    "phases": {"copy": {"count": 1, "wall": 0.15, "cpu": 0.13,
+#                        "calls": {...}}, ...}}
+#
+# Times are in seconds; CPU time is the whole process's, threads and all.
+# Phases are named spans of the command (see traced() and phase()), timed
+# inclusively and summed over every time each was entered, from any thread.
+# Those recorded are resolve (looking up datasets), properties, copy (of a
+# snapshot's data), checksum, replicate (onto mirrors), restore (of stored
+# data as a plain tree), walk (comparing trees), send, receive and history.
+# The calls are to the os functions and open() of the same names, counted
+# by replacing them only while a command is traced; io is what the process
+# read and wrote through system calls, where /proc/self/io says so, and
+# counters are added to by the code being traced (e.g. files copied).
+#
+# Untraced, phases and counters cost one global lookup each.
+
+import io
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import builtins
+except ImportError:  # Python 2
+    import __builtin__ as builtins
+
+# the trace of the command running, if any
+_current = None
+
+# names counted in "calls", and where each function of that name lives
+CALLS = {
+    'stat': [(os, 'stat')],
+    'lstat': [(os, 'lstat')],
+    'open': [(builtins, 'open'), (io, 'open'), (os, 'open')],
+    'listdir': [(os, 'listdir')],
+    'scandir': [(os, 'scandir')],
+}
+# sets of os functions accepting particular arguments, which shutil and
+# others consult before passing them
+_SUPPORTS = ('supports_dir_fd', 'supports_fd', 'supports_follow_symlinks',
+             'supports_effective_ids')
+
+
+def _cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def _read_io():
+    # bytes read and written by the process, or None if unknown
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return {'read': int(fields['rchar']),
+                'written': int(fields['wchar'])}
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+class Trace(object):
+    '''What one command did, as it happens.'''
+    def __init__(self, argv):
+        self.argv = list(argv)
+        self.calls = dict((name, 0) for name in CALLS)
+        self.counters = {}
+        self.phases = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.patched = []
+
+    def count_call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def add(self, counter, n):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def add_phase(self, name, wall, cpu, calls):
+        with self.lock:
+            phase = self.phases.setdefault(name, {
+                'count': 0, 'wall': 0.0, 'cpu': 0.0,
+                'calls': dict((call, 0) for call in CALLS)})
+            phase['count'] += 1
+            phase['wall'] += wall
+            phase['cpu'] += cpu
+            for call, n in calls.items():
+                phase['calls'][call] += n
+
+    def patch(self):
+        '''Count calls to the functions in CALLS, until unpatch().'''
+        for name, places in CALLS.items():
+            for module, attr in places:
+                original = getattr(module, attr, None)
+                if original is None:
+                    continue
+                wrapper = self.counting(name, original)
+                supports = [getattr(os, s) for s in _SUPPORTS
+                            if original in getattr(os, s, ())]
+                for functions in supports:
+                    functions.add(wrapper)
+                setattr(module, attr, wrapper)
+                self.patched.append((module, attr, original, wrapper,
+                                     supports))
+
+    def counting(self, name, function):
+        def wrapper(*args, **kwargs):
+            self.count_call(name)
+            return function(*args, **kwargs)
+        return wrapper
+
+    def unpatch(self):
+        for module, attr, original, wrapper, supports in reversed(
+                self.patched):
+            setattr(module, attr, original)
+            for functions in supports:
+                functions.discard(wrapper)
+        self.patched = []
+
+    def to_json(self, wall, cpu, io_counts):
+        record = {'command': self.argv, 'wall': wall, 'cpu': cpu,
+                  'calls': self.calls, 'counters': self.counters,
+                  'phases': self.phases}
+        if io_counts is not None:
+            record['io'] = io_counts
+        if self.error is not None:
+            record['error'] = self.error
+        return record
+
+
+class _Phase(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.calls = dict(self.trace.calls)
+        self.cpu = _cpu_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.time() - self.start
+        cpu = _cpu_time() - self.cpu
+        self.trace.add_phase(self.name, wall, cpu, dict(
+            (call, n - self.calls[call])
+            for call, n in self.trace.calls.items()))
+
+
+class _Untraced(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_UNTRACED = _Untraced()
+
+
+def phase(name):
+    '''A context manager timing a span of the traced command as the named
+    phase; untraced, it does nothing.
+    '''
+    trace = _current
+    if trace is None:
+        return _UNTRACED
+    return _Phase(trace, name)
+
+
+def traced(name):
+    '''Decorate a function to time each call to it as the named phase.'''
+    def decorate(function):
+        def wrapper(*args, **kwargs):
+            trace = _current
+            if trace is None:
+                return function(*args, **kwargs)
+            with _Phase(trace, name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorate
+
+
+def add(counter, n=1):
+    '''Add n to a counter of the traced command, if any.'''
+    trace = _current
+    if trace is not None:
+        trace.add(counter, n)
+
+
+def write(record, destination):
+    line = json.dumps(record, sort_keys=True)
+    if destination in ('1', '-'):
+        sys.stderr.write(line + '\n')
+        sys.stderr.flush()
+    else:
+        with open(destination, 'a') as f:
+            f.write(line + '\n')
+
+
+@contextlib.contextmanager
+def command(argv):
+    '''Trace a command for as long as the context lasts, if ZZZFS_TRACE is
+    set, writing the trace out once it ends (however it ends).
+    '''
+    global _current
+    destination = os.environ.get('ZZZFS_TRACE')
+    if not destination or _current is not None:
+        yield
+        return
+
+    trace = Trace(argv)
+    io_start = _read_io()
+    cpu_start = _cpu_time()
+    start = time.time()
+    trace.patch()
+    _current = trace
+    try:
+        yield
+    except Exception as e:
+        trace.error = str(e)
+        raise
+    finally:
+        _current = None
+        trace.unpatch()
+        wall = time.time() - start
+        cpu = _cpu_time() - cpu_start
+        io_end = _read_io()
+        io_counts = None
+        if io_start is not None and io_end is not None:
+            io_counts = dict(
+                (key, io_end[key] - io_start[key]) for key in io_end)
+        write(trace.to_json(wall, cpu, io_counts), destination)
@@ -0,0 +1,423 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# Tree copies for snapshot, clone, rollback and rename. Each directory is
+# read once (with os.scandir where available), and file contents are copied
+# in the kernel (os.copy_file_range, else os.sendfile, else userspace
+# buffers), several files at a time on a thread pool sized to the device.
+# Metadata is preserved as by shutil.copytree/copy2, and so are holes in
+# sparse files, where os.SEEK_DATA can find them.
+#
+# Set ZZZFS_COPY_THREADS to override the number of threads, and
+# ZZZFS_COPY_STATS to log the throughput of every copy.
+
+import os
+import stat
+import time
+import errno
+import shutil
+import logging
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from libzzzfs import trace
+
+logger = logging.getLogger(__name__)
+
+# bytes per copy_file_range/sendfile call, and per read otherwise
+CHUNK_SIZE = 1 << 30
+BUFFER_SIZE = 1 << 20
+
+# errors meaning an in-kernel copy isn't possible between these two files
+_UNSUPPORTED = set(getattr(errno, name) for name in (
+    'ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF', 'ETXTBSY')
+    if hasattr(errno, name))
+# methods which failed with ENOSYS, and so never will
+_disabled = set()
+
+
+class CopyStats(object):
+    '''Totals for one tree copy, safe to update from several threads.'''
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.end = None
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.lock:
+            self.files += 1
+            self.bytes += nbytes
+        trace.add('files_copied')
+        trace.add('bytes_copied', nbytes)
+
+    def link(self):
+        with self.lock:
+            self.files += 1
+        trace.add('files_linked')
+
+    def finish(self):
+        self.end = time.time()
+        return self
+
+    @property
+    def elapsed(self):
+        return (self.end or time.time()) - self.start
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def files_per_second(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return '%d files, %d bytes in %.3fs (%.1f files/s, %.0f bytes/s)' % (
+            self.files, self.bytes, self.elapsed, self.files_per_second,
+            self.bytes_per_second)
+
+
+def _kernel_copy(method, src_fd, dst_fd, length):
+    # copy up to length bytes from the current offsets; returns bytes copied,
+    # which may be fewer if the method gave up part way through
+    copied = 0
+    while copied < length:
+        count = min(length - copied, CHUNK_SIZE)
+        try:
+            if method == 'copy_file_range':
+                n = os.copy_file_range(src_fd, dst_fd, count)
+            else:
+                n = os.sendfile(dst_fd, src_fd, None, count)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            if e.errno == errno.ENOSYS:
+                _disabled.add(method)
+            return copied
+        if n == 0:  # file shrank meanwhile
+            return copied
+        copied += n
+    return copied
+
+
+def _copy_range(fsrc, fdst, offset, length):
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    copied = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if method in _disabled or not hasattr(os, method):
+            continue
+        copied += _kernel_copy(
+            method, fsrc.fileno(), fdst.fileno(), length - copied)
+        if copied >= length:
+            return copied
+
+    # in userspace, then
+    fsrc.seek(offset + copied)
+    fdst.seek(offset + copied)
+    while copied < length:
+        buf = fsrc.read(min(length - copied, BUFFER_SIZE))
+        if not buf:
+            break
+        fdst.write(buf)
+        copied += len(buf)
+    return copied
+
+
+def has_holes(st):
+    '''Whether a file (per its stat result) has fewer blocks allocated than
+    its size needs.
+    '''
+    return getattr(st, 'st_blocks', None) is not None and (
+        st.st_blocks * 512 < st.st_size)
+
+
+def data_extents(fd, size):
+    '''Generate (offset, length) for each region of a file holding data,
+    skipping holes, or the whole file if holes can't be found here.
+    '''
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield (0, size)
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # nothing but a hole remains
+                return
+            if e.errno not in _UNSUPPORTED:
+                raise
+            yield (offset, size - offset)
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if end <= start:
+            return
+        yield (start, end - start)
+        offset = end
+
+
+def copy_file(src, dst, st=None):
+    '''Copy a file's contents and metadata, like shutil.copy2, returning the
+    number of bytes copied. Holes in sparse files are recreated.
+    '''
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            if st is None:
+                st = os.fstat(fsrc.fileno())
+
+            if not st.st_size:
+                # files in /proc and the like report a size of zero
+                shutil.copyfileobj(fsrc, fdst)
+                copied = fdst.tell()
+            else:
+                extents = [(0, st.st_size)]
+                if has_holes(st):
+                    extents = list(data_extents(fsrc.fileno(), st.st_size))
+                copied = sum(_copy_range(fsrc, fdst, offset, length)
+                             for offset, length in extents)
+                # extend the copy over any trailing hole
+                fdst.truncate(st.st_size)
+
+    shutil.copystat(src, dst)
+    return copied
+
+
+def _is_rotational(path):
+    # look up the block device holding path in sysfs (Linux only)
+    try:
+        dev = os.stat(path).st_dev
+        sys_dev = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+        for queue in ('queue', os.path.join('..', 'queue')):
+            try:
+                with open(os.path.join(sys_dev, queue, 'rotational')) as f:
+                    return f.read().strip() == '1'
+            except IOError:
+                # a partition; its queue is its parent device's
+                continue
+    except (OSError, AttributeError):
+        pass
+    return False
+
+
+def default_threads(path):
+    '''Number of files to copy at once onto the device holding path: one for
+    spinning disks, where parallel copies only add seeks, and a few per CPU
+    for SSDs, network and memory filesystems.
+    '''
+    if os.environ.get('ZZZFS_COPY_THREADS'):
+        return max(1, int(os.environ['ZZZFS_COPY_THREADS']))
+    if _is_rotational(path):
+        return 1
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return min(4 * cpus, 32)
+
+
+def _scan(path):
+    # generate (name, path, is_dir, is_symlink, lstat-or-None) per entry
+    if hasattr(os, 'scandir'):
+        entries = os.scandir(path)
+        try:
+            for entry in entries:
+                is_symlink = entry.is_symlink()
+                yield (entry.name, entry.path, entry.is_dir(), is_symlink,
+                       None if is_symlink else entry.stat())
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            st = os.lstat(entry_path)
+            is_symlink = stat.S_ISLNK(st.st_mode)
+            yield (name, entry_path, os.path.isdir(entry_path), is_symlink,
+                   None if is_symlink else st)
+
+
+def _make_dirs(src, dst, symlinks):
+    # create the directory structure of src at dst, and any symlinks being
+    # kept as such, returning the (src, dst) directories and files made
+    directories = []
+    files = []
+    pending = [(src, dst)]
+    while pending:
+        src_dir, dst_dir = pending.pop()
+        os.makedirs(dst_dir)
+        directories.append((src_dir, dst_dir))
+        for name, src_path, is_dir, is_symlink, st in _scan(src_dir):
+            dst_path = os.path.join(dst_dir, name)
+            if is_symlink and symlinks:
+                os.symlink(os.readlink(src_path), dst_path)
+                try:
+                    shutil.copystat(src_path, dst_path, follow_symlinks=False)
+                except TypeError:  # Python 2 doesn't copy link metadata
+                    pass
+            elif is_dir:
+                pending.append((src_path, dst_path))
+            else:
+                # symlinks are followed, as by shutil.copytree
+                files.append((src_path, dst_path, st))
+    return directories, files
+
+
+def _finish(src, dst, directories, stats):
+    # directory times are set after their contents, deepest first
+    for src_dir, dst_dir in reversed(directories):
+        shutil.copystat(src_dir, dst_dir)
+
+    stats.finish()
+    if os.environ.get('ZZZFS_COPY_STATS'):
+        logger.info('%s -> %s: %s', src, dst, stats)
+    return stats
+
+
+def copytree(src, dst, symlinks=False, threads=None,
+             copy_function=copy_file):
+    '''Recursively copy a directory tree, like shutil.copytree, returning a
+    CopyStats. dst must not already exist. Files are copied by
+    copy_function(src, dst, st), which returns the number of bytes copied.
+    '''
+    stats = CopyStats()
+    directories, files = _make_dirs(src, dst, symlinks)
+
+    if threads is None:
+        threads = default_threads(dst)
+    threads = min(threads, len(files))
+
+    def copy(item):
+        stats.add(copy_function(*item))
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            # consume the iterator, so the first error is raised here
+            for _ in pool.imap_unordered(copy, files, chunksize=16):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for item in files:
+            copy(item)
+
+    return _finish(src, dst, directories, stats)
+
+
+def linktree(src, dst):
+    '''Recreate a directory tree of files that won't be modified in place,
+    e.g. a snapshot, with hardlinks to its files. Returns a CopyStats
+    counting the files linked.
+    '''
+    stats = CopyStats()
+    directories, files = _make_dirs(src, dst, symlinks=True)
+    for src_path, dst_path, _ in files:
+        os.link(src_path, dst_path)
+        stats.link()
+    return _finish(src, dst, directories, stats)
+
+
+def same_device(path, other):
+    '''Whether two paths are on the same device, so that files can be
+    hardlinked from one to the other.
+    '''
+    return os.stat(path).st_dev == os.stat(other).st_dev
+
+
+def is_linked(path, other):
+    '''Whether two paths are hardlinks to the same file.'''
+    try:
+        return os.path.samestat(os.lstat(path), os.lstat(other))
+    except OSError:
+        return False
+
+
+def remove(path):
+    '''Remove a file or directory tree, if it exists.'''
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def update(src, dst, paths, copy_function=copy_file):
+    '''Bring the given relative paths in dst, and whatever is beneath them, up
+    to date with src, as copytree would have copied them. Files are replaced,
+    not overwritten, so any hardlinks to them (see linktree) are unaffected.
+    Returns a CopyStats.
+    '''
+    stats = CopyStats()
+    parents = set()
+    for path in sorted(paths):
+        src_path = os.path.join(src, path)
+        dst_path = os.path.join(dst, path)
+        parents.add(os.path.dirname(path))
+
+        if os.path.isdir(src_path):
+            if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                # only the directory's own metadata has changed
+                shutil.copystat(src_path, dst_path)
+                continue
+            remove(dst_path)
+            copied = copytree(
+                src_path, dst_path, copy_function=copy_function)
+            stats.files += copied.files
+            stats.bytes += copied.bytes
+        elif os.path.exists(src_path):
+            remove(dst_path)
+            if not os.path.isdir(os.path.dirname(dst_path)):
+                os.makedirs(os.path.dirname(dst_path))
+            stats.add(copy_function(src_path, dst_path, None))
+        else:
+            remove(dst_path)
+
+    # directory times change with their contents, so set them last
+    return _finish(src, dst, [
+        (os.path.join(src, parent), os.path.join(dst, parent))
+        for parent in sorted(parents)
+        if os.path.isdir(os.path.join(src, parent)) and
+        os.path.isdir(os.path.join(dst, parent))], stats)
+
+
+def move(src, dst):
+    '''Move a file or directory tree to dst (which must not exist), copying
+    it if dst is on another device.
+    '''
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        if os.path.isdir(src) and not os.path.islink(src):
+            copytree(src, dst, symlinks=True)
+            shutil.rmtree(src)
+        else:
+            shutil.move(src, dst)
@@ -21,6 +21,10 @@
 
 # Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
 
+import json
+import time
+import threading
+
 
 def validate_component_name(component_name, allow_slashes=False):
     '''Check that component name starts with an alphanumeric character, and
@@ -46,6 +50,24 @@ class ZzzFSException(Exception):
     pass
 
 
+class Throttle(object):
+    '''Limits the combined rate of reads by several threads.'''
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.time()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self.lock:
+            self.total += nbytes
+            delay = self.start + float(self.total) / self.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
 class PropertyList(object):
     # Numeric columns are right-aligned when tabulated.
     numeric_types = ['alloc', 'avail', 'cap', 'free', 'refer', 'size', 'used']
@@ -102,48 +124,188 @@ class PropertyAssignment(object):
         return self.user_string
 
 
-def tabulated(data, headers, scriptable_mode=False, sort_asc=[], sort_desc=[]):
-    '''Generates a printable table as a string given data (an array of dicts)
-    and an array of field names for headers.
+class OutputLines(object):
+    '''Command output generated one line at a time. The command line tools
+    write each line as soon as it is produced; str() joins them.
+    '''
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __str__(self):
+        return '\n'.join(self.lines)
+
+
+def write_output(output, stdout):
+    '''Write each line of a command's output as it is produced, if stdout is
+    given; otherwise return the output as a string.
     '''
-    if len(data) == 0:
-        return ''
+    if not isinstance(output, OutputLines):
+        return output
+    if stdout is None:
+        return str(output)
+
+    for i, line in enumerate(output):
+        stdout.write(line + '\n')
+        if i == 0:
+            # don't keep the reader waiting for a buffer's worth of rows
+            stdout.flush()
+
+
+class Descending(object):
+    '''Sort key wrapper which inverts the order of the wrapped value.'''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def to_number(value):
+    '''Parse a numeric property value, returning None if it isn't one.'''
+    for number_type in (int, float):
+        try:
+            return number_type(value)
+        except (TypeError, ValueError):
+            pass
+    return None
 
+
+def humanized(value):
+    '''Abbreviate a number of bytes in the style of zfs list, e.g. 12.1K.'''
+    number = to_number(value)
+    if number is None or number < 1024:
+        return value
+
+    index = 0
+    while number >= 1024 and index < 6:
+        number /= 1024.0
+        index += 1
+    suffix = 'KMGTPE'[index - 1]
+
+    if number == int(number):
+        return '%d%s' % (number, suffix)
+    # three significant digits
+    for digits in (2, 1, 0):
+        if number < 10 ** (3 - digits):
+            return '%.*f%s' % (digits, number, suffix)
+
+
+def parse_size(value):
+    '''Parse a number of bytes, which may be abbreviated as by humanized().'''
+    number, power = value, 0
+    if value[-1:].upper() in list('KMGTPE'):
+        number, power = value[:-1], 'KMGTPE'.index(value[-1].upper()) + 1
+    number = to_number(number)
+    if number is None or number < 0:
+        raise ZzzFSException('%s: invalid size' % value)
+    return int(number * 1024 ** power)
+
+
+def tabulated(data, headers, scriptable_mode=False, sort_asc=[], sort_desc=[],
+              parsable=False, output_format='table'):
+    '''Generates printable table lines given data (an iterable of dicts) and
+    an array of field names for headers. Unless sorting or column alignment
+    requires all of the data at once, lines are generated as data arrives.
+    Numeric fields are abbreviated unless parsable is set. output_format may
+    also be 'json' (a JSON array of objects) or 'ndjson' (one JSON object per
+    line).
+    '''
     types = list(headers.types)
     names = list(headers.names)
 
-    row_format = '\t'.join('%s' for i in range(len(names)))
-    if not scriptable_mode:
-        # For evenly-spaced columns, left-align each text field (right-align
-        # each numeric field) in a cell that's big enough for the longest value
-        # in each column.
-        data_and_headers = data + [dict(zip(names, names))]
-        cells = []
-        for i in range(len(names)):
-            box_width = max(len(r.get(names[i]) or '-') for r in data_and_headers)
-            if types[i] == str:
-                box_width *= -1  # negative field width means left-align
-            cells.append('%%%ds' % box_width)
-        row_format = '\t'.join(cells)
-
     # sort by specified fields, if any
     for field in sort_asc + sort_desc:
         if field not in names:
             raise ZzzFSException('%s: no such column' % field)
 
-    for field in sort_asc:
-        data = sorted(data, key=lambda row: row[field])
+    if sort_asc or sort_desc:
+        # Fields are applied left to right, ascending then descending, so the
+        # last field given is the most significant. Numeric fields compare as
+        # numbers; missing values sort after all others.
+        fields = [(f, False) for f in sort_asc] + [(f, True) for f in sort_desc]
+        fields.reverse()
+        numeric = dict((n, t is int) for n, t in zip(names, types))
 
-    for field in sort_desc:
-        data = list(reversed(sorted(data, key=lambda row: row[field])))
+        def sort_key(row):
+            key = []
+            for field, descending in fields:
+                value = row.get(field)
+                if numeric[field]:
+                    value = to_number(value)
+                item = (value is None, value if value is not None else '')
+                key.append(Descending(item) if descending else item)
+            return key
 
-    # Add individual data rows.
-    output = '\n'.join(
-        row_format % tuple(row.get(names[i]) or '-' for i in range(len(names)))
-        for row in data)
+        data = sorted(data, key=sort_key)
+
+    if output_format in ('json', 'ndjson'):
+        return OutputLines(jsonified(data, names, types, output_format))
+
+    def cells(row):
+        for name, col_type in zip(names, types):
+            value = row.get(name)
+            if not value:
+                yield '-'
+            elif col_type is int and not parsable:
+                yield humanized(value)
+            else:
+                yield value
+
+    if scriptable_mode:
+        # no alignment needed; stream rows as they arrive
+        return OutputLines('\t'.join(cells(row)) for row in data)
+
+    # For evenly-spaced columns, left-align each text field (right-align each
+    # numeric field) in a cell that's big enough for the longest value in each
+    # column.
+    rows = [tuple(cells(row)) for row in data]
+    if len(rows) == 0:
+        return OutputLines([])
+
+    header = tuple(h.upper() for h in names)
+    formats = []
+    for i in range(len(names)):
+        box_width = max(len(r[i]) for r in rows + [header])
+        if types[i] == str:
+            box_width *= -1  # negative field width means left-align
+        formats.append('%%%ds' % box_width)
+    row_format = '\t'.join(formats)
 
     # Prepend header row in all caps.
-    if not scriptable_mode:
-        output = row_format % tuple(h.upper() for h in names) + '\n' + output
+    return OutputLines([row_format % header] + [row_format % r for r in rows])
+
+
+def jsonified(data, names, types, output_format):
+    '''Generate JSON lines for tabulated(), with exact numeric values.'''
+    def record(row):
+        obj = {}
+        for name, col_type in zip(names, types):
+            value = row.get(name)
+            if col_type is int and to_number(value) is not None:
+                value = to_number(value)
+            obj[name] = value
+        return json.dumps(obj, sort_keys=True)
+
+    if output_format == 'ndjson':
+        for row in data:
+            yield record(row)
+        return
 
-    return output
+    # a JSON array, with one object per line
+    previous = None
+    yield '['
+    for row in data:
+        if previous is not None:
+            yield previous + ','
+        previous = '  ' + record(row)
+    if previous is not None:
+        yield previous
+    yield ']'
@@ -0,0 +1,219 @@
+#!/usr/bin/env python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License, version 1.1 (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at ./LICENSE.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at ./LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+# Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
+
+#
+# A pool may be created on several disks (zzzpool create pool dir1 dir2 ...),
+# each a vdev. The first holds the pool's data as a single disk does; the
+# others are linked from the pool's root, each laid out like it:
+#
+#   <pool root>/vdevs/<n> -> <disk>/<pool_name>/
+#     data/<fs_name>/     (mountpoints of filesystems placed on the vdev)
+#     filesystems/<fs_name>/
+#
+# The pool's root filesystem is on the first vdev. Each filesystem created
+# after it is placed on a vdev by the placement property (inherited from the
+# pool, see zzzpool create -o), and its root in the pool is then a link to
+# the one on its vdev, so that its snapshots are stored on the same disk as
+# its data:
+#
+#   roundrobin  the vdev with the fewest filesystems (the default)
+#   freespace   the vdev with the most space available, per statvfs
+#   hash        by a hash of the filesystem's name, the same wherever created
+#
+# A vdev may instead be a mirror of two or more disks (zzzpool create pool
+# mirror dirA dirB). Its first disk is used as above; each other side keeps
+# a copy of the snapshots of the vdev's filesystems:
+#
+#   <pool root>/mirrors/<n>/<side> -> <disk>/<pool_name>/
+#     filesystems/<fs_name>/snapshots/<snapshot_name>/
+#
+# Snapshots are copied to every side at once as they are written (see
+# replicate), and read from whichever copy is least loaded (least_loaded).
+# zzzpool scrub checks every copy, and repairs any bad file from a good one.
+
+import os
+import stat
+import zlib
+import shutil
+import threading
+import contextlib
+import collections
+
+from libzzzfs import treecopy
+from libzzzfs.util import ZzzFSException
+
+PLACEMENT_POLICIES = ('roundrobin', 'freespace', 'hash')
+
+
+def parse_vdevs(args):
+    '''Group the disks given to zzzpool create into vdevs: each disk alone,
+    unless it follows "mirror", which groups the disks up to the next one.
+    '''
+    vdevs = []
+    mirrors = []
+    for arg in args:
+        if arg == 'mirror':
+            mirrors.append([])
+            vdevs.append(mirrors[-1])
+        elif mirrors:
+            mirrors[-1].append(arg)
+        else:
+            vdevs.append([arg])
+    if any(len(disks) < 2 for disks in mirrors):
+        raise ZzzFSException('a mirror needs at least two disks')
+    return vdevs
+
+
+def parse_placement(value):
+    '''Return the policy named by a placement property value.'''
+    if value is None:
+        return 'roundrobin'
+    if value not in PLACEMENT_POLICIES:
+        raise ZzzFSException(
+            '%s: invalid placement (expected one of %s)' % (
+                value, ', '.join(PLACEMENT_POLICIES)))
+    return value
+
+
+def available(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def choose(policy, vdevs, name, counts):
+    '''Return the index of the vdev (of the paths given) on which to place a
+    new filesystem, given how many filesystems each already has.
+    '''
+    if policy == 'hash':
+        return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % len(vdevs)
+    if policy == 'freespace':
+        space = [available(vdev) for vdev in vdevs]
+        return space.index(max(space))
+    return counts.index(min(counts))
+
+
+def usage(path):
+    '''Return (size, alloc, free) in bytes for the vdev whose directory is
+    path: the size of its disk and the space available there, and how much
+    of it the directory's files occupy (hardlinked files once).
+    '''
+    st = os.statvfs(path)
+    seen = set()
+    alloc = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            file_st = os.lstat(os.path.join(dirpath, name))
+            if (file_st.st_dev, file_st.st_ino) in seen:
+                continue
+            seen.add((file_st.st_dev, file_st.st_ino))
+            alloc += getattr(file_st, 'st_blocks', 0) * 512
+    return (st.f_blocks * st.f_frsize, alloc, st.f_bavail * st.f_frsize)
+
+
+# reads in progress, by device, in this process
+_readers = collections.defaultdict(int)
+_readers_lock = threading.Lock()
+
+
+def _in_flight(dev):
+    # I/O requests queued on a block device (Linux only)
+    try:
+        with open('/sys/dev/block/%d:%d/inflight' % (
+                os.major(dev), os.minor(dev))) as f:
+            return sum(int(n) for n in f.read().split())
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+@contextlib.contextmanager
+def least_loaded(paths):
+    '''Choose among paths to copies of the same data the one on the least
+    loaded device: with the fewest reads by this process, then the fewest
+    requests queued. Ties go to the first. Counts as a read of that device
+    for as long as the context lasts.
+    '''
+    devices = [os.stat(path).st_dev for path in paths]
+    load = [_in_flight(dev) for dev in devices]
+    with _readers_lock:
+        i = min(range(len(paths)),
+                key=lambda i: (_readers[devices[i]], load[i], i))
+        _readers[devices[i]] += 1
+    try:
+        yield paths[i]
+    finally:
+        with _readers_lock:
+            _readers[devices[i]] -= 1
+
+
+def replicate(src, dst, base=None):
+    '''Copy a snapshot's root to dst, on another side of a mirror, moving it
+    into place once complete. Given base, (an earlier snapshot's root, its
+    copy on that side), files src shares with the earlier snapshot are
+    linked to their copies there too.
+    '''
+    partial = os.path.join(
+        os.path.dirname(dst), '.%s.partial' % os.path.basename(dst))
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    elif not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+
+    def copy(src_path, dst_path, st):
+        if base is not None:
+            relpath = os.path.relpath(src_path, src)
+            try:
+                if os.path.samestat(
+                        st or os.stat(src_path),
+                        os.stat(os.path.join(base[0], relpath))):
+                    os.link(os.path.join(base[1], relpath), dst_path)
+                    return 0
+            except OSError:  # not in the earlier snapshot
+                pass
+        return treecopy.copy_file(src_path, dst_path, st)
+
+    treecopy.copytree(src, partial, symlinks=True, copy_function=copy)
+    os.rename(partial, dst)
+
+
+def repair(path, copies, verify):
+    '''Rewrite a bad file in place (so that any hardlinks to it are repaired
+    too) from the first of its copies for which verify(copy) is true,
+    returning the number of bytes written, or None if none was good.
+    '''
+    for copy in copies:
+        if not verify(copy):
+            continue
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            return treecopy.copy_file(copy, path)
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        os.chmod(path, mode | stat.S_IWUSR)
+        with open(copy, 'rb') as fsrc:
+            with open(path, 'r+b') as fdst:
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst)
+                written = fdst.tell()
+        shutil.copystat(copy, path)
+        return written
+    return None
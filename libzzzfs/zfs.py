@@ -21,19 +21,75 @@
 
 # Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
 
-import os
 import sys
 import shutil
-import filecmp
 
+from libzzzfs import sendstream, trace
+from libzzzfs.autosnap import TAG as AUTOSNAP_TAG
+from libzzzfs.bookmark import compare_contents
 from libzzzfs.dataset import (
-    get_all_datasets, get_dataset_by, Filesystem, Pool, Snapshot)
-from libzzzfs.util import tabulated, validate_component_name, ZzzFSException
+    get_all_datasets, get_dataset_by, Bookmark, DatasetCache, Filesystem, Pool,
+    Snapshot)
+from libzzzfs.journal import compare_trees, Watcher
+from libzzzfs.util import (
+    OutputLines, tabulated, validate_component_name, ZzzFSException)
 
 
 # Each method returns a string to be written to stdout, or a dataset (or list
 # of datasets) affected by the command.
 
+def autosnap(action, filesystems, dry_run=False):
+    '''Take the automatic snapshots due for filesystems with
+    com.sun:auto-snapshot=true (of all pools, or those given and their
+    descendants), and prune the oldest beyond what each frequency keeps.
+    With dry_run, list what would be done instead.
+    '''
+    if filesystems:
+        datasets = []
+        for name in filesystems:
+            dataset = get_dataset_by(name, should_be=Filesystem)
+            datasets += [dataset] + dataset.get_children()
+    else:
+        datasets = [filesystem for pool in Pool.all()
+                    for filesystem in pool.get_filesystems()]
+
+    pools = {}
+    for dataset in datasets:
+        if dataset.get_property(AUTOSNAP_TAG) == 'true':
+            filesystems = pools.setdefault(dataset.pool.name, {})
+            filesystems[dataset.name] = dataset
+
+    taken, destroyed = [], []
+    for pool_name, filesystems in sorted(pools.items()):
+        due, doomed = DatasetCache.handle(Pool, pool_name).autosnap(
+            [filesystems[name] for name in sorted(filesystems)],
+            dry_run=dry_run)
+        taken += due
+        destroyed += doomed
+
+    if dry_run:
+        return OutputLines(
+            ['snapshot %s' % snapshot.full_name for snapshot in taken] +
+            ['destroy %s' % snapshot.full_name for snapshot in destroyed])
+    return taken + destroyed
+
+
+def bookmark(snapshot, bookmark):
+    '''Keep what an incremental send from a snapshot needs to know of it, as
+    a bookmark, which remains usable once the snapshot is destroyed.
+    '''
+    dataset1 = get_dataset_by(snapshot, should_be=Snapshot)
+    if bookmark.startswith('#'):
+        bookmark = dataset1.filesystem.name + bookmark
+    dataset2 = get_dataset_by(
+        bookmark, should_be=Bookmark, should_exist=False)
+    if dataset1.filesystem.name != dataset2.filesystem.name:
+        raise ZzzFSException('mismatched filesystems')
+
+    dataset2.create(dataset1)
+    return [dataset1, dataset2]
+
+
 def clone(snapshot, filesystem):
     '''Turn a snapshot into a filesystem with a new name.'''
     dataset1 = get_dataset_by(snapshot, should_be=Snapshot)
@@ -46,6 +102,20 @@ def clone(snapshot, filesystem):
     return [dataset1, dataset2]
 
 
+def copy(snapshot, filesystem, replicate=False):
+    '''Create a filesystem from a snapshot, as zzzfs send piped through
+    zzzfs receive would, but by copying directly, for pools on the same host.
+    With replicate, copy as zzzfs send -R would send.
+    '''
+    dataset1 = get_dataset_by(snapshot, should_be=Snapshot)
+    dataset2 = get_dataset_by(
+        filesystem, should_be=Filesystem, should_exist=False)
+    if replicate:
+        return dataset2.copy_replication(dataset1)
+    dataset2.copy_snapshots([dataset1])
+    return dataset2
+
+
 def create(filesystem, create_parents, properties):
     '''Create a filesystem.'''
     dataset = get_dataset_by(
@@ -59,9 +129,12 @@ def create(filesystem, create_parents, properties):
 
 
 def destroy(filesystem, recursive):
-    '''Remove a filesystem.'''
-    dataset = get_dataset_by(filesystem, should_be=Filesystem)
-    dataset.destroy(recursive)
+    '''Remove a filesystem, snapshot or bookmark.'''
+    dataset = get_dataset_by(filesystem)
+    if isinstance(dataset, Filesystem):
+        dataset.destroy(recursive)
+    else:
+        dataset.destroy()
     return dataset
 
 
@@ -82,25 +155,36 @@ def diff(identifier, other_identifier):
     #    raise ZzzFSException(
     #        '%s: cannot compare to a different filesystem' % identifier)
 
-    output = []
-    def do_diff(dcmp):
-        # trim off pool root from diff output
-        base_path = dcmp.left[len(dataset1.data)+1:]
-        for name in dcmp.diff_files:
-            output.append('M\t%s' % os.path.join(base_path, name))
-        for name in dcmp.left_only:
-            output.append('-\t%s' % os.path.join(base_path, name))
-        for name in dcmp.right_only:
-            output.append('+\t%s' % os.path.join(base_path, name))
-        for sub_dcmp in dcmp.subdirs.values():
-            do_diff(sub_dcmp)
-    do_diff(filecmp.dircmp(dataset1.data, dataset2.data))
-
-    return '\n'.join(output)
+    # with a change journal, only the paths changed since need comparing
+    changes = None
+    if isinstance(dataset2, Filesystem) and (
+            dataset2.name == dataset1.filesystem.name) and (
+            dataset1.journal_mark is not None):
+        changes = dataset2.journal.changes_between(
+            dataset1.journal_mark, dataset2.journal.sync())
+    elif isinstance(dataset2, Snapshot) and (
+            dataset2.filesystem.name == dataset1.filesystem.name):
+        changes = dataset2.changes_since(dataset1)
+
+    if any(isinstance(dataset, Snapshot) and dataset.is_archived()
+           for dataset in (dataset1, dataset2)):
+        # compared by its catalog, rather than extracting its archive
+        with dataset1.contents() as left:
+            with dataset2.contents() as right:
+                with trace.phase('walk'):
+                    return '\n'.join('%s\t%s' % difference for difference in (
+                        compare_contents(left, right, changes)))
+
+    with dataset1.data_tree() as data1:
+        with dataset2.data_tree() as data2:
+            with trace.phase('walk'):
+                return '\n'.join(
+                    '%s\t%s' % difference
+                    for difference in compare_trees(data1, data2, changes))
 
 
 def get(properties, identifiers, headers, sources, scriptable_mode, recursive,
-        max_depth, types):
+        max_depth, types, parsable=False, output_format='table'):
     '''Get a set of properties for a set of datasets.'''
     all_headers = ['name', 'property', 'value', 'source']
     if headers.items == ['all']:
@@ -108,30 +192,33 @@ def get(properties, identifiers, headers, sources, scriptable_mode, recursive,
     headers.validate_against(all_headers)
     sources.validate_against(['local', 'inherited'])
 
-    attrs = []
-    for dataset in get_all_datasets(identifiers, types, recursive, max_depth):
-        if properties.items == ['all']:
-            if 'local' in sources.items:
-                for key, val in dataset.get_local_properties().items():
-                    attrs.append({
-                        'name': dataset.name, 'property': key, 'value': val,
-                        'source': 'local'})
-
-            if 'inherited' in sources.items:
-                for key, val in dataset.get_inherited_properties().items():
-                    attrs.append({
-                        'name': dataset.name, 'property': key, 'value': val,
-                        'source': 'inherited'})
-
-        else:
-            for p in properties.items:
-                val, source = dataset.get_property_and_source(p)
-                if source in sources.items:
-                    attrs.append({
-                        'name': dataset.name, 'property': p, 'value': val,
-                        'source': source})
-
-    return tabulated(attrs, headers, scriptable_mode)
+    def attrs():
+        for dataset in get_all_datasets(
+                identifiers, types, recursive, max_depth):
+            if properties.items == ['all']:
+                if 'local' in sources.items:
+                    for key, val in dataset.get_local_properties().items():
+                        yield {
+                            'name': dataset.name, 'property': key,
+                            'value': val, 'source': 'local'}
+
+                if 'inherited' in sources.items:
+                    for key, val in dataset.get_inherited_properties().items():
+                        yield {
+                            'name': dataset.name, 'property': key,
+                            'value': val, 'source': 'inherited'}
+
+            else:
+                for p in properties.items:
+                    val, source = dataset.get_property_and_source(p)
+                    if source in sources.items:
+                        yield {
+                            'name': dataset.name, 'property': p, 'value': val,
+                            'source': source}
+
+    return tabulated(
+        attrs(), headers, scriptable_mode, parsable=parsable,
+        output_format=output_format)
 
 
 def inherit(property, identifiers):
@@ -141,22 +228,21 @@ def inherit(property, identifiers):
 
     datasets = [get_dataset_by(identifier) for identifier in identifiers]
     for dataset in datasets:
-        try:
-            os.remove(os.path.join(dataset.properties, property))
-        except OSError:
-            # property was not set locally
-            pass
+        # no-op if property was not set locally
+        dataset.remove_local_property(property)
     return datasets
 
 
 def list(identifiers, types, scriptable_mode, headers, recursive, max_depth,
-         sort_asc, sort_desc):
+         sort_asc, sort_desc, parsable=False, output_format='table'):
     '''Tabulate a set of properties for a set of datasets.'''
-    records = []
-    for d in get_all_datasets(identifiers, types, recursive, max_depth):
-        records.append(dict((h, d.get_property(h)) for h in headers.names))
+    records = (
+        dict((h, d.get_property(h)) for h in headers.names)
+        for d in get_all_datasets(identifiers, types, recursive, max_depth))
 
-    return tabulated(records, headers, scriptable_mode, sort_asc, sort_desc)
+    return tabulated(
+        records, headers, scriptable_mode, sort_asc, sort_desc, parsable,
+        output_format)
 
 
 def promote(clone_filesystem):
@@ -168,33 +254,40 @@ def promote(clone_filesystem):
     return dataset
 
 
-def receive(filesystem, stream=sys.stdin):
+def receive(filesystem, stream=sys.stdin, resumable=False, abort=False):
     '''Create a new filesystem pre-populated with the contens of a snapshot
-    sent via zzzfs send piped through stdin.
+    sent via zzzfs send piped through stdin, add a snapshot sent with
+    zzzfs send -i to an existing filesystem, or finish an interrupted
+    receive -s with what zzzfs send -t sends.
     '''
     dataset = get_dataset_by(
-        filesystem, should_be=Filesystem, should_exist=False)
-    dataset.create(from_stream=stream)
+        filesystem, should_be=Filesystem, should_exist=None)
+    if abort:
+        dataset.abort_receive()
+    else:
+        dataset.receive(stream, resumable)
     return dataset
 
 
 def rename(identifier, other_identifier):
     '''Move or rename the dataset.'''
     dataset1 = get_dataset_by(identifier)
-    dataset2 = None  # may be filesystem or snapshot, will check below
+    dataset2 = None  # may be filesystem, snapshot or bookmark; checked below
 
-    if isinstance(dataset1, Snapshot):
-        if not '@' in other_identifier:
+    if isinstance(dataset1, (Snapshot, Bookmark)):
+        separator = '@' if isinstance(dataset1, Snapshot) else '#'
+        if not separator in other_identifier:
             # second argument might be snapshot alone, which we'd interpret as
             # a filesystem; e.g. "rename fs@snapshot new_snapshot"
-            other_identifier = '%s@%s' % (
-                dataset1.filesystem.name, other_identifier)
+            other_identifier = '%s%s%s' % (
+                dataset1.filesystem.name, separator, other_identifier)
 
         # re-identify with should_exist
         dataset2 = get_dataset_by(
-            other_identifier, should_be=Snapshot, should_exist=False)
+            other_identifier, should_be=dataset1.__class__,
+            should_exist=False)
 
-        # both snapshots
+        # both snapshots (or bookmarks)
         if dataset1.filesystem.name != dataset2.filesystem.name:
             raise ZzzFSException('mismatched filesystems')
 
@@ -205,7 +298,7 @@ def rename(identifier, other_identifier):
         if dataset1.pool.name != dataset2.pool.name:
             raise ZzzFSException('cannot rename to different pool')
 
-    # same procedure whether filesystem or snapshot
+    # same procedure whether filesystem, snapshot or bookmark
     dataset1.rename(dataset2)
     return [dataset1, dataset2]
 
@@ -217,10 +310,56 @@ def rollback(snapshot):
     return dataset
 
 
-def send(snapshot, stream=sys.stdout):
-    '''Create a gzipped tarball of a snapshot and write it to sdout.'''
+def send(snapshot=None, incremental_from=None, stream=sys.stdout,
+         resume_token=None, replicate=False, dedup=False):
+    '''Serialize a snapshot, or its differences from an earlier snapshot (or
+    a bookmark of one), and write it to sdout; or write what an interrupted
+    receive is missing, per its resume token. With replicate, the snapshot's
+    filesystem is sent with all of its descendants, properties and earlier
+    snapshots. With dedup, files identical to one sent earlier in the stream
+    are sent as references.
+    '''
+    if resume_token:
+        if snapshot or incremental_from:
+            raise ZzzFSException('cannot give a snapshot with a resume token')
+        token = sendstream.decode_token(resume_token)
+        dataset = get_dataset_by(token['snapshot'], should_be=Snapshot)
+        since = None
+        if token['from']:
+            # or a bookmark of it, once the snapshot itself is destroyed
+            since = dataset.filesystem.find_incremental_source(
+                token['from'].split('@', 1)[1])
+            if since is None:
+                raise ZzzFSException('%s: no such dataset' % token['from'])
+        dataset.to_stream(stream, since, resume={
+            'members': token['members'], 'offset': token['offset']},
+            dedup=token.get('dedup', False))
+        return dataset
+
+    if not snapshot:
+        raise ZzzFSException('missing snapshot')
     dataset = get_dataset_by(snapshot, should_be=Snapshot)
-    dataset.to_stream(stream)
+    if replicate:
+        if incremental_from:
+            raise ZzzFSException('cannot combine -R with -i')
+        dataset.filesystem.to_replication_stream(
+            stream, dataset.name, dedup)
+        return dataset
+
+    since = None
+    if incremental_from:
+        if incremental_from[:1] in ('@', '#'):
+            incremental_from = dataset.filesystem.name + incremental_from
+        since = get_dataset_by(incremental_from)
+        if isinstance(since, Filesystem):
+            raise ZzzFSException(
+                '%s: not a snapshot or bookmark' % incremental_from)
+        if since.filesystem.name != dataset.filesystem.name:
+            raise ZzzFSException(
+                '%s: not a snapshot of %s' % (
+                    incremental_from, dataset.filesystem.name))
+
+    dataset.to_stream(stream, since, dedup=dedup)
     return dataset
 
 
@@ -243,3 +382,12 @@ def snapshot(snapshots, properties):
         for keyval in properties:
             dataset.add_local_property(keyval.key, keyval.val)
         yield dataset
+
+
+def watch(filesystem):
+    '''Record changes to a filesystem in its change journal until
+    interrupted, so that snapshot, diff and send -i need only look at what
+    changed.
+    '''
+    dataset = get_dataset_by(filesystem, should_be=Filesystem)
+    Watcher(dataset.journal, dataset.mountpoint).run()
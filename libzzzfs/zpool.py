@@ -21,14 +21,38 @@
 
 # Copyright (c) 2015 Daniel W. Steinbrook. All rights reserved.
 
+from libzzzfs import vdev
 from libzzzfs.dataset import Pool
-from libzzzfs.util import tabulated, ZzzFSException
+from libzzzfs.history import parse_date
+from libzzzfs.util import (
+    humanized, OutputLines, tabulated, ZzzFSException)
 
 
-def create(pool_name, disk):
-    '''Add a pool in the specified directory.'''
+def get_pools(pool_names):
+    '''Get the named pools (or all pools), after finishing or undoing any
+    operations on them that were interrupted by a crash.
+    '''
+    pools = Pool.all()
+    if pool_names:
+        pools = [Pool(p, should_exist=True) for p in pool_names]
+
+    for pool in pools:
+        pool.recover_intents()
+    return pools
+
+
+def create(pool_name, disks, properties=()):
+    '''Add a pool in the specified directories, one per vdev unless grouped
+    into mirrors (e.g. "mirror dir1 dir2").
+    '''
     pool = Pool(pool_name, should_exist=False)
-    pool.create(disk)
+    pool.create(vdev.parse_vdevs(disks))
+    try:
+        for keyval in properties:
+            pool.add_local_property(keyval.key, keyval.val)
+    except ZzzFSException:
+        pool.destroy()
+        raise
     return pool
 
 
@@ -37,29 +61,105 @@ def destroy(pool_name):
     Pool(pool_name, should_exist=True).destroy()
 
 
-def history(pool_names, long_format):
-    pools = Pool.all()
-    if pool_names:
-        pools = [Pool(p, should_exist=True) for p in pool_names]
+def dedup(pool_name, rate=None):
+    '''Replace identical files in the pool's snapshots with hardlinks.'''
+    pool = get_pools([pool_name])[0]
+    linked, reclaimed = pool.deduplicate(rate)
+    return 'linked %d files, reclaimed %s' % (linked, humanized(reclaimed))
+
+
+def gc(pool_name):
+    '''Remove data no longer used by any snapshot in the pool.'''
+    pool = get_pools([pool_name])[0]
+    chunks, freed = pool.collect_garbage()
+    return 'freed %d chunks (%s), dedup ratio %.2fx' % (
+        chunks, humanized(freed), pool.dedup_ratio())
 
-    output = []
-    for pool in pools:
-        # Each pool will have at least one history record (zzzpool create).
-        output.append('History for %r:' % pool.name)
-        output += pool.get_history(long_format)
 
-    return '\n'.join(output)
+def history(pool_names, long_format, since=None, until=None, tail=None):
+    '''Display pool command history, optionally limited to a date range and
+    then to the last few records of each pool.
+    '''
+    if since:
+        since = parse_date(since)
+    if until:
+        until = parse_date(until, end_of_day=True)
+    if tail is not None and tail < 1:
+        raise ZzzFSException('%d: invalid number of records' % tail)
 
+    pools = get_pools(pool_names)
 
-def list(pool_name, headers, scriptable_mode):
-    '''List all pools.'''
+    def output():
+        for pool in pools:
+            # Each pool will have at least one history record (zzzpool create).
+            yield 'History for %r:' % pool.name
+            for line in pool.get_history(long_format, since, until, tail):
+                yield line
+
+    return OutputLines(output())
+
+
+def list(pool_name, headers, scriptable_mode, parsable=False,
+         output_format='table', verbose=False):
+    '''List all pools, and with verbose, the usage of each of their vdevs.'''
     headers.validate_against([
-        'name', 'size', 'alloc', 'free', 'cap', 'health', 'altroot'])
+        'name', 'size', 'alloc', 'free', 'cap', 'dedup', 'health', 'altroot'])
 
-    pools = Pool.all()
-    if pool_name:
-        pools = [Pool(pool_name, should_exist=True)]
+    pools = get_pools([pool_name] if pool_name else [])
+    # reading every snapshot's manifest, only if asked to
+    want_dedup = 'dedup' in headers.names
+
+    def records():
+        for p in pools:
+            record = {'name': p.name, 'health': 'ONLINE'}
+            if want_dedup:
+                record['dedup'] = '%.2fx' % p.dedup_ratio()
+            yield record
+            if not verbose:
+                continue
+            for i, disks in enumerate(p.vdev_usage()):
+                indent = '  '
+                if len(disks) > 1:
+                    yield {'name': '  mirror-%d' % i, 'health': 'ONLINE'}
+                    indent = '    '
+                for disk, size, alloc, free in disks:
+                    yield {
+                        'name': indent + disk, 'size': size, 'alloc': alloc,
+                        'free': free, 'cap': '%d%%' % (100 * alloc // size),
+                        'health': 'ONLINE'}
 
     return tabulated(
-        [{'name': p.name, 'health': 'ONLINE'} for p in pools], headers,
-        scriptable_mode)
+        records(), headers, scriptable_mode, parsable=parsable,
+        output_format=output_format)
+
+
+def scrub(pool_name, rate=None):
+    '''Verify the pool's snapshots against their checksums, resuming an
+    interrupted scrub.
+    '''
+    pool = get_pools([pool_name])[0]
+    pool.scrub(rate)
+    return OutputLines(pool.status(verbose=True))
+
+
+def status(pool_names, verbose=False):
+    '''Display the health of pools, and the progress of their scrubs.'''
+    pools = get_pools(pool_names)
+
+    def output():
+        for i, pool in enumerate(pools):
+            if i:
+                yield ''
+            for line in pool.status(verbose):
+                yield line
+
+    return OutputLines(output())
+
+
+def tier(pool_name):
+    '''Move snapshots to the pool's cold tier, per its coldtier, coldage and
+    hotsize properties.
+    '''
+    pool = get_pools([pool_name])[0]
+    return OutputLines(
+        'archived %s' % snapshot.full_name for snapshot in pool.tier())
@@ -23,6 +23,10 @@
 
 import io
 import os
+import errno
+import json
+import time
+import datetime
 import uuid
 import shutil
 import random
@@ -30,10 +34,15 @@ import tempfile
 import unittest
 import multiprocessing
 
-from libzzzfs import zfs
-from libzzzfs.dataset import get_dataset_by
+from libzzzfs import chunkstore, dedup, treecopy, zfs
+from libzzzfs.dataset import (
+    get_all_datasets, get_dataset_by, DatasetCache, Filesystem, Snapshot)
+from libzzzfs.dedup import Deduplicator
+from libzzzfs.history import PoolHistory
+from libzzzfs.intent import IntentLog
+from libzzzfs.util import PropertyList
 from libzzzfs.util import ZzzFSException
-from libzzzfs.cmd.zzzfs import zzzfs_main
+from libzzzfs.cmd.zzzfs import zzzfs_main, zzzfs_program
 from libzzzfs.cmd.zzzpool import zzzpool_main
 
 
@@ -107,6 +116,108 @@ class ZPoolTest(ZzzFSTestBase):
         # re-create, so tearDown won't complain
         zzzcmd('zzzpool create foo ' + self.zroot1)
 
+    def test_zpool_vdevs(self):
+        disks = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        zzzcmd('zzzpool create baz %s %s' % tuple(disks))
+        try:
+            for fs in ('a', 'b', 'c', 'b/d'):
+                zzzcmd('zzzfs create baz/' + fs)
+            # spread across the vdevs, children placed independently
+            self.assertEqual(
+                [os.path.join(disks[0], 'baz', 'a'),
+                 os.path.join(disks[1], 'baz', 'data', 'b'),
+                 os.path.join(disks[0], 'baz', 'c'),
+                 os.path.join(disks[1], 'baz', 'data', 'b', 'd')],
+                [get_dataset_by('baz/' + fs).mountpoint
+                 for fs in ('a', 'b', 'c', 'b/d')])
+
+            # snapshots are kept on the same disk as the filesystem
+            with open(os.path.join(disks[1], 'baz', 'data', 'b', 'f'),
+                      'w') as f:
+                f.write('contents')
+            zzzcmd('zzzfs snapshot baz/b@first')
+            zzzcmd('zzzfs rename baz/b/d baz/e')
+            self.assertTrue(treecopy.same_device(
+                get_dataset_by('baz/b@first').data, disks[1]))
+            self.assertTrue(get_dataset_by('baz/e').mountpoint.startswith(
+                disks[1]))
+
+            lines = zzzcmd('zzzpool list -H -v -o name,health baz').split('\n')
+            self.assertEqual(
+                ['baz\tONLINE', '  %s\tONLINE' % disks[0],
+                 '  %s\tONLINE' % disks[1]], lines)
+
+            zzzcmd('zzzpool destroy baz')
+            self.assertEqual([[], []], [os.listdir(d) for d in disks])
+        finally:
+            for disk in disks:
+                shutil.rmtree(disk)
+
+    def test_zpool_mirror(self):
+        disks = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        zzzcmd('zzzpool create baz mirror %s %s' % tuple(disks))
+        try:
+            zzzcmd('zzzfs create baz/a')
+            a_path = os.path.join(disks[0], 'baz', 'a')
+            self.populate_randomly(a_path)
+            with open(os.path.join(a_path, 'file'), 'w') as f:
+                f.write('contents')
+            zzzcmd('zzzfs snapshot baz/a@first')
+
+            # written to both sides
+            snapshot = get_dataset_by('baz/a@first')
+            replica = os.path.join(
+                disks[1], 'baz', 'filesystems', 'baz%a', 'snapshots', 'first')
+            self.assertEqual(
+                [replica],
+                [os.path.realpath(r) for r in snapshot.replica_roots])
+            self.assertEqual(
+                self.all_files_in(snapshot.data),
+                self.all_files_in(os.path.join(replica, 'data')))
+
+            # a bad copy on either side is repaired from the other
+            for root in (snapshot.root, replica):
+                with open(os.path.join(root, 'data', 'file'), 'w') as f:
+                    f.write('CONTENTS')
+                status = zzzcmd('zzzpool scrub baz')
+                self.assertIn('scrub repaired 8 in', status)
+                self.assertIn('No known data errors', status)
+                with open(os.path.join(root, 'data', 'file')) as f:
+                    self.assertEqual('contents', f.read())
+
+            lines = zzzcmd('zzzpool list -H -v -o name baz').split('\n')
+            self.assertEqual(
+                ['baz', '  mirror-0', '    ' + disks[0], '    ' + disks[1]],
+                lines)
+            zzzcmd('zzzfs rename baz/a@first second')
+            zzzcmd('zzzfs destroy baz/a@second')
+            self.assertEqual([], os.listdir(os.path.dirname(replica)))
+        finally:
+            zzzcmd('zzzpool destroy baz')
+            for disk in disks:
+                shutil.rmtree(disk)
+
+    def test_zpool_placement(self):
+        disks = [tempfile.mkdtemp() for i in range(3)]
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzpool create -o placement=random baz ' + disks[0])
+        zzzcmd('zzzpool create -o placement=hash baz %s %s %s' % tuple(disks))
+        try:
+            for fs in ('a', 'b', 'c', 'd'):
+                zzzcmd('zzzfs create baz/' + fs)
+            # hashed names land on the same vdev wherever created
+            vdevs = [get_dataset_by('baz/' + fs).vdev
+                     for fs in ('a', 'b', 'c', 'd')]
+            zzzcmd('zzzfs destroy baz/a')
+            zzzcmd('zzzfs create baz/a')
+            self.assertEqual(vdevs[0], get_dataset_by('baz/a').vdev)
+            self.assertEqual(
+                'hash', zzzcmd('zzzfs get -H -o value placement baz/a'))
+        finally:
+            zzzcmd('zzzpool destroy baz')
+            for disk in disks:
+                shutil.rmtree(disk)
+
     def test_zpool_history(self):
         self.assertIn('zzzpool create foo', zzzcmd('zzzpool history foo'))
 
@@ -128,6 +239,69 @@ class ZPoolTest(ZzzFSTestBase):
         self.assertEqual(
             zzzcmd('zzzpool history foo').count('zzzfs snapshot'), 1)
 
+    def test_zpool_history_segments(self):
+        # replace the pool's history with a long synthetic one
+        history = PoolHistory(get_dataset_by('foo').pool.history)
+        shutil.rmtree(history.path)
+        history.INDEX_INTERVAL = 4
+        history.SEGMENT_SIZE = 512
+        history.append([
+            ['2015-%02d-01.00:00:%02d' % (1 + n // 30, n % 30),
+             'zzzfs set n=%d foo' % n, 'user', 'host'] for n in range(100)])
+        # rotated both by size and by month
+        self.assertGreater(len(history.read_index()), 4)
+        self.assertEqual(
+            ['zzzfs set n=97 foo', 'zzzfs set n=98 foo', 'zzzfs set n=99 foo'],
+            [e[1] for e in history.events(tail=3)])
+
+        output = zzzcmd(
+            'zzzpool history --since 2015-02-01.00:00:28 '
+            '--until 2015-03-01.00:00:00 foo').split('\n')
+        self.assertEqual(output[0], "History for 'foo':")
+        self.assertEqual([
+            '2015-02-01.00:00:28 zzzfs set n=58 foo',
+            '2015-02-01.00:00:29 zzzfs set n=59 foo',
+            '2015-03-01.00:00:00 zzzfs set n=60 foo'], output[1:])
+        self.assertEqual(101, len(zzzcmd('zzzpool history foo').split('\n')))
+        # a date alone includes everything logged that day
+        output = zzzcmd(
+            'zzzpool history --since 2015-03-01 '
+            '--until 2015-03-01 foo').split('\n')
+        self.assertEqual(31, len(output))
+        self.assertEqual(
+            '2015-03-01.00:00:29 zzzfs set n=89 foo', output[-1])
+
+        zzzcmd('zzzfs create foo/subfs')
+        output = zzzcmd('zzzpool history --tail 1 foo').split('\n')
+        self.assertEqual(2, len(output))
+        self.assertTrue(output[1].endswith(' zzzfs create foo/subfs'))
+
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzpool history --since yesterday foo')
+
+    def test_zpool_history_legacy(self):
+        # history used to be kept in a single CSV file
+        pool = get_dataset_by('bar').pool
+        shutil.rmtree(pool.history)
+        with open(pool.history, 'w') as f:
+            f.write('2015-01-13.22:32:38,zzzpool create bar /tmp/pool,u,h\n')
+        self.assertIn('zzzpool create bar', zzzcmd('zzzpool history bar'))
+
+        zzzcmd('zzzfs create bar/subfs')
+        self.assertTrue(os.path.isdir(pool.history))
+        self.assertEqual([
+            "History for 'bar':",
+            '2015-01-13.22:32:38 zzzpool create bar /tmp/pool'],
+            zzzcmd('zzzpool history --until 2015-01-14 bar').split('\n'))
+        self.assertIn('zzzfs create bar/subfs', zzzcmd('zzzpool history bar'))
+
+        # a process finding the file unsplit, but only getting to split it
+        # once another process has, leaves it be
+        PoolHistory(pool.history).split_legacy_file()
+        self.assertTrue(os.path.isdir(pool.history))
+        self.assertFalse(os.path.exists(pool.history + '.legacy'))
+        self.assertIn('zzzfs create bar/subfs', zzzcmd('zzzpool history bar'))
+
     def test_zpool_list(self):
         self.assertIn('foo', zzzcmd('zzzpool list -H'))
         self.assertIn('bar', zzzcmd('zzzpool list -H'))
@@ -144,6 +318,115 @@ class ZPoolTest(ZzzFSTestBase):
         with self.assertRaises(ZzzFSException):
             zzzcmd('zzzpool list baz')
 
+    def test_zpool_dedup(self):
+        big, small = os.urandom(100 << 10), os.urandom(50 << 10)
+        for fs in ('a', 'b'):
+            zzzcmd('zzzfs create foo/' + fs)
+            contents = {
+                'big': big, 'small': small,
+                # alike, but not beyond what's compared by the partial hash
+                'tail': big[:-1] + fs.encode('ascii')}
+            for name, data in contents.items():
+                path = os.path.join(self.zroot1, 'foo', fs, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                # hardlinks share metadata, so it must match too
+                os.utime(path, (0, 0))
+        zzzcmd('zzzfs snapshot foo/a@first foo/b@first')
+        a = get_dataset_by('foo/a@first')
+        b = get_dataset_by('foo/b@first')
+
+        # interrupted after the first (largest) files, then resumed
+        checkpoint = os.path.join(a.pool.root, 'dedup', 'checkpoint')
+        link = Deduplicator.link
+        def interrupted(deduplicator, files):
+            if deduplicator.linked:
+                raise KeyboardInterrupt
+            link(deduplicator, files)
+        Deduplicator.link = interrupted
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                zzzcmd('zzzpool dedup foo')
+        finally:
+            Deduplicator.link = link
+        with open(checkpoint) as f:
+            self.assertEqual(1, len(json.load(f)['done']))
+        self.assertEqual(
+            'linked 1 files, reclaimed 52K', zzzcmd('zzzpool dedup -r 1G foo'))
+        self.assertFalse(os.path.exists(checkpoint))
+
+        for name in ('big', 'small'):
+            self.assertTrue(os.path.samefile(
+                os.path.join(a.data, name), os.path.join(b.data, name)))
+        self.assertFalse(os.path.samefile(
+            os.path.join(a.data, 'tail'), os.path.join(b.data, 'tail')))
+        # live files are left alone
+        self.assertEqual(1, os.stat(
+            os.path.join(self.zroot1, 'foo', 'a', 'big')).st_nlink)
+        self.assertEqual(
+            'linked 0 files, reclaimed 0', zzzcmd('zzzpool dedup foo'))
+
+    def test_zpool_dedup_across_devices(self):
+        data = os.urandom(10 << 10)
+        for fs in ('a', 'b'):
+            zzzcmd('zzzfs create foo/' + fs)
+            path = os.path.join(self.zroot1, 'foo', fs, 'file')
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (0, 0))
+        zzzcmd('zzzfs snapshot foo/a@first foo/b@first')
+        a = get_dataset_by('foo/a@first')
+        b = get_dataset_by('foo/b@first')
+
+        # files on different vdevs are never grouped together
+        groups = dedup.scan([(a.data, None), (b.data, None)])
+        self.assertEqual(
+            [os.stat(a.data).st_dev], [key[0] for key in groups])
+
+        # and can't be linked if they were
+        link = os.link
+        def cross_device(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        os.link = cross_device
+        try:
+            self.assertEqual(
+                'linked 0 files, reclaimed 0', zzzcmd('zzzpool dedup foo'))
+        finally:
+            os.link = link
+        self.assertFalse(os.path.samefile(
+            os.path.join(a.data, 'file'), os.path.join(b.data, 'file')))
+        self.assertEqual([], [
+            name for data in (a.data, b.data) for name in os.listdir(data)
+            if name != 'file'])
+
+    def test_zpool_scrub(self):
+        zzzcmd('zzzfs create foo/a')
+        zzzcmd('zzzfs create -o dedup=on foo/d')
+        for fs in ('a', 'd'):
+            with open(os.path.join(self.zroot1, 'foo', fs, 'file'), 'wb') as f:
+                f.write(os.urandom(10 << 10))
+        zzzcmd('zzzfs snapshot foo/a@first foo/d@first')
+        self.assertIn('none requested', zzzcmd('zzzpool status foo'))
+        self.assertIn('No known data errors', zzzcmd('zzzpool scrub foo'))
+
+        # damage a snapshot file and a chunk
+        a = get_dataset_by('foo/a@first')
+        with open(os.path.join(a.data, 'file'), 'r+b') as f:
+            f.write(b'x')
+        d = get_dataset_by('foo/d@first')
+        key = chunkstore.read_manifest(d.manifest)[1]['chunks'][0]
+        with open(a.pool.chunk_store.chunk_path(key), 'r+b') as f:
+            f.write(b'x')
+
+        zzzcmd('zzzpool scrub -r 1G foo')
+        status = zzzcmd('zzzpool status foo')
+        self.assertIn('with 2 errors', status)
+        self.assertIn("use '-v' for a list", status)
+        self.assertEqual(
+            ['foo/a@first:/file', 'foo/d@first:/file'],
+            [line.strip() for line in zzzcmd(
+                'zzzpool status -v foo').split('\n')[-2:]])
+
 
 class ZFSTest(ZzzFSTestBase):
     def test_bad_dataset_names(self):
@@ -158,6 +441,28 @@ class ZFSTest(ZzzFSTestBase):
         with self.assertRaises(ZzzFSException):
             get_dataset_by('foo@bar!', should_exist=False)
 
+    def test_dataset_cache(self):
+        zzzcmd('zzzfs create -p foo/a/b')
+        with DatasetCache() as cache:
+            fs = get_dataset_by('foo/a/b')
+            # handles are interned, including parents and pools
+            self.assertIs(fs, get_dataset_by('foo/a/b'))
+            self.assertIs(fs.get_parent(), get_dataset_by('foo/a'))
+            self.assertIs(fs.pool, get_dataset_by('foo@snap', None, None).pool)
+
+            # changes made through datasets are seen immediately
+            snap = get_dataset_by('foo/a/b@snap', should_exist=False)
+            snap.create()
+            self.assertTrue(get_dataset_by('foo/a/b@snap').exists())
+            fs.add_local_property('x', '1')
+            self.assertEqual('1', get_dataset_by('foo/a/b').get_property('x'))
+
+            # outside changes are seen in the next command
+            shutil.rmtree(snap.root)
+            self.assertTrue(snap.exists())
+            cache.new_command()
+            self.assertFalse(snap.exists())
+
     def test_zfs_create(self):
         # missing intermediate filesystems
         with self.assertRaises(ZzzFSException):
@@ -294,6 +599,31 @@ class ZFSTest(ZzzFSTestBase):
             'foo/la/dee/da@first',
             zzzcmd('zzzfs list -H -t snap -o name -r foo/la/dee'))
 
+    def test_zfs_list_streaming(self):
+        zzzcmd('zzzfs create -p foo/la/dee/da')
+        zzzcmd('zzzfs snapshot foo/la@first foo/la/dee@first')
+
+        # datasets are generated lazily, so the first is available at once
+        datasets = get_all_datasets([], PropertyList('all'), False, 0)
+        self.assertTrue(hasattr(next(datasets), 'name'))
+
+        # snapshot directories aren't read unless snapshots are requested
+        get_snapshots = Filesystem.get_snapshots
+        def fail(self):
+            raise AssertionError('read snapshots of %s' % self.name)
+        Filesystem.get_snapshots = fail
+        try:
+            self.assertEqual(
+                ['foo/la', 'foo/la/dee'], [d.name for d in get_all_datasets(
+                    ['foo/la'], PropertyList('filesystem'), False, 1)])
+        finally:
+            Filesystem.get_snapshots = get_snapshots
+
+        self.assertEqual(
+            ['foo/la/dee@first', 'foo/la@first'], sorted(
+                d.full_name for d in get_all_datasets(
+                    ['foo/la'], PropertyList('snap'), True, 0)))
+
     def test_zfs_list_sort(self):
         # not using assertSetEquals here because order matters, obviously
         self.assertEqual(
@@ -321,6 +651,38 @@ class ZFSTest(ZzzFSTestBase):
         with self.assertRaises(ZzzFSException):
             zzzcmd('zzzfs list -H -o name -s myprop')
 
+    def test_zfs_list_typed_output(self):
+        zzzcmd('zzzfs set used=12345 foo')
+        zzzcmd('zzzfs set used=512 bar')
+
+        # numeric columns sort as numbers, not strings
+        self.assertEqual(
+            'bar\t512\nfoo\t12.1K',
+            zzzcmd('zzzfs list -H -o name,used -s used'))
+        self.assertEqual(
+            'foo\t12.1K\nbar\t512',
+            zzzcmd('zzzfs list -H -o name,used -S used'))
+
+        # -p prints exact values
+        self.assertEqual(
+            'foo\t12345\nbar\t512',
+            zzzcmd('zzzfs list -H -p -o name,used -S used'))
+
+        # machine-readable output
+        self.assertEqual(
+            [{'name': 'bar', 'used': 512}, {'name': 'foo', 'used': 12345}],
+            json.loads(zzzcmd('zzzfs list -j -o name,used -s name')))
+        self.assertEqual(
+            {'name': 'foo', 'used': 12345}, json.loads(zzzcmd(
+                'zzzfs list --ndjson -o name,used foo')))
+        self.assertEqual('[\n]', zzzcmd('zzzfs list --json -t snap'))
+
+        # rows are written straight to the stream, if one is given
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        self.assertIsNone(zzzfs_main(
+            ['zzzfs', 'list', '-H', '-o', 'name', 'foo'], out))
+        self.assertEqual('foo\n', out.getvalue())
+
     def test_zfs_snapshot(self):
         self.populate_randomly(os.path.join(self.zroot1, 'foo'))
         zzzcmd('zzzfs snapshot foo@first')
@@ -337,6 +699,68 @@ class ZFSTest(ZzzFSTestBase):
         # should have been created once, anyway
         self.assertIn('foo@fourth', zzzcmd('zzzfs list -t snapshot'))
 
+    def test_autosnap(self):
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzfs set com.sun:auto-snapshot:hourly=some foo')
+        zzzcmd('zzzfs create -p foo/a/b')
+        zzzcmd('zzzfs set com.sun:auto-snapshot=true foo/a')
+        for frequency in ('frequent', 'daily', 'weekly', 'monthly'):
+            zzzcmd('zzzfs set com.sun:auto-snapshot:%s=false foo/a' % (
+                frequency))
+        zzzcmd('zzzfs set com.sun:auto-snapshot:hourly=2 foo/a')
+        self.assertEqual(2, len(zzzcmd('zzzfs autosnap run -n').split('\n')))
+
+        # one snapshot per hour, of the tagged filesystem and its children
+        pool = get_dataset_by('foo').pool
+        filesystems = [get_dataset_by('foo/a'), get_dataset_by('foo/a/b')]
+        start = datetime.datetime(2015, 6, 1, 12, 30)
+        for minutes in (0, 10, 40, 100, 100):
+            pool.autosnap(
+                filesystems, now=start + datetime.timedelta(minutes=minutes))
+        self.assertEqual(
+            ['autosnap_hourly-2015-06-01-1300',
+             'autosnap_hourly-2015-06-01-1400'],
+            sorted(s.name for s in filesystems[1].get_snapshots()))
+
+        # only automatic snapshots are pruned
+        zzzcmd('zzzfs snapshot foo/a@manual')
+        taken, destroyed = pool.autosnap(
+            filesystems, now=start + datetime.timedelta(hours=3))
+        self.assertEqual(
+            ['foo/a/b@autosnap_hourly-2015-06-01-1300',
+             'foo/a@autosnap_hourly-2015-06-01-1300'],
+            sorted(s.full_name for s in destroyed))
+        self.assertEqual(
+            ['autosnap_hourly-2015-06-01-1400',
+             'autosnap_hourly-2015-06-01-1500', 'manual'],
+            sorted(s.name for s in filesystems[0].get_snapshots()))
+
+    def test_tree_copy(self):
+        src = os.path.join(self.zroot1, 'foo')
+        self.populate_randomly(src)
+        with open(os.path.join(src, 'big'), 'wb') as f:
+            f.write(os.urandom(1 << 20))
+        os.chmod(os.path.join(src, 'big'), 0o600)
+        os.utime(os.path.join(src, 'big'), (1e9, 1e9))
+        os.symlink('big', os.path.join(src, 'link'))
+
+        for threads, symlinks in ((1, False), (4, True)):
+            dst = os.path.join(self.zroot2, 'copy%d' % threads)
+            stats = treecopy.copytree(src, dst, symlinks, threads)
+            self.assertEqual(self.all_files_in(src), self.all_files_in(dst))
+            self.assertEqual(len(self.all_files_in(src)) - symlinks,
+                             stats.files)
+            self.assertGreaterEqual(stats.bytes, 1 << 20)
+
+            copied = os.stat(os.path.join(dst, 'big'))
+            self.assertEqual(0o600, copied.st_mode & 0o777)
+            self.assertEqual(1e9, copied.st_mtime)
+            self.assertEqual(symlinks, os.path.islink(
+                os.path.join(dst, 'link')))
+            with open(os.path.join(src, 'big'), 'rb') as a:
+                with open(os.path.join(dst, 'link'), 'rb') as b:
+                    self.assertEqual(a.read(), b.read())
+
     def test_zfs_snapshot_with_properties(self):
         zzzcmd('zzzfs snapshot -o x=1 -o y=2 foo@first')
         self.assertEqual(
@@ -390,6 +814,194 @@ class ZFSTest(ZzzFSTestBase):
         # if receive failed, filesystem should not have been created
         self.assertNotIn('foo/newer', zzzcmd('zzzfs list'))
 
+    def test_receive_writes_filesystem_copy(self):
+        origin = os.path.join(self.zroot1, 'foo', 'origin')
+        zzzcmd('zzzfs create foo/origin')
+        contents = dict(('f%d' % i, os.urandom(i << 12)) for i in range(40))
+        for name, data in contents.items():
+            with open(os.path.join(origin, name), 'wb') as f:
+                f.write(data)
+        zzzcmd('zzzfs snapshot foo/origin@first')
+
+        os.environ['ZZZFS_COPY_THREADS'] = '4'
+        try:
+            zfs.receive('bar/copy', stream=self.sent('foo/origin@first'))
+        finally:
+            del os.environ['ZZZFS_COPY_THREADS']
+        copy = os.path.join(self.zroot2, 'bar', 'copy')
+        snapshot = get_dataset_by('bar/copy@first').data
+        for name, data in contents.items():
+            for path in (os.path.join(copy, name),
+                         os.path.join(snapshot, name)):
+                with open(path, 'rb') as f:
+                    self.assertEqual(data, f.read())
+            # separate copies, so the snapshot can't change with the data
+            self.assertFalse(treecopy.is_linked(
+                os.path.join(copy, name), os.path.join(snapshot, name)))
+
+    def test_resumable_receive(self):
+        origin = os.path.join(self.zroot1, 'foo', 'origin')
+        zzzcmd('zzzfs create foo/origin')
+        self.populate_randomly(origin)
+        with open(os.path.join(origin, 'big'), 'wb') as f:
+            f.write(os.urandom(8 << 20))
+        zzzcmd('zzzfs snapshot foo/origin@first')
+        stream = self.sent('foo/origin@first').getvalue()
+
+        # a damaged stream is refused, and discarded without -s
+        damaged = bytearray(stream)
+        damaged[len(stream) // 2] ^= 0xff
+        with self.assertRaises(ZzzFSException):
+            zfs.receive('bar/copy', stream=io.BytesIO(bytes(damaged)))
+        self.assertNotIn('bar/copy', zzzcmd('zzzfs list -H'))
+
+        # cut off partway through the big file, then resumed
+        with self.assertRaises(ZzzFSException):
+            zfs.receive('bar/copy', resumable=True,
+                        stream=io.BytesIO(stream[:len(stream) // 2]))
+        token = zzzcmd('zzzfs get -H -o value receive_resume_token bar/copy')
+        with self.assertRaises(ZzzFSException):
+            zfs.receive('bar/copy', stream=self.sent('foo/origin@first'))
+        buf = io.BytesIO()
+        zfs.send(resume_token=token, stream=buf)
+        self.assertLess(buf.tell(), len(stream) * 3 // 4)
+        buf.seek(0)
+        zfs.receive('bar/copy', stream=buf, resumable=True)
+        self.assertEqual(
+            self.all_files_in(origin),
+            self.all_files_in(os.path.join(self.zroot2, 'bar', 'copy')))
+        self.assertEqual(
+            '', zzzcmd('zzzfs get -H -o value receive_resume_token bar/copy'))
+
+        # an interrupted receive can be abandoned instead
+        with self.assertRaises(ZzzFSException):
+            zfs.receive('bar/other', stream=io.BytesIO(stream[:1000]),
+                        resumable=True)
+        zzzcmd('zzzfs receive -A bar/other')
+        self.assertNotIn('bar/other', zzzcmd('zzzfs list -H'))
+
+    def test_replication_stream(self):
+        for fs in ('a', 'a/b', 'a/c'):
+            zzzcmd('zzzfs create foo/' + fs)
+            self.populate_randomly(os.path.join(self.zroot1, 'foo', fs))
+        zzzcmd('zzzfs set color=blue foo/a/b')
+        zzzcmd('zzzfs snapshot foo/a@first foo/a/b@first foo/a/c@first')
+        with open(os.path.join(self.zroot1, 'foo', 'a', 'b', 'new'), 'w') as f:
+            f.write('new')
+        # foo/a/c has no @second, so isn't sent
+        zzzcmd('zzzfs snapshot foo/a@second foo/a/b@second')
+        zzzcmd('zzzfs snapshot foo/a@third foo/a/b@third')
+
+        buf = io.BytesIO()
+        zfs.send('foo/a@second', stream=buf, replicate=True)
+        buf.seek(0)
+        zfs.receive('bar/copy', stream=buf)
+        self.assertEqual(
+            ['bar/copy', 'bar/copy/b', 'bar/copy/b@first', 'bar/copy/b@second',
+             'bar/copy@first', 'bar/copy@second'],
+            sorted(zzzcmd(
+                'zzzfs list -H -o name -t all -r bar/copy').split('\n')))
+        self.assertEqual(
+            'blue', zzzcmd('zzzfs get -H -o value color bar/copy/b'))
+        self.assertEqual(
+            self.all_files_in(get_dataset_by('foo/a/b@second').data),
+            self.all_files_in(os.path.join(self.zroot2, 'bar', 'copy', 'b')))
+
+    def test_deduplicated_stream(self):
+        origin = os.path.join(self.zroot1, 'foo', 'origin')
+        zzzcmd('zzzfs create foo/origin')
+        data = os.urandom(1 << 20)
+        for name in ('a', 'b', 'c'):
+            with open(os.path.join(origin, name), 'wb') as f:
+                f.write(data)
+            os.utime(os.path.join(origin, name), (1000000000, 1000000000))
+        zzzcmd('zzzfs snapshot foo/origin@first')
+
+        buf = io.BytesIO()
+        zfs.send('foo/origin@first', stream=buf, dedup=True)
+        self.assertLess(buf.tell(), len(self.sent('foo/origin@first').read()))
+        buf.seek(0)
+        zfs.receive('bar/copy', stream=buf)
+
+        # linked in the snapshot, but separate files in the filesystem
+        copy = os.path.join(self.zroot2, 'bar', 'copy')
+        snapshot = get_dataset_by('bar/copy@first').data
+        for name in ('a', 'b', 'c'):
+            with open(os.path.join(copy, name), 'rb') as f:
+                self.assertEqual(data, f.read())
+        self.assertTrue(treecopy.is_linked(
+            os.path.join(snapshot, 'a'), os.path.join(snapshot, 'c')))
+        self.assertFalse(treecopy.is_linked(
+            os.path.join(copy, 'a'), os.path.join(copy, 'c')))
+
+    def test_zfs_copy(self):
+        for fs in ('a', 'a/b'):
+            zzzcmd('zzzfs create foo/' + fs)
+            self.populate_randomly(os.path.join(self.zroot1, 'foo', fs))
+        zzzcmd('zzzfs set color=blue foo/a')
+        zzzcmd('zzzfs snapshot foo/a@first foo/a/b@first')
+        with open(os.path.join(self.zroot1, 'foo', 'a', 'b', 'new'), 'w') as f:
+            f.write('new')
+        zzzcmd('zzzfs snapshot foo/a@second foo/a/b@second')
+
+        zzzcmd('zzzfs copy foo/a/b@second bar/b')
+        self.assertEqual(
+            ['bar/b', 'bar/b@second'],
+            sorted(zzzcmd('zzzfs list -H -o name -t all -r bar/b').split()))
+        self.assertEqual('', zzzcmd('zzzfs get -H -o value origin bar/b'))
+        self.assertIn('zzzfs copy', zzzcmd('zzzpool history bar'))
+        source = get_dataset_by('foo/a/b@second').data
+        copy = os.path.join(self.zroot2, 'bar', 'b')
+        self.assertEqual(self.all_files_in(source), self.all_files_in(copy))
+        # snapshots share their files, on the same device; filesystems don't
+        self.assertTrue(treecopy.is_linked(
+            os.path.join(source, 'new'),
+            os.path.join(get_dataset_by('bar/b@second').data, 'new')))
+        self.assertFalse(treecopy.is_linked(
+            os.path.join(source, 'new'), os.path.join(copy, 'new')))
+
+        zzzcmd('zzzfs copy -R foo/a@second bar/a')
+        self.assertEqual(
+            ['bar/a', 'bar/a/b', 'bar/a/b@first', 'bar/a/b@second',
+             'bar/a@first', 'bar/a@second'],
+            sorted(zzzcmd('zzzfs list -H -o name -t all -r bar/a').split()))
+        self.assertEqual('blue', zzzcmd('zzzfs get -H -o value color bar/a'))
+        self.assertEqual(
+            self.all_files_in(source),
+            self.all_files_in(os.path.join(self.zroot2, 'bar', 'a', 'b')))
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzfs copy foo/a@first bar/a')
+
+    @unittest.skipUnless(hasattr(os, 'SEEK_DATA'), 'holes not detectable')
+    def test_sparse_files(self):
+        zzzcmd('zzzfs create foo/vm')
+        image = os.path.join(self.zroot1, 'foo', 'vm', 'disk.img')
+        with open(image, 'wb') as f:
+            f.write(b'boot')
+            f.seek(32 << 20)
+            f.write(b'data')
+            f.truncate(64 << 20)
+        if not treecopy.has_holes(os.stat(image)):
+            self.skipTest('filesystem does not support holes')
+
+        zzzcmd('zzzfs snapshot foo/vm@first')
+        zzzcmd('zzzfs clone foo/vm@first foo/copy')
+        buf = io.BytesIO()
+        zfs.send('foo/vm@first', stream=buf)
+        self.assertLess(buf.tell(), 1 << 16)
+        buf.seek(0)
+        zfs.receive('foo/received', stream=buf)
+
+        with open(image, 'rb') as f:
+            contents = f.read()
+        for fs in ('vm', 'copy', 'received'):
+            path = os.path.join(self.zroot1, 'foo', fs, 'disk.img')
+            st = os.stat(path)
+            self.assertEqual(64 << 20, st.st_size)
+            self.assertLess(st.st_blocks * 512, 1 << 20)
+            with open(path, 'rb') as f:
+                self.assertEqual(contents, f.read())
+
     def test_zfs_diff(self):
         foo_path = os.path.join(self.zroot1, 'foo')
         self.populate_randomly(foo_path)
@@ -404,6 +1016,275 @@ class ZFSTest(ZzzFSTestBase):
             zzzcmd('zzzfs diff foo@first'),
             zzzcmd('zzzfs diff foo@first foo'))
 
+    def start_watcher(self, filesystem):
+        '''Run zzzfs watch in a child process until the test ends.'''
+        watcher = multiprocessing.Process(
+            target=zzzcmd, args=('zzzfs watch ' + filesystem,))
+        watcher.start()
+        journal = get_dataset_by(filesystem).journal
+        for _ in range(500):
+            if journal.running():
+                break
+            time.sleep(0.01)
+
+        def stop():
+            watcher.terminate()
+            watcher.join()
+        self.addCleanup(stop)
+        return stop
+
+    def test_change_journal(self):
+        foo_path = os.path.join(self.zroot1, 'foo')
+        self.populate_randomly(foo_path)
+        for name in ('kept', 'changed', 'removed'):
+            with open(os.path.join(foo_path, name), 'w') as f:
+                f.write(name)
+        stop_watcher = self.start_watcher('foo')
+        zzzcmd('zzzfs snapshot foo@first')
+        zfs.receive('bar/copy', stream=self.sent('foo@first'))
+
+        with open(os.path.join(foo_path, 'changed'), 'w') as f:
+            f.write('new contents')
+        os.remove(os.path.join(foo_path, 'removed'))
+        self.populate_randomly(os.path.join(foo_path, 'new'))
+        journaled_diff = zzzcmd('zzzfs diff foo@first')
+        zzzcmd('zzzfs snapshot foo@second')
+
+        # unchanged files are shared with the first snapshot
+        first = get_dataset_by('foo@first')
+        second = get_dataset_by('foo@second')
+        self.assertTrue(os.path.samefile(
+            os.path.join(first.data, 'kept'),
+            os.path.join(second.data, 'kept')))
+        with open(os.path.join(first.data, 'changed')) as f:
+            self.assertEqual('changed', f.read())
+        with open(os.path.join(second.data, 'changed')) as f:
+            self.assertEqual('new contents', f.read())
+        self.assertEqual(
+            self.all_files_in(foo_path), self.all_files_in(second.data))
+
+        # incremental send carries just the changes
+        zfs.receive(
+            'bar/copy', stream=self.sent('foo@second', '@first'))
+        copy_path = os.path.join(self.zroot2, 'bar', 'copy')
+        self.assertEqual(
+            self.all_files_in(foo_path), self.all_files_in(copy_path))
+        with open(os.path.join(copy_path, 'changed')) as f:
+            self.assertEqual('new contents', f.read())
+
+        # without a watcher, everything is compared and copied
+        stop_watcher()
+        self.assertEqual(
+            sorted(journaled_diff.split('\n')),
+            sorted(zzzcmd('zzzfs diff foo@first').split('\n')))
+        self.assertIn('-\tremoved', journaled_diff)
+        self.assertIn('M\tchanged', journaled_diff)
+        self.assertIn('+\tnew', journaled_diff)
+        zzzcmd('zzzfs snapshot foo@third')
+        self.assertFalse(os.path.samefile(
+            os.path.join(first.data, 'kept'),
+            os.path.join(get_dataset_by('foo@third').data, 'kept')))
+
+    def test_change_journal_renamed_snapshot(self):
+        # marks follow snapshots, not names that may be reused
+        foo_path = os.path.join(self.zroot1, 'foo')
+        with open(os.path.join(foo_path, 'x'), 'w') as f:
+            f.write('v0')
+        self.start_watcher('foo')
+        zzzcmd('zzzfs snapshot foo@s1')
+        with open(os.path.join(foo_path, 'x'), 'w') as f:
+            f.write('v1')
+        zzzcmd('zzzfs snapshot foo@s2')
+        zzzcmd('zzzfs destroy foo@s2')
+        zzzcmd('zzzfs rename foo@s1 foo@s2')
+        with open(os.path.join(foo_path, 'y'), 'w') as f:
+            f.write('y')
+        zzzcmd('zzzfs snapshot foo@s3')
+
+        with open(os.path.join(get_dataset_by('foo@s3').data, 'x')) as f:
+            self.assertEqual('v1', f.read())
+        self.assertEqual('', zzzcmd('zzzfs diff foo@s3'))
+        self.assertEqual(
+            ['+\ty', 'M\tx'], sorted(zzzcmd('zzzfs diff foo@s2').split('\n')))
+
+    def sent(self, snapshot, incremental_from=None):
+        buf = io.BytesIO()
+        zfs.send(snapshot, incremental_from, stream=buf)
+        buf.seek(0)
+        return buf
+
+    def test_bookmarks(self):
+        foo_path = os.path.join(self.zroot1, 'foo')
+        self.populate_randomly(foo_path)
+        for name in ('changed', 'removed'):
+            with open(os.path.join(foo_path, name), 'w') as f:
+                f.write('old contents')
+        zzzcmd('zzzfs snapshot foo@first')
+        zfs.receive('bar/copy', stream=self.sent('foo@first'))
+        zzzcmd('zzzfs bookmark foo@first #mark')
+        zzzcmd('zzzfs destroy foo@first')
+        self.assertEqual(
+            'foo#mark', zzzcmd('zzzfs list -H -o name -t bookmark'))
+        self.assertEqual(
+            'foo', zzzcmd('zzzfs list -H -o name -t filesystem,snapshot foo'))
+
+        with open(os.path.join(foo_path, 'changed'), 'w') as f:
+            f.write('new contents')
+        os.remove(os.path.join(foo_path, 'removed'))
+        with open(os.path.join(foo_path, 'new'), 'w') as f:
+            f.write('new')
+        zzzcmd('zzzfs snapshot foo@second')
+        zfs.receive('bar/copy', stream=self.sent('foo@second', '#mark'))
+        self.assertEqual(
+            self.all_files_in(foo_path),
+            self.all_files_in(os.path.join(self.zroot2, 'bar', 'copy')))
+
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzfs bookmark foo@second bar/copy#mark')
+        zzzcmd('zzzfs destroy foo#mark')
+        self.assertEqual('', zzzcmd('zzzfs list -H -o name -t bookmark'))
+
+    def test_compression(self):
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzfs set compression=zlib-0 foo')
+        zzzcmd('zzzfs create -o compression=zlib-6 foo/c')
+        c_path = os.path.join(self.zroot1, 'foo', 'c')
+        contents = {
+            'text': b'snooze ' * (1 << 16), 'random': os.urandom(1 << 16),
+            'small': b'zzz' * 100}
+        for name, data in contents.items():
+            with open(os.path.join(c_path, name), 'wb') as f:
+                f.write(data)
+        zzzcmd('zzzfs snapshot foo/c@first')
+
+        # only the file worth compressing is stored compressed
+        snapshot = get_dataset_by('foo/c@first')
+        for name, data in contents.items():
+            size = os.path.getsize(os.path.join(snapshot.data, name))
+            if name == 'text':
+                self.assertLess(size, len(data) // 10)
+            else:
+                self.assertEqual(len(data), size)
+        ratio = zzzcmd('zzzfs list -H -o compressratio -t snap foo/c@first')
+        self.assertGreater(float(ratio.rstrip('x')), 1.5)
+
+        # and decompressed on the way out
+        with open(os.path.join(c_path, 'text'), 'wb') as f:
+            f.write(b'changed')
+        self.assertEqual('M\ttext', zzzcmd('zzzfs diff foo/c@first'))
+        zzzcmd('zzzfs rollback foo/c@first')
+        zzzcmd('zzzfs clone foo/c@first foo/d')
+        zfs.receive('bar/copy', stream=self.sent('foo/c@first'))
+        for path in (c_path, os.path.join(self.zroot1, 'foo', 'd'),
+                     os.path.join(self.zroot2, 'bar', 'copy')):
+            for name, data in contents.items():
+                with open(os.path.join(path, name), 'rb') as f:
+                    self.assertEqual(data, f.read())
+
+    def test_cold_tier(self):
+        cold = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cold)
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzpool tier foo')  # no coldtier set
+        with self.assertRaises(ZzzFSException):
+            zzzcmd('zzzfs set coldage=soon foo')
+        zzzcmd('zzzfs set coldtier=%s foo' % cold)
+        zzzcmd('zzzfs create -o compression=on foo/a')
+        a_path = os.path.join(self.zroot1, 'foo', 'a')
+        os.makedirs(os.path.join(a_path, 'dir'))
+        contents = {'text': b'snooze ' * (1 << 16),
+                    'dir/random': os.urandom(1 << 16)}
+        for name, data in contents.items():
+            with open(os.path.join(a_path, name), 'wb') as f:
+                f.write(data)
+        zzzcmd('zzzfs snapshot foo/a@first')
+        os.remove(os.path.join(a_path, 'text'))
+        with open(os.path.join(a_path, 'dir', 'random'), 'wb') as f:
+            f.write(os.urandom(1 << 16))
+        zzzcmd('zzzfs snapshot foo/a@second')
+        creation = zzzcmd('zzzfs list -H -o creation -t snap foo/a@first')
+        diffs = [zzzcmd('zzzfs diff foo/a@first foo/a@second'),
+                 zzzcmd('zzzfs diff foo/a@second foo/a@first'),
+                 zzzcmd('zzzfs diff foo/a@first')]
+
+        # beyond the newest 100K, snapshots are archived
+        zzzcmd('zzzfs set hotsize=100K foo')
+        self.assertEqual('archived foo/a@first', zzzcmd('zzzpool tier foo'))
+        self.assertEqual('', zzzcmd('zzzpool tier foo'))
+        first = get_dataset_by('foo/a@first')
+        self.assertFalse(os.path.exists(first.data))
+        self.assertEqual(
+            'foo/a@first\tcold\nfoo/a@second\thot',
+            zzzcmd('zzzfs list -H -o name,tier -t snap -r foo/a'))
+        self.assertEqual(
+            creation, zzzcmd('zzzfs list -H -o creation -t snap foo/a@first'))
+
+        # diffed from its catalog, and extracted when its data is needed
+        self.assertEqual(diffs, [
+            zzzcmd('zzzfs diff foo/a@first foo/a@second'),
+            zzzcmd('zzzfs diff foo/a@second foo/a@first'),
+            zzzcmd('zzzfs diff foo/a@first')])
+        zfs.receive('bar/copy', stream=self.sent('foo/a@first'))
+        zfs.receive('bar/copy', stream=self.sent('foo/a@second', '@first'))
+        zzzcmd('zzzfs clone foo/a@first foo/b')
+        zzzcmd('zzzfs rollback foo/a@first')
+        for path in (a_path, os.path.join(self.zroot1, 'foo', 'b')):
+            for name, data in contents.items():
+                with open(os.path.join(path, name), 'rb') as f:
+                    self.assertEqual(data, f.read())
+        self.assertEqual(
+            ['dir/random'],
+            self.all_files_in(os.path.join(self.zroot2, 'bar', 'copy')))
+
+        # and at least coldage days old
+        zzzcmd('zzzfs inherit hotsize foo')
+        zzzcmd('zzzfs set coldage=7 foo')
+        self.assertEqual([], get_dataset_by('foo').pool.tier())
+        self.assertEqual(
+            ['foo/a@second'], [s.full_name for s in get_dataset_by(
+                'foo').pool.tier(now=time.time() + 8 * 24 * 60 * 60)])
+        zzzcmd('zzzfs destroy -r foo/a')
+        self.assertEqual([], os.listdir(cold))
+
+    def test_dedup(self):
+        contents = os.urandom(300 << 10)
+        for fs in ('a', 'b'):
+            zzzcmd('zzzfs create -o dedup=on foo/' + fs)
+            image = os.path.join(self.zroot1, 'foo', fs, 'image')
+            with open(image, 'wb') as f:
+                f.write(contents)
+        a_path = os.path.join(self.zroot1, 'foo', 'a')
+        self.populate_randomly(a_path)
+        zzzcmd('zzzfs snapshot foo/a@first foo/b@first')
+        snapshot = get_dataset_by('foo/a@first')
+        self.assertTrue(snapshot.is_deduplicated())
+        self.assertFalse(os.path.exists(snapshot.data))
+        # the image is stored once for both snapshots
+        self.assertEqual('2.00x', zzzcmd('zzzpool list -H -o dedup foo'))
+
+        # data is recreated from the chunks on the way out
+        files = self.all_files_in(a_path)
+        with open(os.path.join(a_path, 'image'), 'wb') as f:
+            f.write(b'changed')
+        self.assertEqual('M\timage', zzzcmd('zzzfs diff foo/a@first'))
+        zzzcmd('zzzfs rollback foo/a@first')
+        zzzcmd('zzzfs clone foo/a@first foo/c')
+        zfs.receive('bar/copy', stream=self.sent('foo/a@first'))
+        for path in (a_path, os.path.join(self.zroot1, 'foo', 'c'),
+                     os.path.join(self.zroot2, 'bar', 'copy')):
+            self.assertEqual(files, self.all_files_in(path))
+            with open(os.path.join(path, 'image'), 'rb') as f:
+                self.assertEqual(contents, f.read())
+
+        # chunks are only freed once no snapshot uses them
+        self.assertEqual(
+            'freed 0 chunks (0), dedup ratio 2.00x', zzzcmd('zzzpool gc foo'))
+        zzzcmd('zzzfs destroy foo/a')
+        zzzcmd('zzzfs destroy foo/b')
+        self.assertEqual(
+            'freed 3 chunks (300K), dedup ratio 1.00x',
+            zzzcmd('zzzpool gc foo'))
+
     def test_zfs_rename_filesystem(self):
         something_path = os.path.join(self.zroot1, 'foo', 'something')
         subfoo_path = os.path.join(self.zroot1, 'foo', 'subfoo')
@@ -469,6 +1350,179 @@ class ZFSTest(ZzzFSTestBase):
         self.assertEqual(self.all_files_in(production_path), beta_contents)
         self.assertNotIn('foo/beta', zzzcmd('zzzfs list'))
 
+    def test_zfs_program(self):
+        program = tempfile.NamedTemporaryFile(mode='w', delete=False)
+        program.write(
+            '# set up a small hierarchy\n'
+            'create -p foo/a/b\n'
+            '\n'
+            'zzzfs set myvar=nothing foo/a\n'
+            'snapshot foo/a@first bar@first\n'
+            'get -H -o value myvar foo/a/b\n')
+        program.close()
+        try:
+            self.assertEqual('nothing', zzzcmd('zzzfs program ' + program.name))
+        finally:
+            os.remove(program.name)
+
+        self.assertIn('foo/a/b', zzzcmd('zzzfs list -H -o name'))
+        self.assertIn('foo/a@first', zzzcmd('zzzfs list -H -t snap -o name'))
+        # each command is logged individually in the pools it affected
+        self.assertIn('zzzfs set myvar=nothing foo/a', zzzcmd(
+            'zzzpool history foo'))
+        self.assertNotIn('create -p foo/a/b', zzzcmd('zzzpool history bar'))
+        self.assertIn('snapshot foo/a@first bar@first', zzzcmd(
+            'zzzpool history bar'))
+
+        # the whole program is parsed before anything runs
+        with self.assertRaises(ZzzFSException):
+            zzzfs_program('zzzfs', ['create foo/c', 'no-such-command'])
+        self.assertNotIn('foo/c', zzzcmd('zzzfs list -H -o name'))
+
+    def test_zfs_program_errors(self):
+        lines = ['create foo/c', 'create foo/c', 'create foo/d']
+
+        # by default, every command is attempted
+        with self.assertRaises(ZzzFSException):
+            zzzfs_program('zzzfs', lines)
+        self.assertIn('foo/d', zzzcmd('zzzfs list -H -o name'))
+        zzzcmd('zzzfs destroy foo/c')
+        zzzcmd('zzzfs destroy foo/d')
+
+        # -e stops at the first failure
+        with self.assertRaises(ZzzFSException):
+            zzzfs_program('zzzfs', lines, stop_on_error=True)
+        self.assertIn('foo/c', zzzcmd('zzzfs list -H -o name'))
+        self.assertNotIn('foo/d', zzzcmd('zzzfs list -H -o name'))
+        zzzcmd('zzzfs destroy foo/c')
+
+        # --rollback undoes everything the program did
+        foo_path = os.path.join(self.zroot1, 'foo')
+        self.populate_randomly(foo_path)
+        contents_before = self.all_files_in(foo_path)
+        history_before = zzzcmd('zzzpool history foo')
+        with self.assertRaises(ZzzFSException):
+            zzzfs_program(
+                'zzzfs', ['set x=1 foo'] + lines, rollback=True)
+        self.assertNotIn('foo/c', zzzcmd('zzzfs list -H -o name'))
+        self.assertEqual('', zzzcmd('zzzfs get -H -s local -o value x foo'))
+        self.assertEqual(contents_before, self.all_files_in(foo_path))
+        self.assertEqual(history_before, zzzcmd('zzzpool history foo'))
+
+        # including commands that modify pools without naming them
+        zzzcmd('zzzfs set com.sun:auto-snapshot=true foo')
+        history_before = zzzcmd('zzzpool history foo')
+        with self.assertRaises(ZzzFSException) as raised:
+            zzzfs_program(
+                'zzzfs', ['autosnap run', 'destroy nopool/x'], rollback=True)
+        self.assertIn('program rolled back', str(raised.exception))
+        self.assertEqual('', zzzcmd('zzzfs list -H -t snapshot'))
+        self.assertEqual(history_before, zzzcmd('zzzpool history foo'))
+
+    def test_trace(self):
+        origin = os.path.join(self.zroot1, 'foo', 'origin')
+        zzzcmd('zzzfs create foo/origin')
+        for i in range(10):
+            with open(os.path.join(origin, 'f%d' % i), 'wb') as f:
+                f.write(os.urandom(1000))
+        log = os.path.join(self.zzzfs_root, 'trace.log')
+        stat = os.stat
+
+        os.environ['ZZZFS_TRACE'] = log
+        try:
+            zzzcmd('zzzfs snapshot foo/origin@first')
+            with self.assertRaises(ZzzFSException):
+                zzzcmd('zzzfs destroy foo/missing')
+        finally:
+            del os.environ['ZZZFS_TRACE']
+        zzzcmd('zzzfs list')
+        # counting calls only while tracing
+        self.assertIs(stat, os.stat)
+
+        with open(log) as f:
+            snapshot, destroy = [json.loads(line) for line in f]
+        self.assertEqual(
+            ['zzzfs', 'snapshot', 'foo/origin@first'], snapshot['command'])
+        self.assertEqual(10, snapshot['counters']['files_copied'])
+        self.assertEqual(10000, snapshot['counters']['bytes_copied'])
+        self.assertGreater(snapshot['calls']['open'], 10)
+        self.assertIn('copy', snapshot['phases'])
+        self.assertGreaterEqual(
+            snapshot['wall'], snapshot['phases']['copy']['wall'])
+        self.assertEqual('foo/missing: no such dataset', destroy['error'])
+
+
+class CrashRecoveryTest(ZzzFSTestBase):
+    '''Test recovery of operations interrupted by a crash.'''
+    def crash_during(self, cmdline, module, function, after_calls):
+        '''Run a command in a child process which exits abruptly on calling
+        module.function for the (after_calls + 1)th time.
+        '''
+        def run():
+            calls = []
+            original = getattr(module, function)
+            def crash(*args, **kwargs):
+                if len(calls) == after_calls:
+                    os._exit(1)
+                calls.append(args)
+                return original(*args, **kwargs)
+            setattr(module, function, crash)
+            zzzcmd(cmdline)
+
+        child = multiprocessing.Process(target=run)
+        child.start()
+        child.join()
+        self.assertEqual(1, child.exitcode)
+
+    def test_interrupted_create(self):
+        self.crash_during('zzzfs create foo/subfoo', os, 'symlink', 0)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.zroot1, 'foo', 'subfoo')))
+
+        # next access removes the half-created filesystem
+        self.assertNotIn('foo/subfoo', zzzcmd('zzzfs list -H -o name'))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.zroot1, 'foo', 'subfoo')))
+        zzzcmd('zzzfs create foo/subfoo')
+
+    def test_interrupted_snapshot(self):
+        self.populate_randomly(os.path.join(self.zroot1, 'foo'))
+        self.crash_during('zzzfs snapshot foo@first', os, 'makedirs', 2)
+        self.assertTrue(os.path.exists(Snapshot('foo', 'first').root))
+        self.assertEqual('', zzzcmd('zzzfs list -H -t snap'))
+        zzzcmd('zzzfs snapshot foo@first')
+
+    def test_interrupted_rename(self):
+        zzzcmd('zzzfs create foo/something')
+        zzzcmd('zzzfs set myvar=something foo/something')
+        path = os.path.join(self.zroot1, 'foo', 'something')
+        self.populate_randomly(path)
+        contents_before = self.all_files_in(path)
+
+        # crash after moving the data, but before moving properties
+        self.crash_during(
+            'zzzfs rename foo/something foo/subfoo', treecopy, 'move', 1)
+
+        # zzzpool access also finishes the rename
+        zzzcmd('zzzpool list foo')
+        self.assertEqual(
+            'foo\nfoo/subfoo', zzzcmd('zzzfs list -H -o name -s name -r foo'))
+        self.assertEqual(
+            'something', zzzcmd('zzzfs get -H -o value myvar foo/subfoo'))
+        self.assertEqual(contents_before, self.all_files_in(
+            os.path.join(self.zroot1, 'foo', 'subfoo')))
+
+    def test_operations_in_progress_are_not_recovered(self):
+        # another process is mid-way through an operation
+        log = IntentLog(get_dataset_by('foo').pool.intent_log)
+        intent_id = log.begin('snapshot', {'root': self.zroot1})
+        try:
+            zzzcmd('zzzfs list')
+            self.assertTrue(os.path.exists(self.zroot1))
+        finally:
+            log.end(intent_id, sync=True)
+            log.f.close()
+
 
 class ConcurrencyTest(unittest.TestCase):
     '''Test thread safety of filesystem create/destroy.'''